@@ -1,12 +1,18 @@
 """
-Add placeholder chapters to the database
+Add placeholder chapters to the content
+
+The chapters are published as a new content version cloned from the active
+one, with the same ids ingest_content.py gives chapters of the same name, so
+a later ingest of a unit fills in its placeholder.
 """
 import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 import os
 from pathlib import Path
-import uuid
+
+from content_versions import ContentNamespace, get_active_version, publish
+from ingest_content import stable_id
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -77,32 +83,41 @@ chapters_data = [
 ]
 
 async def add_chapters():
-    # Get existing chapters
-    existing = await db.chapters.find({}).to_list(100)
-    existing_titles = [ch.get('title') or ch.get('chapter_name') for ch in existing]
-    
-    print(f"Found {len(existing)} existing chapters")
+    added = []
     
-    for chapter_data in chapters_data:
-        # Check if chapter already exists
-        if chapter_data['title'] in existing_titles:
-            print(f"✓ Chapter already exists: {chapter_data['title']}")
-            continue
+    async def build(draft):
+        # Get existing chapters
+        existing = await draft.chapters.find({}).to_list(100)
+        existing_titles = [ch.get('title') or ch.get('chapter_name') for ch in existing]
         
-        # Add chapter_id and chapter_name
-        chapter_data['chapter_id'] = str(uuid.uuid4())
-        chapter_data['chapter_name'] = chapter_data['title']
+        print(f"Found {len(existing)} existing chapters")
         
-        await db.chapters.insert_one(chapter_data)
-        print(f"✅ Added chapter: {chapter_data['title']}")
+        for chapter_data in chapters_data:
+            # Check if chapter already exists
+            if chapter_data['title'] in existing_titles:
+                print(f"✓ Chapter already exists: {chapter_data['title']}")
+                continue
+            
+            # Add chapter_id and chapter_name
+            chapter_data['chapter_id'] = stable_id("chapter", chapter_data['title'])
+            chapter_data['chapter_name'] = chapter_data['title']
+            
+            await draft.chapters.insert_one(chapter_data)
+            added.append(chapter_data['title'])
+            print(f"✅ Added chapter: {chapter_data['title']}")
     
-    # Show all chapters
-    all_chapters = await db.chapters.find({}).sort("order", 1).to_list(100)
-    print(f"\n📚 Total chapters in database: {len(all_chapters)}")
-    for ch in all_chapters:
-        status = "🔓 Unlocked" if not ch.get('locked', False) else "🔒 Locked"
-        print(f"   {ch['order']}. {ch.get('title') or ch.get('chapter_name')} - {status}")
-    
-    client.close()
+    try:
+        version = await publish(db, build, note="placeholder chapters")
+        print(f"🚀 Published content version {version} with {len(added)} new chapters")
+        
+        # Show all chapters
+        content = ContentNamespace(db, await get_active_version(db))
+        all_chapters = await content.chapters.find({}).sort("order", 1).to_list(100)
+        print(f"\n📚 Total chapters in database: {len(all_chapters)}")
+        for ch in all_chapters:
+            status = "🔓 Unlocked" if not ch.get('locked', False) else "🔒 Locked"
+            print(f"   {ch['order']}. {ch.get('title') or ch.get('chapter_name')} - {status}")
+    finally:
+        client.close()
 
 asyncio.run(add_chapters())
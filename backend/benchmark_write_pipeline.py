@@ -0,0 +1,179 @@
+"""
+Benchmark the subtopic progress write path: the old sequential chain vs the current one
+
+The "sequential" side replays the writes update_subtopic_progress issued before
+the pipeline work: every side effect (progress upsert, XP $inc, subtopic scan,
+completion count, topic upsert, bonus $inc, streak read and write) is its own
+awaited round trip. The "pipelined" side calls server.apply_subtopic_progress,
+which buffers card swipes, journals XP for the aggregator and runs the
+independent rollups concurrently. Both run the same workload against a scratch
+database, which is dropped afterwards.
+
+Run against a local mongod or replica set, e.g.:
+    MONGO_URL="mongodb://localhost:27017" python benchmark_write_pipeline.py [--iterations 500]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+import server  # noqa: E402
+from content_versions import ContentNamespace  # noqa: E402
+
+SUBTOPICS_PER_TOPIC = 2
+CARDS_PER_SUBTOPIC = 5
+
+
+async def seed_content(database, subtopic_count):
+    """One chapter whose topics hold SUBTOPICS_PER_TOPIC subtopics each"""
+    subtopics = [
+        {
+            "subtopic_id": f"bench-s{n}",
+            "topic_id": f"bench-t{n // SUBTOPICS_PER_TOPIC}",
+            "chapter_id": "bench-c",
+            "microcontent_count": CARDS_PER_SUBTOPIC
+        }
+        for n in range(subtopic_count)
+    ]
+    topic_ids = sorted({s["topic_id"] for s in subtopics})
+    await database.topics.insert_many([{"topic_id": topic_id, "chapter_id": "bench-c"} for topic_id in topic_ids])
+    await database.subtopics.insert_many(subtopics)
+    return subtopics
+
+
+async def sequential_update_user_streak(database, user_id):
+    """update_user_streak as it was: a read, then a write"""
+    user = await database.users.find_one({"user_id": user_id})
+    last_activity = user.get("last_activity_date")
+    if last_activity and last_activity.date() == datetime.utcnow().date():
+        return
+    await database.users.update_one(
+        {"user_id": user_id},
+        {"$set": {"streak": 1, "last_activity_date": datetime.utcnow()}}
+    )
+
+
+async def sequential_progress(database, user_id, subtopic, current_card, completed):
+    """The pre-pipeline write chain of POST /subtopics/{id}/progress"""
+    await database.subtopics.find_one({"subtopic_id": subtopic["subtopic_id"]})
+    await database.subtopic_progress.update_one(
+        {"user_id": user_id, "subtopic_id": subtopic["subtopic_id"]},
+        {"$set": {
+            "topic_id": subtopic["topic_id"],
+            "chapter_id": subtopic["chapter_id"],
+            "current_card": current_card,
+            "progress": current_card / CARDS_PER_SUBTOPIC * 100,
+            "completed": completed,
+            "completed_at": datetime.utcnow() if completed else None,
+            "updated_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+    if not completed:
+        return
+
+    await database.users.update_one({"user_id": user_id}, {"$inc": {"xp": 20}})
+    siblings = await database.subtopics.find({"topic_id": subtopic["topic_id"]}).to_list(100)
+    completed_count = await database.subtopic_progress.count_documents({
+        "user_id": user_id,
+        "subtopic_id": {"$in": [s["subtopic_id"] for s in siblings]},
+        "completed": True
+    })
+    if completed_count == len(siblings):
+        await database.topic_progress.update_one(
+            {"user_id": user_id, "topic_id": subtopic["topic_id"]},
+            {"$set": {
+                "chapter_id": subtopic["chapter_id"],
+                "completed": True,
+                "completed_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow()
+            }},
+            upsert=True
+        )
+        await database.users.update_one({"user_id": user_id}, {"$inc": {"xp": 40}})
+    await sequential_update_user_streak(database, user_id)
+
+
+async def pipelined_progress(database, user_id, subtopic, current_card, completed):
+    """The current path: catalog lookup, then server.apply_subtopic_progress"""
+    info = await server.get_subtopic_info(subtopic["subtopic_id"])
+    await server.apply_subtopic_progress(
+        user_id, subtopic["subtopic_id"], info,
+        server.SubtopicProgressUpdate(current_card=current_card, completed=completed)
+    )
+
+
+async def measure(name, fn, database, user_id, subtopics):
+    """Swipe through every card of each subtopic, then complete it; time each request"""
+    swipes, completions = [], []
+    for subtopic in subtopics:
+        for card in range(1, CARDS_PER_SUBTOPIC + 1):
+            completed = card == CARDS_PER_SUBTOPIC
+            start = time.perf_counter()
+            await fn(database, user_id, subtopic, card, completed)
+            (completions if completed else swipes).append((time.perf_counter() - start) * 1000)
+
+    for label, samples in (("swipe", swipes), ("completion", completions)):
+        samples.sort()
+        p95 = samples[max(int(len(samples) * 0.95) - 1, 0)]
+        print(f"{name + ' ' + label:<24} mean {statistics.mean(samples):7.2f} ms   "
+              f"p50 {statistics.median(samples):7.2f} ms   p95 {p95:7.2f} ms")
+    return statistics.mean(swipes), statistics.mean(completions)
+
+
+def use_database(database, journal_dir):
+    """Point the server module's globals at the benchmark database"""
+    server.db = database
+    server.content = ContentNamespace(database)
+    server.catalog = server.ContentCatalog()
+    server.xp_aggregator = server.XpAggregator("XP aggregator", 60, journal_dir, False)
+
+
+async def run_benchmark(database, iterations):
+    """Run both paths over `iterations` subtopics each; returns {name: (swipe ms, completion ms)}"""
+    subtopics = await seed_content(database, iterations)
+    users = {name: f"bench-{name}-{uuid.uuid4()}" for name in ("sequential", "pipelined")}
+    await database.users.insert_many([{"user_id": user_id, "xp": 0, "streak": 0} for user_id in users.values()])
+
+    with tempfile.TemporaryDirectory() as journal_dir:
+        use_database(database, Path(journal_dir))
+        results = {
+            "sequential": await measure("sequential", sequential_progress, database, users["sequential"], subtopics),
+            "pipelined": await measure("pipelined", pipelined_progress, database, users["pipelined"], subtopics),
+        }
+        # Buffered swipes and XP are part of the write path; land them before comparing
+        await server.card_progress_buffer.flush()
+        await server.xp_aggregator.stop()
+
+    for label, index in (("swipe", 0), ("completion", 1)):
+        print(f"   {label} speedup: {results['sequential'][index] / results['pipelined'][index]:.2f}x")
+    return results, users
+
+
+async def main(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    database = client[args.db_name]
+    print(f"⏱  {args.iterations} subtopics x {CARDS_PER_SUBTOPIC} cards per path against {os.environ['MONGO_URL']}\n")
+    try:
+        await run_benchmark(database, args.iterations)
+    finally:
+        await client.drop_database(database.name)
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200, help="subtopics to swipe through and complete per path")
+    parser.add_argument("--db-name", default=os.environ.get("BENCH_DB_NAME", "ailo_bench"), help="scratch database, dropped afterwards")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,237 @@
+"""
+Versioned content publishing with an atomic active-version pointer
+
+Every published version lives in its own set of collections (`chapters__<version>`,
+`topics__<version>`, ...). A new version starts as a server-side copy of the
+active one, is filled and validated while students keep reading the old one,
+and goes live by switching the pointer document in `content_versions`. The
+server polls the pointer, so a publish never leaves an empty window, and old
+versions stay around for rollback.
+
+Usage:
+    python content_versions.py list
+    python content_versions.py activate <version>
+    python content_versions.py rollback
+    python content_versions.py prune [--keep 3]
+"""
+import argparse
+import asyncio
+import os
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+CONTENT_COLLECTIONS = ["chapters", "topics", "subtopics", "microcontent", "quiz_questions"]
+
+CONTENT_INDEXES = {
+    "chapters": ["chapter_id"],
+    "topics": ["topic_id", "chapter_id"],
+    "subtopics": ["subtopic_id", "topic_id"],
+    "microcontent": ["microcontent_id", "subtopic_id"],
+    "quiz_questions": ["question_id", "subtopic_id", "topic_id"],
+}
+
+POINTER_ID = "active"
+
+
+class ContentValidationError(Exception):
+    def __init__(self, version, errors):
+        super().__init__(f"Content version {version} failed validation: {'; '.join(errors)}")
+        self.version = version
+        self.errors = errors
+
+
+def collection_name(name, version):
+    return f"{name}__{version}" if version else name
+
+
+class ContentNamespace:
+    """Resolves content collections (db.chapters, ...) against one content version.
+
+    A version of None means the legacy unversioned collections.
+    """
+
+    def __init__(self, database, version=None):
+        self.database = database
+        self.version = version
+
+    def __getattr__(self, name):
+        if name in CONTENT_COLLECTIONS:
+            return self.database[collection_name(name, self.version)]
+        raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+async def get_active_version(database):
+    pointer = await database.content_versions.find_one({"_id": POINTER_ID})
+    return pointer["version"] if pointer else None
+
+
+async def create_version(database, clone_from_active=True, note=None):
+    """Create a draft version, optionally as a server-side copy of the active one"""
+    version = datetime.utcnow().strftime("v%Y%m%d%H%M%S%f")
+    source = await get_active_version(database)
+
+    await database.content_versions.insert_one({
+        "_id": version,
+        "status": "draft",
+        "cloned_from": source if clone_from_active else None,
+        "note": note,
+        "created_at": datetime.utcnow(),
+    })
+
+    for name in CONTENT_COLLECTIONS:
+        target = collection_name(name, version)
+        if clone_from_active:
+            await database[collection_name(name, source)].aggregate([{"$out": target}]).to_list(None)
+        for field in CONTENT_INDEXES[name]:
+            await database[target].create_index(field)
+
+    return version
+
+
+async def validate_version(database, version):
+    """Return a list of problems that would break the app if this version went live"""
+    content = ContentNamespace(database, version)
+    errors = []
+
+    ids = {}
+    for name, id_field in [("chapters", "chapter_id"), ("topics", "topic_id"), ("subtopics", "subtopic_id")]:
+        ids[name] = set(await content[name].distinct(id_field))
+    for name in ["chapters", "topics"]:
+        if not ids[name]:
+            errors.append(f"{name} is empty")
+
+    # Every document must point at a parent that exists in the same version
+    references = [
+        ("topics", "chapter_id", "chapters"),
+        ("subtopics", "topic_id", "topics"),
+        ("microcontent", "subtopic_id", "subtopics"),
+        ("quiz_questions", "subtopic_id", "subtopics"),
+    ]
+    for name, field, parent in references:
+        dangling = set(await content[name].distinct(field)) - ids[parent] - {None}
+        if dangling:
+            errors.append(f"{len(dangling)} {name} reference missing {parent}")
+
+    bad_questions = await content.quiz_questions.count_documents(
+        {"$expr": {"$not": {"$in": ["$correct_answer", {"$ifNull": ["$options", []]}]}}}
+    )
+    if bad_questions:
+        errors.append(f"{bad_questions} quiz_questions have a correct_answer missing from options")
+
+    # The card counts drive progress percentages, so they must match the cards
+    card_counts = {
+        doc["_id"]: doc["count"]
+        async for doc in content.microcontent.aggregate([{"$group": {"_id": "$subtopic_id", "count": {"$sum": 1}}}])
+    }
+    async for subtopic in content.subtopics.find({}, {"subtopic_id": 1, "microcontent_count": 1}):
+        if subtopic.get("microcontent_count", 0) != card_counts.get(subtopic["subtopic_id"], 0):
+            errors.append(f"subtopic {subtopic['subtopic_id']} microcontent_count does not match its cards")
+            break
+
+    return errors
+
+
+async def activate_version(database, version):
+    """Validate a version and atomically make it the one the server reads"""
+    if not await database.content_versions.find_one({"_id": version}):
+        raise ValueError(f"Unknown content version: {version}")
+
+    errors = await validate_version(database, version)
+    if errors:
+        await database.content_versions.update_one({"_id": version}, {"$set": {"status": "invalid", "errors": errors}})
+        raise ContentValidationError(version, errors)
+
+    previous = await get_active_version(database)
+    await database.content_versions.update_one(
+        {"_id": POINTER_ID},
+        {"$set": {"version": version, "previous": previous, "activated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    await database.content_versions.update_one({"_id": version}, {"$set": {"status": "active"}})
+    if previous and previous != version:
+        await database.content_versions.update_one({"_id": previous}, {"$set": {"status": "retired"}})
+    return version
+
+
+async def rollback(database):
+    """Re-activate the version that was live before the current one"""
+    pointer = await database.content_versions.find_one({"_id": POINTER_ID})
+    if not pointer or not pointer.get("previous"):
+        raise ValueError("No previous content version to roll back to")
+    return await activate_version(database, pointer["previous"])
+
+
+async def publish(database, build, note=None, clone_from_active=True):
+    """Create a version (by default cloned from the active one), let `build` fill it, then activate it.
+
+    `build` is an async callable receiving the version's ContentNamespace. If it
+    raises or validation fails the live version is left untouched.
+    """
+    version = await create_version(database, clone_from_active=clone_from_active, note=note)
+    try:
+        await build(ContentNamespace(database, version))
+        await activate_version(database, version)
+    except Exception:
+        await database.content_versions.update_one(
+            {"_id": version, "status": "draft"},
+            {"$set": {"status": "failed"}}
+        )
+        raise
+    return version
+
+
+async def prune_versions(database, keep=3):
+    """Drop the collections of all but the newest `keep` inactive versions"""
+    active = await get_active_version(database)
+    versions = await database.content_versions.find(
+        {"_id": {"$nin": [POINTER_ID, active]}, "status": {"$ne": "dropped"}}
+    ).sort("created_at", -1).to_list(None)
+
+    dropped = []
+    for entry in versions[keep:]:
+        for name in CONTENT_COLLECTIONS:
+            await database.drop_collection(collection_name(name, entry["_id"]))
+        await database.content_versions.update_one({"_id": entry["_id"]}, {"$set": {"status": "dropped"}})
+        dropped.append(entry["_id"])
+    return dropped
+
+
+async def main(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    database = client[os.environ.get('DB_NAME', 'ailo_db')]
+    try:
+        if args.command == "list":
+            active = await get_active_version(database)
+            async for entry in database.content_versions.find({"_id": {"$ne": POINTER_ID}}).sort("created_at", -1):
+                marker = "▶" if entry["_id"] == active else " "
+                print(f"{marker} {entry['_id']}  {entry['status']:<8} {entry.get('note') or ''}")
+        elif args.command == "activate":
+            print(f"✅ Active content version: {await activate_version(database, args.version)}")
+        elif args.command == "rollback":
+            print(f"✅ Rolled back to: {await rollback(database)}")
+        elif args.command == "prune":
+            dropped = await prune_versions(database, args.keep)
+            print(f"🗑️  Dropped {len(dropped)} versions: {', '.join(dropped) or '-'}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage published content versions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list")
+    activate_parser = subparsers.add_parser("activate")
+    activate_parser.add_argument("version")
+    subparsers.add_parser("rollback")
+    prune_parser = subparsers.add_parser("prune")
+    prune_parser.add_argument("--keep", type=int, default=3)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,214 @@
+"""
+Distractor mining from the existing answer corpus
+
+For every question, the wrong options are the correct answers of the most
+similar questions in other subtopics of the same chapter. Similarity is cosine
+over sparse TF-IDF vectors, accumulated from shared-term postings in bounded
+blocks of questions.
+
+Ingestion calls mine_distractors() directly. Run this module to re-mine the
+questions of the active content version and publish the result:
+    python distractors.py [--dry-run]
+"""
+import argparse
+import asyncio
+import os
+import re
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from has have how in is it its of on or
+that the their them they this to was we what when where which who why will with you your
+""".split())
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall((text or "").lower()) if token not in STOPWORDS]
+
+
+def normalize_answer(text):
+    return " ".join((text or "").lower().split())
+
+
+def tfidf_vectors(documents):
+    """Sparse L2-normalized TF-IDF rows for a list of token lists.
+
+    Returns (rows, terms, weights) arrays with one entry per distinct token of a
+    row, sorted by row.
+    """
+    vocabulary = {}
+    rows, terms = [], []
+    for row, tokens in enumerate(documents):
+        for token in tokens:
+            rows.append(row)
+            terms.append(vocabulary.setdefault(token, len(vocabulary)))
+
+    # Repeated tokens of a row collapse into one (row, term) entry with a count
+    width = max(len(vocabulary), 1)
+    cells, counts = np.unique(np.asarray(rows, dtype=np.intp) * width + np.asarray(terms, dtype=np.intp), return_counts=True)
+    rows, terms = np.divmod(cells, width)
+
+    document_frequency = np.bincount(terms, minlength=width)
+    idf = np.log((1 + len(documents)) / (1 + document_frequency)) + 1
+    weights = np.log1p(counts) * idf[terms]
+    norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=len(documents)))
+    return rows, terms, (weights / np.where(norms == 0, 1, norms)[rows]).astype(np.float32)
+
+
+def cosine_blocks(queries, candidates, query_count, candidate_count, max_rows=512, max_pairs=2_000_000):
+    """Yield (first row, dense block) of query-by-candidate cosine similarity.
+
+    Both inputs are tfidf_vectors() entries over one vocabulary. Only terms a
+    query shares with a candidate are multiplied, found through the candidates'
+    term postings, and blocks of query rows are bounded both in rows and in
+    multiplied pairs, so memory stays flat however large the chapter is.
+    """
+    query_rows, query_terms, query_weights = queries
+    order = np.argsort(candidates[1], kind="stable")
+    candidate_rows, candidate_terms, candidate_weights = (array[order] for array in candidates)
+
+    # Postings range of every query entry's term among the candidate entries
+    starts = np.searchsorted(candidate_terms, query_terms, side="left")
+    lengths = np.searchsorted(candidate_terms, query_terms, side="right") - starts
+    row_pairs = np.bincount(query_rows, weights=lengths, minlength=query_count)
+    row_entries = np.searchsorted(query_rows, np.arange(query_count + 1))
+
+    first = 0
+    while first < query_count:
+        last, pairs = first, 0
+        while last < query_count and last - first < max_rows and (last == first or pairs + row_pairs[last] <= max_pairs):
+            pairs += row_pairs[last]
+            last += 1
+
+        entries = np.arange(row_entries[first], row_entries[last])
+        spans = lengths[entries]
+        entry = np.repeat(entries, spans)
+        posting = starts[entry] + np.arange(len(entry)) - np.repeat(np.cumsum(spans) - spans, spans)
+        cells = (query_rows[entry] - first) * candidate_count + candidate_rows[posting]
+        block = np.bincount(
+            cells,
+            weights=query_weights[entry] * candidate_weights[posting],
+            minlength=(last - first) * candidate_count
+        )
+        yield first, block.reshape(last - first, candidate_count)
+        first = last
+
+
+def mine_chapter(questions, k, fallback):
+    """Distractor lists for questions of a single chapter, in input order"""
+    # One candidate per distinct answer text, remembering which subtopics use it
+    answer_index, answers, answer_subtopics = {}, [], []
+    for question in questions:
+        key = normalize_answer(question["correct_answer"])
+        if key not in answer_index:
+            answer_index[key] = len(answers)
+            answers.append(question["correct_answer"])
+            answer_subtopics.append(set())
+        answer_subtopics[answer_index[key]].add(question.get("subtopic_id"))
+
+    subtopic_index = {s: i for i, s in enumerate({q.get("subtopic_id") for q in questions})}
+    question_subtopic = np.array([subtopic_index[q.get("subtopic_id")] for q in questions], dtype=np.intp)
+    own_answer = np.array([answer_index[normalize_answer(q["correct_answer"])] for q in questions], dtype=np.intp)
+
+    in_subtopic = np.zeros((len(subtopic_index), len(answers)), dtype=bool)
+    for column, subtopics in enumerate(answer_subtopics):
+        in_subtopic[[subtopic_index[s] for s in subtopics], column] = True
+
+    # Fit one vocabulary on questions + answers so both live in the same space
+    rows, terms, weights = tfidf_vectors(
+        [tokenize(f"{q['question_text']} {q['correct_answer']}") for q in questions] +
+        [tokenize(answer) for answer in answers]
+    )
+    is_question = rows < len(questions)
+    queries = (rows[is_question], terms[is_question], weights[is_question])
+    candidates = (rows[~is_question] - len(questions), terms[~is_question], weights[~is_question])
+
+    take = min(k, max(len(answers) - 1, 0))
+    top = np.zeros((len(questions), take), dtype=np.intp)
+    if take:
+        for first, similarity in cosine_blocks(queries, candidates, len(questions), len(answers)):
+            block_rows = np.arange(len(similarity))
+            # Answers from other subtopics rank first, same-subtopic answers are a last
+            # resort, and a question's own answer is never offered
+            similarity -= 2.0 * in_subtopic[question_subtopic[first:first + len(similarity)]]
+            similarity[block_rows, own_answer[first:first + len(similarity)]] = -np.inf
+
+            block_top = np.argpartition(-similarity, take - 1, axis=1)[:, :take]
+            order = np.argsort(-np.take_along_axis(similarity, block_top, axis=1), axis=1)
+            top[first:first + len(similarity)] = np.take_along_axis(block_top, order, axis=1)
+
+    mined = []
+    for question, columns in zip(questions, top):
+        own = normalize_answer(question["correct_answer"])
+        picks = [answers[c] for c in columns]
+        picks += [f for f in fallback if normalize_answer(f) != own and f not in picks][:k - len(picks)]
+        mined.append(picks)
+    return mined
+
+
+def mine_distractors(questions, k=3, fallback=()):
+    """Return k distractors for every question (in input order).
+
+    Questions need question_text, correct_answer, chapter_id and subtopic_id.
+    Chapters with too few distinct answers are padded from `fallback`.
+    """
+    by_chapter = defaultdict(list)
+    for position, question in enumerate(questions):
+        by_chapter[question.get("chapter_id")].append(position)
+
+    mined = [None] * len(questions)
+    for positions in by_chapter.values():
+        chapter_questions = [questions[p] for p in positions]
+        for position, distractors in zip(positions, mine_chapter(chapter_questions, k, fallback)):
+            mined[position] = distractors
+    return mined
+
+
+async def main(args):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from content_versions import ContentNamespace, get_active_version, publish
+    from ingest_content import PLACEHOLDER_DISTRACTORS, ContentBuilder, upsert_changed
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    database = client[os.environ.get('DB_NAME', 'ailo_db')]
+    try:
+        active = ContentNamespace(database, await get_active_version(database))
+        questions = await active.quiz_questions.find({}, {"_id": 0, "content_hash": 0}).to_list(None)
+
+        started = time.perf_counter()
+        mined = mine_distractors(questions, fallback=PLACEHOLDER_DISTRACTORS)
+        # LLM-generated questions keep their own distractors; they only feed the pool
+        updated = []
+        for question, distractors in zip(questions, mined):
+            if not question.get("generated_by"):
+                ContentBuilder.set_options(question, distractors)
+                updated.append(question)
+        print(f"✅ Mined distractors for {len(updated)} questions in {time.perf_counter() - started:.3f}s")
+
+        if args.dry_run or not updated:
+            return
+
+        async def build(draft):
+            written, unchanged = await upsert_changed(draft, "quiz_questions", "question_id", updated)
+            print(f"   - quiz_questions: {written} written, {unchanged} unchanged")
+
+        version = await publish(database, build, note="mined distractors")
+        print(f"🚀 Published content version {version}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-mine distractors for the active content version")
+    parser.add_argument("--dry-run", action="store_true", help="mine without publishing")
+    asyncio.run(main(parser.parse_args()))
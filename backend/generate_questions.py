@@ -0,0 +1,243 @@
+"""
+Generate quiz questions (with real distractors) for every microcontent card
+
+Runs offline against the active content version: each card is sent to an
+OpenAI-compatible chat endpoint with bounded concurrency and retried with
+exponential backoff. Results are cached by a hash of the card text, model and
+prompt, so unchanged cards are never regenerated. The generated questions are
+published as a new content version.
+
+Point OPENAI_BASE_URL at any OpenAI-compatible server (e.g. a local stub) to
+run without the real API.
+
+Usage:
+    python generate_questions.py [--concurrency 16] [--model gpt-4o-mini] [--limit 100] [--dry-run]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from pathlib import Path
+
+import openai
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from content_versions import ContentNamespace, get_active_version, publish
+from ingest_content import ContentBuilder, chunked, stable_id, upsert_changed
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+PROMPT_VERSION = "mcq-v1"
+DIFFICULTIES = {"easy", "medium", "hard"}
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+SYSTEM_PROMPT = """You write multiple-choice questions for high-school students.
+Given a short learning card, reply with a JSON object:
+{"question_text": "...", "correct_answer": "...", "distractors": ["...", "...", "..."],
+ "explanation": "...", "difficulty": "easy|medium|hard"}
+The distractors must be plausible, clearly wrong, distinct from each other and
+from the correct answer, and about the same length as the correct answer."""
+
+
+class InvalidGeneration(ValueError):
+    pass
+
+
+def card_prompt(card):
+    parts = [f"Card: {card['microcontent_text']}"]
+    if card.get("qa_pair"):
+        parts.append(f"Reference Q&A: {card['qa_pair']}")
+    return "\n".join(parts)
+
+
+def cache_key(card, model):
+    payload = json.dumps([PROMPT_VERSION, model, SYSTEM_PROMPT, card_prompt(card)])
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def parse_generation(text):
+    """Validate the model's JSON reply and return it normalized"""
+    try:
+        data = json.loads(text)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise InvalidGeneration(f"reply is not JSON: {e}")
+
+    question_text = str(data.get("question_text") or "").strip()
+    correct_answer = str(data.get("correct_answer") or "").strip()
+    distractors = [str(d).strip() for d in data.get("distractors") or [] if str(d).strip()]
+    distractors = list(dict.fromkeys(d for d in distractors if d != correct_answer))[:3]
+
+    if not question_text or not correct_answer:
+        raise InvalidGeneration("question_text and correct_answer are required")
+    if len(distractors) < 3:
+        raise InvalidGeneration("need three distinct distractors")
+
+    difficulty = data.get("difficulty")
+    return {
+        "question_text": question_text,
+        "correct_answer": correct_answer,
+        "distractors": distractors,
+        "explanation": str(data.get("explanation") or "").strip(),
+        "difficulty": difficulty if difficulty in DIFFICULTIES else "medium",
+    }
+
+
+class QuestionGenerator:
+    """Bounded-concurrency generation with retries and a persistent result cache"""
+
+    def __init__(self, database, model, concurrency=16, max_retries=5, timeout=60):
+        self.database = database
+        self.model = model
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_retries = max_retries
+        self.llm = openai.AsyncOpenAI(
+            api_key=os.environ.get('OPENAI_API_KEY') or "not-needed",
+            base_url=os.environ.get('OPENAI_BASE_URL') or None,
+            timeout=timeout,
+            max_retries=0,  # retried below with our own backoff
+        )
+        self.stats = {"generated": 0, "cached": 0, "failed": 0, "retries": 0}
+
+    async def load_cache(self, keys):
+        cursor = self.database.question_generation_cache.find({"_id": {"$in": list(keys)}})
+        return {doc["_id"]: doc["result"] async for doc in cursor}
+
+    async def complete(self, card):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    response = await self.llm.chat.completions.create(
+                        model=self.model,
+                        messages=[
+                            {"role": "system", "content": SYSTEM_PROMPT},
+                            {"role": "user", "content": card_prompt(card)},
+                        ],
+                        response_format={"type": "json_object"},
+                        temperature=0.4,
+                        max_tokens=400,
+                    )
+                return parse_generation(response.choices[0].message.content)
+            except (InvalidGeneration, *RETRYABLE_ERRORS) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.stats["retries"] += 1
+                # Exponential backoff with full jitter, capped at 30s
+                delay = random.uniform(0, min(30, 2 ** attempt))
+                print(f"   ↻ {card['microcontent_id']}: {type(e).__name__}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def generate_one(self, card, key, cached):
+        if key in cached:
+            self.stats["cached"] += 1
+            return cached[key]
+        try:
+            result = await self.complete(card)
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"   ✗ {card['microcontent_id']}: {e}")
+            return None
+        self.stats["generated"] += 1
+        return result
+
+    async def generate(self, cards, chunk_size=200):
+        """Yield (card, result) for every card; result is None when generation failed"""
+        for chunk in chunked(cards, chunk_size):
+            keys = [cache_key(card, self.model) for card in chunk]
+            cached = await self.load_cache(keys)
+            results = await asyncio.gather(*(
+                self.generate_one(card, key, cached) for card, key in zip(chunk, keys)
+            ))
+
+            fresh = [
+                UpdateOne({"_id": key}, {"$set": {"result": result, "model": self.model}}, upsert=True)
+                for key, result in zip(keys, results)
+                if result is not None and key not in cached
+            ]
+            if fresh:
+                await self.database.question_generation_cache.bulk_write(fresh, ordered=False)
+
+            for card, result in zip(chunk, results):
+                yield card, result
+
+
+def question_document(card, result):
+    question = {
+        # Same id as the sheet-derived question, so the generated one replaces it
+        "question_id": stable_id("question", card["microcontent_id"]),
+        "subtopic_id": card["subtopic_id"],
+        "topic_id": card["topic_id"],
+        "chapter_id": card["chapter_id"],
+        "microcontent_id": card["microcontent_id"],
+        "question_text": result["question_text"],
+        "correct_answer": result["correct_answer"],
+        "difficulty": result["difficulty"],
+        "explanation": result["explanation"] or (card.get("microcontent_text") or "")[:200],
+        "generated_by": PROMPT_VERSION,
+    }
+    ContentBuilder.set_options(question, result["distractors"])
+    return question
+
+
+async def run(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    database = client[os.environ.get('DB_NAME', 'ailo_db')]
+    started = time.perf_counter()
+    try:
+        active = ContentNamespace(database, await get_active_version(database))
+        projection = {"_id": 0, "microcontent_id": 1, "subtopic_id": 1, "topic_id": 1,
+                      "chapter_id": 1, "microcontent_text": 1, "qa_pair": 1}
+        cursor = active.microcontent.find({"microcontent_text": {"$nin": [None, ""]}}, projection)
+        if args.limit:
+            cursor = cursor.limit(args.limit)
+        cards = await cursor.to_list(None)
+        print(f"🧠 Generating questions for {len(cards)} cards with {args.model} "
+              f"(concurrency {args.concurrency})...")
+
+        generator = QuestionGenerator(database, args.model, args.concurrency, args.max_retries)
+        questions = [
+            question_document(card, result)
+            async for card, result in generator.generate(cards)
+            if result is not None
+        ]
+
+        stats = generator.stats
+        print(f"✅ {stats['generated']} generated, {stats['cached']} cached, "
+              f"{stats['failed']} failed, {stats['retries']} retries "
+              f"in {time.perf_counter() - started:.1f}s")
+
+        if args.dry_run or not questions:
+            return
+
+        async def build(draft):
+            written, unchanged = 0, 0
+            for chunk in chunked(questions, 500):
+                chunk_written, chunk_unchanged = await upsert_changed(draft, "quiz_questions", "question_id", chunk)
+                written += chunk_written
+                unchanged += chunk_unchanged
+            print(f"   - quiz_questions: {written} written, {unchanged} unchanged")
+
+        version = await publish(database, build, note=f"generated questions ({args.model})")
+        print(f"🚀 Published content version {version}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate quiz questions for microcontent cards with an LLM")
+    parser.add_argument("--model", default=os.environ.get('QUESTION_MODEL', 'gpt-4o-mini'))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--limit", type=int, help="only generate for the first N cards")
+    parser.add_argument("--dry-run", action="store_true", help="generate (and cache) without publishing")
+    asyncio.run(run(parser.parse_args()))
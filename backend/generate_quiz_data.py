@@ -1,13 +1,23 @@
 """
-Generate quiz questions for Practice Tab using GPT
+Load the quiz question bank for the Practice Tab
+
+The built-in bank below (plus any --bank JSON files) is validated in memory and
+upserted in chunks with deterministic ids; reloading is idempotent. LLM-generated
+questions for the Learn tab come from generate_questions.py.
+
+Usage:
+    python generate_quiz_data.py [--bank extra_bank.json ...] [--chunk-size 500]
 """
+import argparse
 import asyncio
+import json
+import time
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateMany
 from dotenv import load_dotenv
 import os
 from pathlib import Path
-import uuid
-from datetime import datetime
+from ingest_content import stable_id, chunked, upsert_changed
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -431,61 +441,152 @@ quiz_questions_data = [
     }
 ]
 
-async def populate_quiz_questions():
-    """Populate the database with quiz questions"""
-    print("🎯 Populating quiz questions for Practice Tab...")
-    
-    # Clear existing quiz questions
-    await db.practice_questions.delete_many({})
-    await db.chapter_quizzes.delete_many({})
-    
-    total_questions = 0
-    
-    for chapter_data in quiz_questions_data:
-        chapter_name = chapter_data["chapter"]
-        chapter_number = chapter_data["chapter_number"]
-        questions = chapter_data["questions"]
-        
-        # Create chapter quiz metadata
-        chapter_quiz_id = str(uuid.uuid4())
-        chapter_quiz = {
-            "quiz_id": chapter_quiz_id,
+DIFFICULTIES = {"easy", "medium", "hard"}
+QUESTION_FIELDS = ["question_text", "options", "correct_answer", "explanation", "difficulty", "topic"]
+
+
+def load_bank(path):
+    """Read an extra question bank: a JSON list of chapters shaped like quiz_questions_data"""
+    with open(path, encoding="utf-8") as f:
+        bank = json.load(f)
+    return bank["chapters"] if isinstance(bank, dict) else bank
+
+
+def validate_bank(chapters):
+    """Return a list of problems; the bank is only written when this is empty"""
+    errors = []
+    seen_chapters = set()
+    for chapter in chapters:
+        label = f"chapter {chapter.get('chapter_number')} ({chapter.get('chapter')})"
+        if not chapter.get("chapter") or not isinstance(chapter.get("chapter_number"), int):
+            errors.append(f"{label}: needs a chapter name and an integer chapter_number")
+        if chapter.get("chapter_number") in seen_chapters:
+            errors.append(f"{label}: chapter_number appears more than once")
+        seen_chapters.add(chapter.get("chapter_number"))
+
+        seen_questions = set()
+        for idx, question in enumerate(chapter.get("questions") or [], start=1):
+            missing = [field for field in QUESTION_FIELDS if not question.get(field)]
+            if missing:
+                errors.append(f"{label} question {idx}: missing {', '.join(missing)}")
+                continue
+            if question["question_text"] in seen_questions:
+                errors.append(f"{label} question {idx}: duplicate question_text")
+            seen_questions.add(question["question_text"])
+            if len(set(question["options"])) != len(question["options"]) or len(question["options"]) < 2:
+                errors.append(f"{label} question {idx}: needs at least two distinct options")
+            if question["correct_answer"] not in question["options"]:
+                errors.append(f"{label} question {idx}: correct_answer is not one of the options")
+            if question["difficulty"] not in DIFFICULTIES:
+                errors.append(f"{label} question {idx}: unknown difficulty {question['difficulty']!r}")
+        if not seen_questions:
+            errors.append(f"{label}: has no questions")
+    return errors
+
+
+def build_bank(chapters):
+    """Turn chapters into chapter_quizzes and practice_questions documents.
+
+    Ids are derived from the chapter number and question text, so reloading the
+    same bank updates documents in place instead of replacing them.
+    """
+    quizzes, questions = [], []
+    for chapter in chapters:
+        chapter_name = chapter["chapter"]
+        chapter_number = chapter["chapter_number"]
+        quiz_id = stable_id("chapter_quiz", chapter_number)
+
+        quizzes.append({
+            "quiz_id": quiz_id,
             "chapter_name": chapter_name,
             "chapter_number": chapter_number,
-            "total_questions": len(questions),
-            "time_limit": len(questions) * 60,  # 1 min per question
-            "xp_reward": len(questions) * 10,
+            "total_questions": len(chapter["questions"]),
+            "time_limit": len(chapter["questions"]) * 60,  # 1 min per question
+            "xp_reward": len(chapter["questions"]) * 10,
             "difficulty": "mixed",
-            "type": "chapter",
-            "created_at": datetime.utcnow()
-        }
-        await db.chapter_quizzes.insert_one(chapter_quiz)
-        
-        # Insert questions
-        for idx, q_data in enumerate(questions):
-            question = {
-                "question_id": str(uuid.uuid4()),
-                "quiz_id": chapter_quiz_id,
+            "type": "chapter"
+        })
+
+        for idx, q_data in enumerate(chapter["questions"]):
+            questions.append({
+                "question_id": stable_id("practice_question", chapter_number, q_data["question_text"]),
+                "quiz_id": quiz_id,
                 "chapter_name": chapter_name,
                 "chapter_number": chapter_number,
-                "question_text": q_data["question_text"],
-                "options": q_data["options"],
-                "correct_answer": q_data["correct_answer"],
-                "explanation": q_data["explanation"],
-                "difficulty": q_data["difficulty"],
-                "topic": q_data["topic"],
-                "order": idx + 1,
-                "created_at": datetime.utcnow()
-            }
-            await db.practice_questions.insert_one(question)
-            total_questions += 1
-        
-        print(f"✅ Added {len(questions)} questions for: {chapter_name}")
+                **{field: q_data[field] for field in QUESTION_FIELDS},
+                "order": idx + 1
+            })
+    return quizzes, questions
+
+
+async def write_bank(database, quizzes, questions, chunk_size=500):
+    """Upsert the bank in chunks, then drop quizzes and questions no longer in it.
+
+    Stale documents are removed only after the new ones are written, so the
+    Practice tab never sees an empty bank. Attempts at a replaced quiz are moved
+    to the new quiz of the same chapter first, so best scores carry over.
+    """
+    await database.chapter_quizzes.create_index("quiz_id", unique=True)
+    await database.practice_questions.create_index("question_id", unique=True)
+    await database.practice_questions.create_index([("quiz_id", 1), ("order", 1)])
+
+    banks = [("chapter_quizzes", "quiz_id", quizzes), ("practice_questions", "question_id", questions)]
+    stats = {}
+    for collection, id_field, docs in banks:
+        written = unchanged = 0
+        for chunk in chunked(docs, chunk_size):
+            chunk_written, chunk_unchanged = await upsert_changed(database, collection, id_field, chunk)
+            written += chunk_written
+            unchanged += chunk_unchanged
+        stats[collection] = {"written": written, "unchanged": unchanged}
+
+    quiz_ids = {quiz["chapter_number"]: quiz["quiz_id"] for quiz in quizzes}
+    replaced = database.chapter_quizzes.find({"quiz_id": {"$nin": list(quiz_ids.values())}}, {"quiz_id": 1, "chapter_number": 1})
+    moves = [
+        UpdateMany({"quiz_id": quiz["quiz_id"]}, {"$set": {"quiz_id": quiz_ids[quiz["chapter_number"]]}})
+        async for quiz in replaced
+        if quiz.get("chapter_number") in quiz_ids
+    ]
+    migrated = (await database.quiz_attempts.bulk_write(moves, ordered=False)).modified_count if moves else 0
+    stats["quiz_attempts"] = {"migrated": migrated}
+
+    for collection, id_field, docs in banks:
+        removed = await database[collection].delete_many({id_field: {"$nin": [doc[id_field] for doc in docs]}})
+        stats[collection]["removed"] = removed.deleted_count
+    return stats
+
+
+async def populate_quiz_questions(bank_paths=(), chunk_size=500):
+    """Populate the database with quiz questions"""
+    print("🎯 Populating quiz questions for Practice Tab...")
+    
+    chapters = list(quiz_questions_data)
+    for path in bank_paths:
+        chapters.extend(load_bank(path))
+    
+    errors = validate_bank(chapters)
+    if errors:
+        for error in errors:
+            print(f"❌ {error}")
+        raise SystemExit(f"Question bank is invalid ({len(errors)} problems), nothing was written")
     
-    print(f"\n🎉 Successfully added {total_questions} quiz questions!")
-    print(f"📚 Chapters: {len(quiz_questions_data)}")
+    started = time.perf_counter()
+    quizzes, questions = build_bank(chapters)
+    try:
+        stats = await write_bank(db, quizzes, questions, chunk_size)
+    finally:
+        client.close()
     
-    client.close()
+    attempts = stats.pop("quiz_attempts")
+    for collection, counts in stats.items():
+        print(f"   - {collection}: {counts['written']} written, {counts['unchanged']} unchanged, {counts['removed']} removed")
+    print(f"   - quiz_attempts: {attempts['migrated']} moved to reloaded quizzes")
+    print(f"\n🎉 Loaded {len(questions)} quiz questions in {time.perf_counter() - started:.2f}s!")
+    print(f"📚 Chapters: {len(quizzes)}")
 
 if __name__ == "__main__":
-    asyncio.run(populate_quiz_questions())
+    parser = argparse.ArgumentParser(description="Load the Practice tab question bank")
+    parser.add_argument("--bank", action="append", default=[], help="extra JSON question bank to load (repeatable)")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(populate_quiz_questions(args.bank, args.chunk_size))
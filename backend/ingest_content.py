@@ -0,0 +1,440 @@
+"""
+Bulk, idempotent content ingestion from CSV/XLSX syllabus sheets
+
+Rows are streamed in chunks and every document gets an id derived from the
+sheet (chapter name, topic number, subtopic title or Subtopic_ID,
+Microcontent_ID), so re-ingesting or reordering rows keeps student progress
+attached to the same content. Rewording a topic title keeps its id; rewording
+a subtopic title does too when the sheet has a Subtopic_ID column. Only
+documents whose content changed are written, with one bulk_write per chunk and
+collection.
+
+Rows always go into a new content version (a copy of the active one), so
+students never read a half-written ingest. By default it is left as a draft
+to review and activate with content_versions.py; with --publish it is
+validated and switched live atomically.
+
+Usage:
+    python ingest_content.py syllabus.xlsx [--sheet Sheet1] [--chunk-size 500] [--prune] [--dry-run] [--publish]
+    python ingest_content.py syllabus.csv
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+from itertools import islice
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from content_versions import ContentNamespace, create_version, get_active_version, publish
+from distractors import mine_distractors
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+# Fixed namespace so the same sheet row always maps to the same ids
+ID_NAMESPACE = uuid.UUID("6b1d3c2e-4a8f-5d7b-9c0e-a1f2b3c4d5e6")
+
+COLUMNS = [
+    "Chapter_Name", "Topic_Number", "Topic_Title", "Subtopic_ID", "Subtopic_Title", "Subtopic_Name",
+    "Microcontent_ID", "Microcontent_Text", "Content_Type", "Related_Code_or_Image_Ref",
+    "Exercises_Ref", "Activities_Ref", "Analogy_Explanation", "Story_Explanation", "QA_Pair",
+]
+
+# Only used when a chapter has too few distinct answers to mine from
+PLACEHOLDER_DISTRACTORS = [
+    "This is a distractor option",
+    "Another incorrect option",
+    "Yet another wrong answer"
+]
+
+# Collection -> id field, in the order documents reference each other
+CONTENT_COLLECTIONS = [
+    ("chapters", "chapter_id"),
+    ("topics", "topic_id"),
+    ("subtopics", "subtopic_id"),
+    ("microcontent", "microcontent_id"),
+    ("quiz_questions", "question_id"),
+]
+
+
+def stable_id(kind, *parts):
+    return str(uuid.uuid5(ID_NAMESPACE, "|".join([kind, *(str(p) for p in parts)])))
+
+
+def content_hash(doc):
+    return hashlib.sha1(json.dumps(doc, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def normalize_row(row):
+    """Trim cells and turn blanks into None; numbers like topic 1.1 become strings"""
+    normalized = {}
+    for column in COLUMNS:
+        value = row.get(column)
+        if isinstance(value, float) and value.is_integer() and column != "Topic_Number":
+            value = int(value)
+        if value is not None and not isinstance(value, str):
+            value = str(value)
+        value = value.strip() if value is not None else None
+        normalized[column] = value or None
+    return normalized
+
+
+def iter_csv_rows(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            yield normalize_row(row)
+
+
+def iter_xlsx_rows(path, sheet=None):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise SystemExit("Reading .xlsx files requires openpyxl: pip install openpyxl")
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.active
+        rows = worksheet.iter_rows(values_only=True)
+        header = [str(cell).strip() if cell is not None else "" for cell in next(rows)]
+        for values in rows:
+            if any(v is not None for v in values):
+                yield normalize_row(dict(zip(header, values)))
+    finally:
+        workbook.close()
+
+
+def iter_rows(path, sheet=None):
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return iter_csv_rows(path)
+    if suffix in (".xlsx", ".xlsm"):
+        return iter_xlsx_rows(path, sheet)
+    raise SystemExit(f"Unsupported file type: {suffix} (expected .csv or .xlsx)")
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def parse_qa_pair(qa_pair):
+    """Split 'Q: ... A: ...' into (question, answer), or None"""
+    if not qa_pair:
+        return None
+    qa_parts = qa_pair.split("A:")
+    if len(qa_parts) != 2:
+        return None
+    return qa_parts[0].replace("Q:", "").strip(), qa_parts[1].strip()
+
+
+def topic_order(topic_number, fallback):
+    # "1.1.2" -> 1.0102, "1.1" -> 1.01
+    try:
+        return sum(float(part) / (100 ** idx) for idx, part in enumerate(topic_number.split('.'))) if topic_number else 0
+    except ValueError:
+        return fallback
+
+
+def microcontent_order(microcontent_id, fallback):
+    # "1.1.2_MC3" -> 3; ids without a numeric _MC suffix keep their row order
+    match = re.search(r"_MC(\d+)$", microcontent_id)
+    return int(match.group(1)) if match else fallback
+
+
+def subtopic_title_key(subtopic_title):
+    # Case and spacing edits keep the id; an empty title is the topic's own subtopic
+    return " ".join(subtopic_title.lower().split()) if subtopic_title else ""
+
+
+def chapter_order(chapter_name, fallback):
+    match = re.match(r"\s*Unit\s+(\d+)", chapter_name)
+    return int(match.group(1)) if match else fallback
+
+
+class ContentBuilder:
+    """Turns sheet rows into chapter/topic/subtopic/microcontent/question documents"""
+
+    def __init__(self):
+        self.chapters = {}
+        self.topics = {}
+        self.subtopics = {}
+        self._subtopic_positions = {}
+
+    def add_row(self, row):
+        """Register a row's hierarchy and return its (microcontent, question) documents"""
+        chapter_name = row["Chapter_Name"]
+        topic_number = row["Topic_Number"]
+        topic_title = row["Topic_Title"]
+
+        chapter_id = stable_id("chapter", chapter_name)
+        if chapter_id not in self.chapters:
+            self.chapters[chapter_id] = {
+                "chapter_id": chapter_id,
+                "chapter_name": chapter_name,
+                "title": chapter_name,
+                "description": f"Learn about {chapter_name}",
+                "order": chapter_order(chapter_name, len(self.chapters) + 1),
+                "locked": False,
+            }
+
+        # Titles get reworded between sheet revisions, so only numbers go into the ids
+        topic_id = stable_id("topic", chapter_name, topic_number or topic_title)
+        if topic_id not in self.topics:
+            self.topics[topic_id] = {
+                "topic_id": topic_id,
+                "chapter_id": chapter_id,
+                "topic_number": topic_number,
+                "topic_title": topic_title,
+                "title": topic_title,
+                "description": f"Explore {topic_title}",
+                "order": topic_order(topic_number, len(self.topics) + 1),
+            }
+
+        # Rows without a subtopic use the topic itself as their subtopic. A topic holds
+        # several subtopics, so they are told apart by an explicit Subtopic_ID when the
+        # sheet has one, else by title; row positions would shift on every insertion
+        subtopic_title = row["Subtopic_Title"] or topic_title
+        subtopic_key = row["Subtopic_ID"] or subtopic_title_key(row["Subtopic_Title"])
+        subtopic_id = stable_id("subtopic", chapter_name, topic_number or topic_title, subtopic_key)
+        positions = self._subtopic_positions.setdefault(topic_id, {})
+        subtopic_position = positions.setdefault(subtopic_id, len(positions) + 1)
+        if subtopic_id not in self.subtopics:
+            self.subtopics[subtopic_id] = {
+                "subtopic_id": subtopic_id,
+                "topic_id": topic_id,
+                "chapter_id": chapter_id,
+                "subtopic_title": subtopic_title,
+                "subtopic_name": row["Subtopic_Name"],
+                "title": subtopic_title,
+                "order": subtopic_position,
+                "microcontent_count": 0,
+            }
+        self.subtopics[subtopic_id]["microcontent_count"] += 1
+
+        microcontent_id = row["Microcontent_ID"]
+        microcontent = {
+            "microcontent_id": microcontent_id,
+            "subtopic_id": subtopic_id,
+            "topic_id": topic_id,
+            "chapter_id": chapter_id,
+            "microcontent_text": row["Microcontent_Text"],
+            "content_type": row["Content_Type"] or "text",
+            "story_explanation": row["Story_Explanation"],
+            "analogy_explanation": row["Analogy_Explanation"],
+            "core_text": row["Microcontent_Text"],  # Why mode
+            "related_code": row["Related_Code_or_Image_Ref"],
+            "qa_pair": row["QA_Pair"],
+            "order": microcontent_order(microcontent_id, self.subtopics[subtopic_id]["microcontent_count"]),
+        }
+
+        question = None
+        qa = parse_qa_pair(row["QA_Pair"])
+        if qa:
+            question_text, correct_answer = qa
+            question = {
+                "question_id": stable_id("question", microcontent_id),
+                "subtopic_id": subtopic_id,
+                "topic_id": topic_id,
+                "chapter_id": chapter_id,
+                "question_text": question_text,
+                "correct_answer": correct_answer,
+                "difficulty": "medium",
+                "explanation": (row["Microcontent_Text"] or "")[:200],
+            }
+
+        return microcontent, question
+
+    @staticmethod
+    def assign_distractors(questions):
+        """Give every question mined distractors; needs the whole batch of questions"""
+        for question, distractors in zip(questions, mine_distractors(questions, fallback=PLACEHOLDER_DISTRACTORS)):
+            ContentBuilder.set_options(question, distractors)
+
+    @staticmethod
+    def set_options(question, distractors):
+        """Shuffle the options deterministically so unchanged rows hash the same"""
+        options = [question["correct_answer"]] + list(distractors)
+        random.Random(question["question_id"]).shuffle(options)
+        question["options"] = options
+        question["correct_index"] = options.index(question["correct_answer"])
+
+
+async def upsert_changed(database, collection, id_field, docs, dry_run=False):
+    """Write only the documents whose content hash differs from what is stored.
+
+    Returns (written, unchanged).
+    """
+    if not docs:
+        return 0, 0
+
+    hashes = {doc[id_field]: content_hash(doc) for doc in docs}
+    existing = database[collection].find({id_field: {"$in": list(hashes)}}, {id_field: 1, "content_hash": 1})
+    stored = {doc[id_field]: doc.get("content_hash") async for doc in existing}
+
+    ops = [
+        UpdateOne({id_field: doc[id_field]}, {"$set": {**doc, "content_hash": hashes[doc[id_field]]}}, upsert=True)
+        for doc in docs
+        if stored.get(doc[id_field]) != hashes[doc[id_field]]
+    ]
+    if ops and not dry_run:
+        await database[collection].bulk_write(ops, ordered=False)
+    return len(ops), len(docs) - len(ops)
+
+
+async def skip_generated(database, questions):
+    """Drop questions stored with generated_by; those replaced the sheet-built ones and stay.
+
+    Returns (questions to write, number skipped).
+    """
+    ids = [question["question_id"] for question in questions]
+    generated = set(await database.quiz_questions.distinct(
+        "question_id", {"question_id": {"$in": ids}, "generated_by": {"$exists": True}}
+    ))
+    return [question for question in questions if question["question_id"] not in generated], len(generated)
+
+
+async def prune_missing(database, chapter_ids, seen_ids, dry_run=False):
+    """Delete content of the ingested chapters that is no longer in the sheet"""
+    removed = {}
+    for collection, id_field in CONTENT_COLLECTIONS:
+        query = {"chapter_id": {"$in": list(chapter_ids)}, id_field: {"$nin": list(seen_ids[collection])}}
+        if dry_run:
+            removed[collection] = await database[collection].count_documents(query)
+        else:
+            removed[collection] = (await database[collection].delete_many(query)).deleted_count
+    return removed
+
+
+async def ingest_rows(database, rows, chunk_size=500, prune=False, dry_run=False):
+    """Ingest an iterable of sheet rows into `database` and return statistics"""
+    started = time.perf_counter()
+    builder = ContentBuilder()
+    stats = {collection: {"written": 0, "unchanged": 0} for collection, _ in CONTENT_COLLECTIONS}
+    seen_ids = {collection: set() for collection, _ in CONTENT_COLLECTIONS}
+    row_count = 0
+    questions = []
+
+    for chunk in chunked(rows, chunk_size):
+        microcontent_docs = []
+        for row in chunk:
+            if not row.get("Chapter_Name") or not row.get("Microcontent_ID"):
+                continue
+            microcontent, question = builder.add_row(row)
+            microcontent_docs.append(microcontent)
+            if question:
+                questions.append(question)
+        row_count += len(chunk)
+
+        written, unchanged = await upsert_changed(database, "microcontent", "microcontent_id", microcontent_docs, dry_run)
+        stats["microcontent"]["written"] += written
+        stats["microcontent"]["unchanged"] += unchanged
+        seen_ids["microcontent"].update(doc["microcontent_id"] for doc in microcontent_docs)
+
+    # Distractors come from the other answers, so they are mined once all
+    # questions are known
+    ContentBuilder.assign_distractors(questions)
+
+    # The hierarchy is complete (and counted) only after the last row
+    final_docs = [
+        ("chapters", "chapter_id", list(builder.chapters.values())),
+        ("topics", "topic_id", list(builder.topics.values())),
+        ("subtopics", "subtopic_id", list(builder.subtopics.values())),
+    ] + [("quiz_questions", "question_id", questions[i:i + chunk_size]) for i in range(0, len(questions), chunk_size)]
+
+    stats["quiz_questions"]["generated"] = 0
+    for collection, id_field, docs in final_docs:
+        seen_ids[collection].update(doc[id_field] for doc in docs)
+        if collection == "quiz_questions":
+            docs, generated = await skip_generated(database, docs)
+            stats[collection]["generated"] += generated
+        written, unchanged = await upsert_changed(database, collection, id_field, docs, dry_run)
+        stats[collection]["written"] += written
+        stats[collection]["unchanged"] += unchanged
+
+    removed = await prune_missing(database, builder.chapters, seen_ids, dry_run) if prune else {}
+
+    elapsed = time.perf_counter() - started
+    return {
+        "rows": row_count,
+        "seconds": elapsed,
+        "rows_per_second": row_count / elapsed if elapsed > 0 else 0,
+        "collections": stats,
+        "removed": removed,
+    }
+
+
+async def publish_rows(database, rows, note=None, **options):
+    """Ingest rows into a new content version and activate it; returns (version, stats)"""
+    result = {}
+
+    async def build(draft):
+        result["stats"] = await ingest_rows(draft, rows, **options)
+
+    version = await publish(database, build, note=note)
+    return version, result["stats"]
+
+
+async def draft_rows(database, rows, note=None, **options):
+    """Ingest rows into a new draft content version without activating it; returns (version, stats)"""
+    version = await create_version(database, note=note)
+    try:
+        stats = await ingest_rows(ContentNamespace(database, version), rows, **options)
+    except Exception:
+        await database.content_versions.update_one({"_id": version}, {"$set": {"status": "failed"}})
+        raise
+    return version, stats
+
+
+def print_stats(stats):
+    print(f"✅ Ingested {stats['rows']} rows in {stats['seconds']:.2f}s "
+          f"({stats['rows_per_second']:.0f} rows/s)")
+    for collection, counts in stats["collections"].items():
+        line = f"   - {collection}: {counts['written']} written, {counts['unchanged']} unchanged"
+        if counts.get("generated"):
+            line += f", {counts['generated']} kept as LLM-generated"
+        if collection in stats["removed"]:
+            line += f", {stats['removed'][collection]} removed"
+        print(line)
+
+
+async def main(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    database = client[os.environ.get('DB_NAME', 'ailo_db')]
+    rows = iter_rows(args.path, args.sheet)
+    options = {"chunk_size": args.chunk_size, "prune": args.prune}
+    try:
+        if args.dry_run:
+            active = ContentNamespace(database, await get_active_version(database))
+            print_stats(await ingest_rows(active, rows, dry_run=True, **options))
+        elif args.publish:
+            version, stats = await publish_rows(database, rows, note=Path(args.path).name, **options)
+            print_stats(stats)
+            print(f"🚀 Published content version {version}")
+        else:
+            version, stats = await draft_rows(database, rows, note=Path(args.path).name, **options)
+            print_stats(stats)
+            print(f"📝 Wrote draft content version {version}; go live with: python content_versions.py activate {version}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest syllabus content from a CSV or XLSX file")
+    parser.add_argument("path", help="CSV or XLSX file with one microcontent row per line")
+    parser.add_argument("--sheet", help="worksheet name (XLSX only, defaults to the active sheet)")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--prune", action="store_true", help="delete content of the ingested chapters missing from the file (in the new version only)")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without writing")
+    parser.add_argument("--publish", action="store_true", help="switch to the new content version once valid instead of leaving it as a draft")
+    asyncio.run(main(parser.parse_args()))
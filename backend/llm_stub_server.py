@@ -0,0 +1,206 @@
+"""
+OpenAI-compatible stub server for offline load and latency testing
+
+Serves /v1/chat/completions (plain and streamed) with deterministic content:
+the same prompt always gets the same reply. Latency follows a log-normal
+distribution with an optional slow tail, and a share of requests can fail with
+500s or 429s, so LLM-dependent endpoints can be benchmarked under realistic
+tail latencies without calling the real API.
+
+Usage:
+    python llm_stub_server.py --port 8099 --latency-median 0.8 --latency-sigma 0.6 \\
+        --tail-rate 0.02 --tail-seconds 8 --error-rate 0.01
+    OPENAI_BASE_URL=http://localhost:8099/v1 uvicorn server:app
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+from typing import Any, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "learning practice concept example step idea model data value result pattern "
+    "question answer review skill topic lesson number function variable student "
+    "explain compare measure build test improve understand apply remember"
+).split()
+
+app = FastAPI(title="LLM stub")
+settings = argparse.Namespace(
+    latency_median=0.5, latency_sigma=0.5, tail_rate=0.0, tail_seconds=5.0,
+    error_rate=0.0, rate_limit_rate=0.0, completion_tokens=60, token_interval=0.01, seed=None,
+)
+stats = {"requests": 0, "streamed": 0, "errors": 0, "rate_limited": 0}
+rng = random.Random()
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4 if text else 0
+
+
+def sample_latency():
+    """Log-normal around the median, plus a fixed stall for the tail share"""
+    latency = settings.latency_median * math.exp(rng.gauss(0, settings.latency_sigma)) if settings.latency_median > 0 else 0.0
+    if settings.tail_rate and rng.random() < settings.tail_rate:
+        latency += settings.tail_seconds
+    return latency
+
+
+def error_response():
+    roll = rng.random()
+    if roll < settings.rate_limit_rate:
+        stats["rate_limited"] += 1
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": "1"},
+            content={"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_error", "code": "rate_limit_exceeded"}}
+        )
+    if roll < settings.rate_limit_rate + settings.error_rate:
+        stats["errors"] += 1
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"message": "Internal error (stub)", "type": "server_error", "code": None}}
+        )
+    return None
+
+
+def reply_for(messages: List[Dict[str, Any]], body: Dict[str, Any]) -> str:
+    """Deterministic reply shaped like what the caller asked for"""
+    prompt = "\n".join(str(m.get("content", "")) for m in messages)
+    seed = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12], 16)
+    words = random.Random(seed)
+    target = body.get("max_tokens") or settings.completion_tokens
+    length = max(3, min(settings.completion_tokens, target))
+
+    def sentence(n):
+        return " ".join(words.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+    if (body.get("response_format") or {}).get("type") == "json_object":
+        return json.dumps({
+            "question_text": sentence(8)[:-1] + "?",
+            "correct_answer": sentence(4),
+            "distractors": [sentence(4) for _ in range(3)],
+            "explanation": sentence(12),
+            "difficulty": words.choice(["easy", "medium", "hard"]),
+        })
+    if "json array" in prompt.lower():
+        return json.dumps([sentence(max(3, length // 9)) for _ in range(3)])
+    # ~0.75 words per token
+    return " ".join(sentence(8) for _ in range(max(1, int(length * 0.75) // 8)))
+
+
+def completion_id():
+    return f"chatcmpl-stub-{uuid.uuid4().hex[:12]}"
+
+
+async def stream_chunks(model: str, text: str, prompt_tokens: int, include_usage: bool):
+    chunk_id, created = completion_id(), int(time.time())
+
+    def chunk(delta, finish_reason=None, **extra):
+        payload = {
+            "id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+            **extra,
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    pieces = text.split(" ")
+    for i, piece in enumerate(pieces):
+        await asyncio.sleep(settings.token_interval)
+        yield chunk({"content": piece if i == 0 else " " + piece})
+    yield chunk({}, finish_reason="stop")
+    if include_usage:
+        completion_tokens = estimate_tokens(text)
+        yield chunk(None, usage={
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        })
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    messages = body.get("messages") or []
+    model = body.get("model", "stub-model")
+
+    # Time to first byte: errors and streams pay the same latency as full replies
+    await asyncio.sleep(sample_latency())
+    error = error_response()
+    if error is not None:
+        return error
+
+    text = reply_for(messages, body)
+    prompt_tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+
+    if body.get("stream"):
+        stats["streamed"] += 1
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return StreamingResponse(
+            stream_chunks(model, text, prompt_tokens, include_usage),
+            media_type="text/event-stream"
+        )
+
+    completion_tokens = estimate_tokens(text)
+    return {
+        "id": completion_id(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "stub-model", "object": "model", "owned_by": "stub"}]}
+
+
+@app.get("/stub/stats")
+async def get_stats():
+    return {**stats, "settings": vars(settings)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for offline load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-median", type=float, default=0.5, help="median seconds before the first byte")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="log-normal spread (0 = fixed latency)")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="share of requests that stall")
+    parser.add_argument("--tail-seconds", type=float, default=5.0, help="extra seconds for stalled requests")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--completion-tokens", type=int, default=60, help="approximate reply length")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument("--seed", type=int, help="seed latency and error sampling for repeatable runs")
+    args = parser.parse_args()
+
+    for key, value in vars(args).items():
+        if hasattr(settings, key):
+            setattr(settings, key, value)
+    rng.seed(args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
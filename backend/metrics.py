@@ -0,0 +1,319 @@
+"""
+Lightweight in-process metric primitives
+
+A fixed-bucket histogram is cheap enough to update on every request and can
+report approximate quantiles without keeping individual samples. The registry
+renders counters and histograms in the Prometheus text format; the ASGI
+middleware and pymongo command listener below feed it per route template,
+with Mongo commands attributed to the request that issued them through a
+context variable (motor copies the context into its executor threads).
+
+With budget checks enabled (development and tests), the middleware also
+compares each request's command count with the budget its handler declared
+through @query_budget, and reports query shapes that repeat within a request,
+the signature of a query issued inside a loop.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers fast Mongo queries through slow LLM completions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by linear interpolation inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower  # beyond the last bound, report the bound
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def cumulative(self):
+        """Yield (upper bound, cumulative count) pairs, ending with +Inf"""
+        running = 0
+        for bound, bucket_count in zip(list(self.buckets) + [float("inf")], self.counts):
+            running += bucket_count
+            yield bound, running
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "p99": round(self.quantile(0.99), 6),
+        }
+
+
+# Commands per request; the upper buckets are where N+1 handlers land
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+def escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """Thread-safe labelled counters and histograms with Prometheus text output"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Dict[str, Any]] = {}
+
+    def _family(self, name: str, kind: str, help_text: str, labels: Tuple[str, ...], buckets=None):
+        family = self._metrics.get(name)
+        if family is None:
+            family = self._metrics[name] = {
+                "kind": kind, "help": help_text, "labels": labels, "buckets": buckets, "series": {}
+            }
+        return family
+
+    def inc(self, name: str, help_text: str, labels: Dict[str, Any], amount: float = 1):
+        with self._lock:
+            family = self._family(name, "counter", help_text, tuple(labels))
+            key = tuple(labels.values())
+            family["series"][key] = family["series"].get(key, 0) + amount
+
+    def observe(self, name: str, help_text: str, labels: Dict[str, Any], value: float,
+                buckets: Sequence[float] = DEFAULT_BUCKETS):
+        with self._lock:
+            family = self._family(name, "histogram", help_text, tuple(labels), buckets)
+            key = tuple(labels.values())
+            histogram = family["series"].get(key)
+            if histogram is None:
+                histogram = family["series"][key] = Histogram(family["buckets"])
+            histogram.observe(value)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, family in sorted(self._metrics.items()):
+                lines.append(f"# HELP {name} {family['help']}")
+                lines.append(f"# TYPE {name} {family['kind']}")
+                for key, series in sorted(family["series"].items(), key=lambda item: tuple(map(str, item[0]))):
+                    if family["kind"] == "counter":
+                        lines.append(f"{name}{format_labels(family['labels'], key)} {format_value(series)}")
+                        continue
+                    for bound, count in series.cumulative():
+                        le = f'le="{format_value(bound)}"'
+                        lines.append(f"{name}_bucket{format_labels(family['labels'], key, le)} {count}")
+                    lines.append(f"{name}_sum{format_labels(family['labels'], key)} {format_value(series.sum)}")
+                    lines.append(f"{name}_count{format_labels(family['labels'], key)} {series.count}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    """Mongo activity of one HTTP request, shared with motor's executor threads"""
+
+    def __init__(self, track_shapes: bool = False):
+        self._lock = threading.Lock()
+        self.track_shapes = track_shapes
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.shapes: Dict[str, int] = {}
+
+    def record_command(self, seconds: float):
+        with self._lock:
+            self.mongo_commands += 1
+            self.mongo_seconds += seconds
+
+    def record_shape(self, shape: str):
+        with self._lock:
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def repeated_shapes(self, threshold: int) -> Dict[str, int]:
+        with self._lock:
+            return {shape: count for shape, count in self.shapes.items() if count >= threshold}
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def command_collection(event: monitoring.CommandStartedEvent) -> str:
+    value = event.command.get(event.command_name)
+    if isinstance(value, str):
+        return value
+    # getMore names its collection separately; admin commands have none
+    return event.command.get("collection", "-")
+
+
+# Driver bookkeeping that differs between otherwise identical commands
+SHAPE_IGNORED_FIELDS = {
+    "lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "readConcern",
+    "writeConcern", "cursor", "comment", "apiVersion", "documents",
+}
+
+
+def redact(value: Any) -> Any:
+    """Keep the structure of a filter or pipeline, drop its values"""
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        # $in lists of different lengths are still the same query
+        return [redact(value[0])] if value else []
+    return "?"
+
+
+def query_shape(event: monitoring.CommandStartedEvent) -> str:
+    body = {key: redact(value) for key, value in event.command.items()
+            if key not in SHAPE_IGNORED_FIELDS and key != event.command_name}
+    return f"{command_collection(event)}.{event.command_name} {json.dumps(body, sort_keys=True)}"
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+def query_budget(max_commands: int):
+    """Declare how many Mongo commands a route handler may issue per request"""
+    def decorate(endpoint):
+        endpoint.query_budget = max_commands
+        return endpoint
+    return decorate
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every Mongo command per collection and charges it to the current request"""
+
+    IGNORED = {"hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions", "buildInfo"}
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._inflight: Dict[Tuple[Any, int], Tuple[str, Optional[RequestStats]]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in self.IGNORED:
+            return
+        stats = current_request.get()
+        # Batches of one cursor are not separate queries
+        if stats is not None and stats.track_shapes and event.command_name != "getMore":
+            stats.record_shape(query_shape(event))
+        with self._lock:
+            self._inflight[(event.connection_id, event.request_id)] = (command_collection(event), stats)
+
+    def _finished(self, event, outcome: str):
+        with self._lock:
+            started = self._inflight.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        collection, stats = started
+        seconds = event.duration_micros / 1e6
+        labels = {"collection": collection, "command": event.command_name}
+        self.registry.observe("mongodb_command_duration_seconds", "Mongo command latency", labels, seconds)
+        self.registry.inc("mongodb_commands_total", "Mongo commands by outcome", {**labels, "outcome": outcome})
+        if stats is not None:
+            stats.record_command(seconds)
+
+    def succeeded(self, event):
+        self._finished(event, "ok")
+
+    def failed(self, event):
+        self._finished(event, "error")
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording latency, status and Mongo command counts per route template.
+
+    budget_mode is "off", "warn" (log) or "raise" (QueryBudgetExceeded, which
+    the test client re-raises into the failing test). Commands that background
+    tasks started by the handler issue after the response are not counted.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry, budget_mode: str = "off", repeat_threshold: int = 3):
+        self.app = app
+        self.registry = registry
+        self.budget_mode = budget_mode
+        self.repeat_threshold = repeat_threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(track_shapes=self.budget_mode != "off")
+        token = current_request.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_request.reset(token)
+            route = scope.get("route")
+            # Unmatched paths share one label so scanners cannot explode cardinality
+            labels = {"route": getattr(route, "path", "unmatched"), "method": scope["method"]}
+            self.registry.observe("http_request_duration_seconds", "Request latency by route template",
+                                  labels, time.perf_counter() - started)
+            self.registry.inc("http_requests_total", "Requests by route template and status",
+                              {**labels, "status": status_code})
+            self.registry.observe("http_request_mongo_commands", "Mongo commands issued per request",
+                                  labels, stats.mongo_commands, COUNT_BUCKETS)
+            self.registry.observe("http_request_mongo_seconds", "Time spent in Mongo per request",
+                                  labels, stats.mongo_seconds)
+        if self.budget_mode != "off" and route is not None:
+            self.check_budget(labels, getattr(route, "endpoint", None), stats)
+
+    def check_budget(self, labels: Dict[str, Any], endpoint, stats: RequestStats):
+        problems = []
+        budget = getattr(endpoint, "query_budget", None)
+        if budget is not None and stats.mongo_commands > budget:
+            problems.append(f"{stats.mongo_commands} Mongo commands (budget {budget})")
+        for shape, count in stats.repeated_shapes(self.repeat_threshold).items():
+            problems.append(f"{count}x {shape}")
+        if not problems:
+            return
+        self.registry.inc("http_query_budget_violations_total", "Requests over their query budget or repeating a query",
+                          labels)
+        message = f"Possible N+1 in {labels['method']} {labels['route']}: " + "; ".join(problems)
+        if self.budget_mode == "raise":
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
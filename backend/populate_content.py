@@ -6,7 +6,8 @@ from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 import os
 from pathlib import Path
-import uuid
+from content_versions import ContentNamespace
+from ingest_content import publish_rows, print_stats
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -474,188 +475,27 @@ async def populate_database():
     
     print("Starting database population...")
     
-    # Clear existing content collections
-    print("Clearing existing collections...")
-    await db.chapters.delete_many({})
-    await db.topics.delete_many({})
-    await db.subtopics.delete_many({})
-    await db.microcontent.delete_many({})
-    await db.quiz_questions.delete_many({})
-    
-    # Process data and create hierarchical structure
-    chapters_dict = {}
-    topics_dict = {}
-    subtopics_dict = {}
-    
-    for row in excel_data:
-        chapter_name = row["Chapter_Name"]
-        topic_number = row["Topic_Number"]
-        topic_title = row["Topic_Title"]
-        subtopic_title = row["Subtopic_Title"]
-        
-        # Create Chapter
-        if chapter_name not in chapters_dict:
-            chapter_id = str(uuid.uuid4())
-            chapters_dict[chapter_name] = {
-                "chapter_id": chapter_id,
-                "chapter_name": chapter_name,
-                "title": chapter_name,
-                "description": f"Learn about {chapter_name}",
-                "order": 1,
-                "locked": False,
-                "icon": "📚"
-            }
-        
-        chapter_id = chapters_dict[chapter_name]["chapter_id"]
-        
-        # Create Topic
-        topic_key = f"{chapter_name}|{topic_number}|{topic_title}"
-        if topic_key not in topics_dict:
-            topic_id = str(uuid.uuid4())
-            # Convert topic_number to sortable order (e.g., "1.1.2" -> 1.012, "1.1" -> 1.01)
-            try:
-                order_val = sum(float(part) / (100 ** idx) for idx, part in enumerate(topic_number.split('.'))) if topic_number else 0
-            except:
-                order_val = len(topics_dict) + 1
-            
-            topics_dict[topic_key] = {
-                "topic_id": topic_id,
-                "chapter_id": chapter_id,
-                "topic_number": topic_number,
-                "topic_title": topic_title,
-                "title": topic_title,
-                "description": f"Explore {topic_title}",
-                "order": order_val,
-                "locked": False
-            }
-        
-        topic_id = topics_dict[topic_key]["topic_id"]
-        
-        # Create Subtopic (if exists)
-        if subtopic_title:
-            subtopic_key = f"{topic_key}|{subtopic_title}"
-            if subtopic_key not in subtopics_dict:
-                subtopic_id = str(uuid.uuid4())
-                subtopics_dict[subtopic_key] = {
-                    "subtopic_id": subtopic_id,
-                    "topic_id": topic_id,
-                    "chapter_id": chapter_id,
-                    "subtopic_title": subtopic_title,
-                    "subtopic_name": row["Subtopic_Name"],
-                    "title": subtopic_title,
-                    "order": len([k for k in subtopics_dict.keys() if k.startswith(topic_key)]) + 1,
-                    "microcontent_count": 0
-                }
-            
-            subtopic_id = subtopics_dict[subtopic_key]["subtopic_id"]
-            subtopics_dict[subtopic_key]["microcontent_count"] += 1
-        else:
-            # If no subtopic, use topic as subtopic
-            subtopic_key = f"{topic_key}|{topic_title}"
-            if subtopic_key not in subtopics_dict:
-                subtopic_id = str(uuid.uuid4())
-                subtopics_dict[subtopic_key] = {
-                    "subtopic_id": subtopic_id,
-                    "topic_id": topic_id,
-                    "chapter_id": chapter_id,
-                    "subtopic_title": topic_title,
-                    "subtopic_name": row["Subtopic_Name"],
-                    "title": topic_title,
-                    "order": 1,
-                    "microcontent_count": 0
-                }
-            
-            subtopic_id = subtopics_dict[subtopic_key]["subtopic_id"]
-            subtopics_dict[subtopic_key]["microcontent_count"] += 1
-        
-        # Create Microcontent
-        microcontent_doc = {
-            "microcontent_id": row["Microcontent_ID"],
-            "subtopic_id": subtopic_id,
-            "topic_id": topic_id,
-            "chapter_id": chapter_id,
-            "microcontent_text": row["Microcontent_Text"],
-            "content_type": row["Content_Type"],
-            "story_explanation": row["Story_Explanation"],
-            "analogy_explanation": row["Analogy_Explanation"],
-            "core_text": row["Microcontent_Text"],  # Why mode
-            "related_code": row["Related_Code_or_Image_Ref"],
-            "qa_pair": row["QA_Pair"],
-            "order": int(row["Microcontent_ID"].split("_MC")[-1]) if "_MC" in row["Microcontent_ID"] else 1
-        }
-        
-        await db.microcontent.insert_one(microcontent_doc)
-        
-        # Generate quiz questions for this subtopic
-        if row["QA_Pair"]:
-            # Parse Q&A pair
-            qa_parts = row["QA_Pair"].split("A:")
-            if len(qa_parts) == 2:
-                question_text = qa_parts[0].replace("Q:", "").strip()
-                correct_answer = qa_parts[1].strip()
-                
-                # Generate 3 distractors
-                distractors = [
-                    "This is a distractor option",
-                    "Another incorrect option",
-                    "Yet another wrong answer"
-                ]
-                
-                options = [correct_answer] + distractors
-                import random
-                random.shuffle(options)
-                
-                correct_index = options.index(correct_answer)
-                
-                quiz_question = {
-                    "question_id": str(uuid.uuid4()),
-                    "subtopic_id": subtopic_id,
-                    "topic_id": topic_id,
-                    "chapter_id": chapter_id,
-                    "question_text": question_text,
-                    "options": options,
-                    "correct_answer": correct_answer,
-                    "correct_index": correct_index,
-                    "difficulty": "medium",
-                    "explanation": row["Microcontent_Text"][:200]
-                }
-                
-                await db.quiz_questions.insert_one(quiz_question)
-    
-    # Insert all chapters
-    print(f"Inserting {len(chapters_dict)} chapters...")
-    if chapters_dict:
-        await db.chapters.insert_many(list(chapters_dict.values()))
-    
-    # Insert all topics
-    print(f"Inserting {len(topics_dict)} topics...")
-    if topics_dict:
-        await db.topics.insert_many(list(topics_dict.values()))
-    
-    # Insert all subtopics
-    print(f"Inserting {len(subtopics_dict)} subtopics...")
-    if subtopics_dict:
-        await db.subtopics.insert_many(list(subtopics_dict.values()))
-    
-    print("✅ Database population complete!")
-    print(f"   - Chapters: {len(chapters_dict)}")
-    print(f"   - Topics: {len(topics_dict)}")
-    print(f"   - Subtopics: {len(subtopics_dict)}")
-    print(f"   - Microcontent: {len(excel_data)}")
+    # Stable ids and change detection make this safe to re-run: existing
+    # student progress keeps pointing at the same chapters/topics/subtopics.
+    # The content goes into a new version, so the live one is never emptied.
+    version, stats = await publish_rows(db, excel_data, note="populate_content")
+    print_stats(stats)
+    print(f"🚀 Published content version {version}")
+    content = ContentNamespace(db, version)
     
     # Print sample data
     print("\n📊 Sample Chapter:")
-    sample_chapter = await db.chapters.find_one()
+    sample_chapter = await content.chapters.find_one()
     if sample_chapter:
         print(f"   {sample_chapter['title']}")
     
     print("\n📊 Sample Topic:")
-    sample_topic = await db.topics.find_one()
+    sample_topic = await content.topics.find_one()
     if sample_topic:
         print(f"   {sample_topic['title']}")
     
     print("\n📊 Sample Subtopic:")
-    sample_subtopic = await db.subtopics.find_one()
+    sample_subtopic = await content.subtopics.find_one()
     if sample_subtopic:
         print(f"   {sample_subtopic['title']}")
 
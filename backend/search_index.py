@@ -0,0 +1,140 @@
+"""
+In-process inverted index with BM25F ranking
+
+Documents have several text fields, each with a boost; scores combine the
+length-normalized, boosted term frequencies of all fields before saturation
+(BM25F). The last query term also matches as a prefix so search-as-you-type
+works. Documents can be added, replaced and removed one at a time, and sync()
+applies only the differences between the indexed set and a new one.
+"""
+import hashlib
+import heapq
+import json
+import math
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from distractors import tokenize
+
+K1 = 1.2
+B = 0.75
+PREFIX_WEIGHT = 0.6
+MAX_PREFIX_EXPANSIONS = 50
+
+
+class SearchIndex:
+    def __init__(self, boosts: Dict[str, float]):
+        self.boosts = boosts
+        self.postings: Dict[str, Dict[str, Dict[str, int]]] = {}
+        self.field_lengths: Dict[str, Dict[str, int]] = {}
+        self.document_terms: Dict[str, set] = {}
+        self.length_totals: Dict[str, int] = {field: 0 for field in boosts}
+        self.payloads: Dict[str, Dict[str, Any]] = {}
+        self.signatures: Dict[str, str] = {}
+        self._vocabulary: List[str] = []
+        self._vocabulary_dirty = False
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def add(self, key: str, fields: Dict[str, Optional[str]], payload: Dict[str, Any]):
+        """Index a document, replacing any previous version with the same key"""
+        self.remove(key)
+        lengths = {}
+        terms = set()
+        for field in self.boosts:
+            tokens = tokenize(fields.get(field))
+            lengths[field] = len(tokens)
+            self.length_totals[field] += len(tokens)
+            terms.update(tokens)
+            for token in tokens:
+                by_doc = self.postings.get(token)
+                if by_doc is None:
+                    by_doc = self.postings[token] = {}
+                    self._vocabulary_dirty = True
+                counts = by_doc.setdefault(key, {})
+                counts[field] = counts.get(field, 0) + 1
+        self.field_lengths[key] = lengths
+        self.document_terms[key] = terms
+        self.payloads[key] = payload
+        self.signatures[key] = document_signature(fields, payload)
+
+    def remove(self, key: str):
+        lengths = self.field_lengths.pop(key, None)
+        if lengths is None:
+            return
+        for field, length in lengths.items():
+            self.length_totals[field] -= length
+        for token in self.document_terms.pop(key):
+            del self.postings[token][key]
+            if not self.postings[token]:
+                del self.postings[token]
+                self._vocabulary_dirty = True
+        del self.payloads[key]
+        del self.signatures[key]
+
+    def sync(self, documents: Iterable[Tuple[str, Dict[str, Optional[str]], Dict[str, Any]]]) -> Dict[str, int]:
+        """Make the index hold exactly `documents`, re-indexing only what changed"""
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        seen = set()
+        for key, fields, payload in documents:
+            seen.add(key)
+            previous = self.signatures.get(key)
+            if previous == document_signature(fields, payload):
+                stats["unchanged"] += 1
+                continue
+            self.add(key, fields, payload)
+            stats["updated" if previous else "added"] += 1
+        for key in [key for key in self.payloads if key not in seen]:
+            self.remove(key)
+            stats["removed"] += 1
+        return stats
+
+    def _expand(self, term: str, prefix: bool) -> List[Tuple[str, float]]:
+        if not prefix:
+            return [(term, 1.0)] if term in self.postings else []
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self.postings)
+            self._vocabulary_dirty = False
+        matches = []
+        position = bisect_left(self._vocabulary, term)
+        while position < len(self._vocabulary) and len(matches) < MAX_PREFIX_EXPANSIONS:
+            candidate = self._vocabulary[position]
+            if not candidate.startswith(term):
+                break
+            matches.append((candidate, 1.0 if candidate == term else PREFIX_WEIGHT))
+            position += 1
+        return matches
+
+    def search(self, query: str, limit: int = 20, kinds: Optional[set] = None) -> List[Dict[str, Any]]:
+        """Rank documents for `query`; the final term also matches as a prefix"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.payloads:
+            return []
+        prefix_last = not query[-1:].isspace()
+
+        document_count = len(self.payloads)
+        average_lengths = {field: max(total / document_count, 1.0) for field, total in self.length_totals.items()}
+        scores: Dict[str, float] = {}
+
+        for position, term in enumerate(terms):
+            is_last = position == len(terms) - 1
+            for token, weight in self._expand(term, prefix=is_last and prefix_last and len(term) >= 2):
+                by_doc = self.postings[token]
+                idf = math.log(1 + (document_count - len(by_doc) + 0.5) / (len(by_doc) + 0.5))
+                for key, counts in by_doc.items():
+                    lengths = self.field_lengths[key]
+                    weighted_tf = sum(
+                        self.boosts[field] * tf / (1 - B + B * lengths[field] / average_lengths[field])
+                        for field, tf in counts.items()
+                    )
+                    scores[key] = scores.get(key, 0.0) + weight * idf * weighted_tf * (K1 + 1) / (weighted_tf + K1)
+
+        if kinds:
+            scores = {key: score for key, score in scores.items() if self.payloads[key]["type"] in kinds}
+        ranked = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [{**self.payloads[key], "score": round(score, 4)} for key, score in ranked]
+
+
+def document_signature(fields, payload):
+    return hashlib.sha1(json.dumps([fields, payload], sort_keys=True, default=str).encode("utf-8")).hexdigest()
@@ -1,37 +1,72 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Request, status
+from fastapi.responses import StreamingResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne, UpdateMany
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import os
+import asyncio
+import json
+import fcntl
+import gzip
+import hashlib
+import hmac
+import math
+import time
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 import random
 import openai
 
+from content_versions import ContentNamespace, get_active_version, publish
+from search_index import SearchIndex
+from metrics import Histogram, MetricsRegistry, MongoCommandListener, RequestMetricsMiddleware, query_budget
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Prometheus metrics; the command listener must be registered before the client connects
+metrics_registry = MetricsRegistry()
+mongo_command_listener = MongoCommandListener(metrics_registry)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[mongo_command_listener])
+
+# N+1 detection for development and tests: off | warn | raise. Handlers declare
+# budgets with @query_budget; they count every command of the request, including
+# the user lookup in get_current_user
+QUERY_BUDGET_MODE = os.environ.get('QUERY_BUDGET_MODE', 'off')
+QUERY_REPEAT_THRESHOLD = int(os.environ.get('QUERY_REPEAT_THRESHOLD', '3'))
 db = client[os.environ.get('DB_NAME', 'ailo_db')]
 
+# Content collections resolve against the active published version
+content = ContentNamespace(db)
+CONTENT_POLL_SECONDS = float(os.environ.get('CONTENT_POLL_SECONDS', '10'))
+
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = os.environ.get("SECRET_KEY", "ailo-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
-# OpenAI Setup
-openai.api_key = os.environ.get('OPENAI_API_KEY', '')
+# OpenAI Setup (OPENAI_BASE_URL points the client at any OpenAI-compatible server)
+LLM_ENABLED = bool(os.environ.get('OPENAI_API_KEY') or os.environ.get('OPENAI_BASE_URL'))
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gpt-3.5-turbo')
+llm_client = openai.AsyncOpenAI(
+    api_key=os.environ.get('OPENAI_API_KEY') or "not-configured",
+    base_url=os.environ.get('OPENAI_BASE_URL') or None
+)
 
 # Create the main app
 app = FastAPI(title="AILO EdTech API")
@@ -97,6 +132,15 @@ class QuizSubmission(BaseModel):
     user_answer: str
     time_taken: Optional[int] = None
 
+class QuizBatchAnswer(BaseModel):
+    question_id: str
+    user_answer: str
+    time_taken: Optional[int] = None
+
+class QuizBatchSubmission(BaseModel):
+    quiz_id: str
+    answers: List[QuizBatchAnswer]
+
 class QuizResult(BaseModel):
     quiz_id: str
     score: float
@@ -130,9 +174,21 @@ class ParentLinkRequest(BaseModel):
     parent_email: EmailStr
     student_id: str
 
+class SyncEvent(BaseModel):
+    idempotency_key: str
+    type: str  # "onboarding_answer", "card_progress", "quiz_answer", "feedback"
+    payload: Dict[str, Any]
+    client_ts: Optional[datetime] = None
+
+class SyncBatch(BaseModel):
+    events: List[SyncEvent]
+
 class ChatMessage(BaseModel):
     message: str
     context: Optional[str] = None  # lesson/quiz context
+    microcontent_id: Optional[str] = None  # card the student is looking at
+    subtopic_id: Optional[str] = None
+    thread_id: Optional[str] = None  # omit to start a new conversation
 
 # ============================================================================
 # HELPER FUNCTIONS
@@ -171,13 +227,38 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise credentials_exception
     return user
 
+def estimate_tokens(text: Optional[str]) -> int:
+    """Rough token count (~4 characters per token for English text)"""
+    return (len(text) + 3) // 4 if text else 0
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    if estimate_tokens(text) <= budget:
+        return text
+    return text[:max(budget, 0) * 4].rsplit(" ", 1)[0] + "…"
+
 def generate_otp():
     return str(random.randint(100000, 999999))
 
-async def get_ai_recommendations(user_id: str, performance_data: Dict):
+def parse_recommendations(text: Optional[str]) -> List[str]:
+    """Read the model's JSON array of recommendations, tolerating code fences"""
+    text = (text or "").strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        parsed = [line.lstrip("-*0123456789. ").strip() for line in text.splitlines()]
+    if not isinstance(parsed, list):
+        parsed = [parsed]
+    return [str(item) for item in parsed if str(item).strip()] or ["Keep practicing!"]
+
+async def get_ai_recommendations(user_id: str, performance_data: Dict, endpoint: str = "recommendations"):
     """Generate AI-powered learning recommendations"""
     try:
-        if not openai.api_key:
+        if not LLM_ENABLED:
+            llm_metrics.count(endpoint, "disabled")
+            return ["Complete more practice quizzes", "Review weak topics", "Stay consistent"]
+        # Page loads never fail on quota; the student just gets the standard tips
+        if await llm_quota_exceeded(user_id):
+            llm_metrics.count(endpoint, "quota_exceeded")
             return ["Complete more practice quizzes", "Review weak topics", "Stay consistent"]
         
         prompt = f"""Based on this student's performance data, provide 3 specific, actionable learning recommendations:
@@ -188,19 +269,1175 @@ async def get_ai_recommendations(user_id: str, performance_data: Dict):
         
         Provide recommendations as a JSON array of strings."""
         
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
+        recommendations = await llm_chat(
+            endpoint,
+            user_id,
+            [{"role": "user", "content": prompt}],
             max_tokens=200
         )
-        
-        recommendations = response.choices[0].message.content
-        # Parse and return recommendations
-        return eval(recommendations) if recommendations else ["Keep practicing!"]
+        return parse_recommendations(recommendations)
+    except (LlmUnavailable, asyncio.TimeoutError):
+        return ["Complete daily practice", "Review challenging topics", "Stay consistent"]
     except Exception as e:
         logger.error(f"AI recommendation error: {e}")
         return ["Complete daily practice", "Review challenging topics", "Stay consistent"]
 
+# ============================================================================
+# CONTENT CATALOG & PROGRESS ROLLUP
+# ============================================================================
+
+class ContentCatalog:
+    """In-memory view of the content hierarchy (child counts and parent ids).
+    
+    Progress writes use it instead of re-reading topics/subtopics on every call.
+    Call invalidate() whenever content is (re)seeded.
+    """
+    
+    def __init__(self):
+        self.subtopics: Dict[str, Dict[str, Any]] = {}
+        self.topic_chapter: Dict[str, str] = {}
+        self.topic_subtopics: Dict[str, List[str]] = {}
+        self.chapter_topics: Dict[str, List[str]] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+    
+    async def ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._lock:
+            if self._loaded:
+                return
+            await self._load()
+    
+    async def _load(self):
+        subtopics: Dict[str, Dict[str, Any]] = {}
+        topic_chapter: Dict[str, str] = {}
+        topic_subtopics: Dict[str, List[str]] = {}
+        chapter_topics: Dict[str, List[str]] = {}
+        
+        async for topic in content.topics.find({}, {"topic_id": 1, "chapter_id": 1}):
+            topic_chapter[topic["topic_id"]] = topic["chapter_id"]
+            chapter_topics.setdefault(topic["chapter_id"], []).append(topic["topic_id"])
+        
+        projection = {"subtopic_id": 1, "topic_id": 1, "chapter_id": 1, "microcontent_count": 1}
+        async for subtopic in content.subtopics.find({}, projection):
+            subtopics[subtopic["subtopic_id"]] = {
+                "topic_id": subtopic["topic_id"],
+                "chapter_id": subtopic["chapter_id"],
+                "microcontent_count": subtopic.get("microcontent_count", 0)
+            }
+            topic_subtopics.setdefault(subtopic["topic_id"], []).append(subtopic["subtopic_id"])
+        
+        self.subtopics = subtopics
+        self.topic_chapter = topic_chapter
+        self.topic_subtopics = topic_subtopics
+        self.chapter_topics = chapter_topics
+        self._loaded = True
+        logger.info(f"Content catalog loaded: {len(topic_chapter)} topics, {len(subtopics)} subtopics")
+    
+    def invalidate(self):
+        self._loaded = False
+
+catalog = ContentCatalog()
+
+SEARCH_FIELD_BOOSTS = {
+    "title": 3.0,
+    "parent_title": 1.0,
+    "core_text": 1.5,
+    "qa_pair": 1.2,
+    "story_explanation": 0.7,
+    "analogy_explanation": 0.7,
+}
+
+class ContentSearch:
+    """BM25 search index over the active content version.
+    
+    Synced lazily like the catalog; a version switch re-indexes only the
+    documents that changed between versions.
+    """
+    
+    def __init__(self):
+        self.index = SearchIndex(SEARCH_FIELD_BOOSTS)
+        self.version: Optional[str] = None
+        self._synced = False
+        self._lock = asyncio.Lock()
+    
+    async def ensure_current(self):
+        if self._synced and self.version == content.version:
+            return
+        async with self._lock:
+            if self._synced and self.version == content.version:
+                return
+            await self._sync()
+    
+    async def _sync(self):
+        version = content.version
+        topics = await content.topics.find({}, {"_id": 0, "topic_id": 1, "chapter_id": 1, "title": 1, "description": 1}).to_list(None)
+        subtopics = await content.subtopics.find({}, {"_id": 0, "subtopic_id": 1, "topic_id": 1, "chapter_id": 1, "title": 1}).to_list(None)
+        topic_titles = {t["topic_id"]: t.get("title") for t in topics}
+        subtopic_titles = {s["subtopic_id"]: s.get("title") for s in subtopics}
+        
+        documents = []
+        for topic in topics:
+            documents.append((f"topic:{topic['topic_id']}", {
+                "title": topic.get("title"),
+                "core_text": topic.get("description"),
+            }, {
+                "type": "topic",
+                "id": topic["topic_id"],
+                "chapter_id": topic["chapter_id"],
+                "title": topic.get("title")
+            }))
+        for subtopic in subtopics:
+            documents.append((f"subtopic:{subtopic['subtopic_id']}", {
+                "title": subtopic.get("title"),
+                "parent_title": topic_titles.get(subtopic["topic_id"]),
+            }, {
+                "type": "subtopic",
+                "id": subtopic["subtopic_id"],
+                "topic_id": subtopic["topic_id"],
+                "chapter_id": subtopic["chapter_id"],
+                "title": subtopic.get("title")
+            }))
+        
+        projection = {"_id": 0, "microcontent_id": 1, "subtopic_id": 1, "topic_id": 1, "chapter_id": 1,
+                      "core_text": 1, "microcontent_text": 1, "story_explanation": 1, "analogy_explanation": 1, "qa_pair": 1}
+        async for card in content.microcontent.find({}, projection):
+            core_text = card.get("core_text") or card.get("microcontent_text")
+            documents.append((f"microcontent:{card['microcontent_id']}", {
+                "title": subtopic_titles.get(card["subtopic_id"]),
+                "parent_title": topic_titles.get(card.get("topic_id")),
+                "core_text": core_text,
+                "qa_pair": card.get("qa_pair"),
+                "story_explanation": card.get("story_explanation"),
+                "analogy_explanation": card.get("analogy_explanation"),
+            }, {
+                "type": "microcontent",
+                "id": card["microcontent_id"],
+                "subtopic_id": card["subtopic_id"],
+                "topic_id": card.get("topic_id"),
+                "chapter_id": card.get("chapter_id"),
+                "title": subtopic_titles.get(card["subtopic_id"]),
+                "snippet": (core_text or "")[:160]
+            }))
+        
+        # Answers stay out of the index so search cannot be used to look them up
+        async for question in content.quiz_questions.find({}, {"_id": 0, "question_id": 1, "question_text": 1, "subtopic_id": 1, "topic_id": 1}):
+            documents.append((f"question:{question['question_id']}", {
+                "title": question.get("question_text"),
+                "parent_title": subtopic_titles.get(question.get("subtopic_id")) or topic_titles.get(question.get("topic_id")),
+            }, {
+                "type": "question",
+                "id": question["question_id"],
+                "subtopic_id": question.get("subtopic_id"),
+                "topic_id": question.get("topic_id"),
+                "title": question.get("question_text")
+            }))
+        
+        stats = self.index.sync(documents)
+        self.version = version
+        self._synced = True
+        logger.info(f"Search index synced to content version {version}: {stats}")
+
+content_search = ContentSearch()
+
+async def refresh_content_version() -> bool:
+    """Point `content` at the currently active version; returns True if it changed"""
+    version = await get_active_version(db)
+    if version == content.version:
+        return False
+    logger.info(f"Switching content version {content.version} -> {version}")
+    content.version = version
+    catalog.invalidate()
+    return True
+
+async def watch_content_version():
+    """Pick up content publishes (and rollbacks) made by other processes"""
+    while True:
+        await asyncio.sleep(CONTENT_POLL_SECONDS)
+        try:
+            if await refresh_content_version():
+                await content_search.ensure_current()
+        except Exception as e:
+            logger.error(f"Content version poll failed: {e}")
+
+async def rollup_child_completion(collection, key: Dict[str, Any], counter: str, delta: int, total: int,
+                                  extra: Dict[str, Any], count_completed, has_lesson: bool = False) -> int:
+    """Apply a child's completed-state flip (+1/-1) to its parent's progress counter.
+    
+    The counter, the fields in `extra`, the progress percentage and the completed
+    flag are updated in one atomic write. A parent is completed once all `total`
+    children are or, with has_lesson, when its own lesson_completed flag is set.
+    Returns the resulting flip of the parent's own completed state (+1, -1 or 0)
+    so the caller can roll it up one level further.
+    
+    Rows written before the counter existed (or not written yet) are seeded on
+    first use from `count_completed()`, which counts completed children as
+    stored now, i.e. already including the flip being applied.
+    """
+    if delta == 0 and not extra:
+        # Nothing changes unless the row still needs its counter seeded
+        if await collection.count_documents({**key, counter: {"$exists": True}}, limit=1):
+            return 0
+    
+    now = datetime.utcnow()
+    
+    def children_done(count_expr: Any) -> Any:
+        return {"$gte": [count_expr, total]} if total > 0 else False
+    
+    def children_pending(count_expr: Any) -> Any:
+        return {"$lt": [count_expr, total]} if total > 0 else True
+    
+    def pipeline(seed: int) -> List[Dict[str, Any]]:
+        fields = {field: {"$literal": value} for field, value in extra.items()}
+        if has_lesson and "lesson_completed" not in extra:
+            # Rows completed by reading the lesson before the flag existed keep that completion
+            fields["lesson_completed"] = {"$ifNull": ["$lesson_completed", {"$and": [
+                {"$eq": ["$completed", True]},
+                children_pending({"$ifNull": [f"${counter}", seed]})
+            ]}]}
+        completed_expr = children_done(f"${counter}")
+        if has_lesson:
+            completed_expr = {"$or": [{"$eq": ["$lesson_completed", True]}, completed_expr]}
+        derived = {
+            "completed": completed_expr,
+            "completed_at": {"$cond": [completed_expr, {"$ifNull": ["$completed_at", now]}, None]}
+        }
+        if total > 0 and "progress" not in extra:
+            derived["progress"] = {"$multiply": [{"$divide": [f"${counter}", total]}, 100]}
+        return [
+            {"$set": {
+                **fields,
+                counter: {"$max": [0, {"$add": [{"$ifNull": [f"${counter}", seed]}, delta]}]},
+                "updated_at": now
+            }},
+            {"$set": derived}
+        ]
+    
+    projection = {counter: 1, "completed": 1, "lesson_completed": 1}
+    before = await collection.find_one_and_update(
+        {**key, counter: {"$exists": True}},
+        pipeline(0),
+        projection=projection,
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        # Seed with the count before this flip. A concurrent first use may seed
+        # in between; $ifNull then keeps its value and only the delta is applied.
+        seed = max(0, await count_completed() - delta)
+        before = await collection.find_one_and_update(
+            key,
+            pipeline(seed),
+            projection=projection,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        ) or {}
+        before.setdefault(counter, seed)
+    
+    was_completed = bool(before.get("completed", False))
+    is_completed = total > 0 and max(0, before[counter] + delta) >= total
+    if has_lesson:
+        lesson_completed = extra.get("lesson_completed", before.get(
+            "lesson_completed", was_completed and not (total > 0 and before[counter] >= total)
+        ))
+        is_completed = is_completed or bool(lesson_completed)
+    return int(is_completed) - int(was_completed)
+
+async def update_topic_rollup(user_id: str, topic_id: str, chapter_id: str, delta: int, extra: Dict[str, Any]) -> int:
+    """Apply a subtopic completion flip and/or lesson fields to a topic's progress row"""
+    await catalog.ensure_loaded()
+    subtopic_ids = catalog.topic_subtopics.get(topic_id, [])
+    return await rollup_child_completion(
+        db.topic_progress,
+        {"user_id": user_id, "topic_id": topic_id},
+        "completed_subtopics",
+        delta,
+        len(subtopic_ids),
+        {"chapter_id": chapter_id, **extra},
+        lambda: db.subtopic_progress.count_documents(
+            {"user_id": user_id, "subtopic_id": {"$in": subtopic_ids}, "completed": True}
+        ),
+        has_lesson=True
+    )
+
+async def rollup_topic_completion(user_id: str, topic_id: str, delta: int) -> int:
+    """Roll a topic's completed-state flip up into its chapter's progress"""
+    await catalog.ensure_loaded()
+    chapter_id = catalog.topic_chapter.get(topic_id)
+    if not chapter_id:
+        return 0
+    topic_ids = catalog.chapter_topics.get(chapter_id, [])
+    return await rollup_child_completion(
+        db.user_progress,
+        {"user_id": user_id, "chapter_id": chapter_id},
+        "completed_topics",
+        delta,
+        len(topic_ids),
+        {},
+        lambda: db.topic_progress.count_documents(
+            {"user_id": user_id, "topic_id": {"$in": topic_ids}, "completed": True}
+        )
+    )
+
+async def rollup_subtopic_completion(user_id: str, subtopic_id: str, delta: int, rollup_chapter: bool = True) -> int:
+    """Roll a subtopic's completed-state flip up into its topic and chapter.
+    
+    Returns the flip of the topic's completed state. Pass rollup_chapter=False to
+    apply the chapter step yourself, e.g. concurrently with other writes.
+    """
+    await catalog.ensure_loaded()
+    subtopic = catalog.subtopics.get(subtopic_id)
+    if not subtopic:
+        return 0
+    topic_id = subtopic["topic_id"]
+    topic_delta = await update_topic_rollup(user_id, topic_id, subtopic["chapter_id"], delta, {})
+    if rollup_chapter:
+        await rollup_topic_completion(user_id, topic_id, topic_delta)
+    return topic_delta
+
+async def get_subtopic_info(subtopic_id: str) -> Optional[Dict[str, Any]]:
+    """Return parent ids and card count for a subtopic, from the catalog when possible"""
+    await catalog.ensure_loaded()
+    info = catalog.subtopics.get(subtopic_id)
+    if info:
+        return info
+    subtopic = await content.subtopics.find_one({"subtopic_id": subtopic_id})
+    if not subtopic:
+        return None
+    return {
+        "topic_id": subtopic["topic_id"],
+        "chapter_id": subtopic["chapter_id"],
+        "microcontent_count": subtopic.get("microcontent_count", 0)
+    }
+
+# ============================================================================
+# WRITE-BEHIND BUFFERS
+# ============================================================================
+
+class WriteBehindBuffer(ABC):
+    """Coalesces writes per key in memory and flushes them in batches.
+    
+    Subclasses implement _write() to persist a batch of {key: value} items.
+    A flush runs every `interval` seconds, on demand, and once more on stop().
+    """
+    
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self._pending: Dict[Any, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"{self.name} flush error: {e}")
+    
+    async def flush(self, keys: Optional[List[Any]] = None):
+        async with self._flush_lock:
+            if keys is None:
+                items, self._pending = self._pending, {}
+            else:
+                items = {k: self._pending.pop(k) for k in keys if k in self._pending}
+            if not items:
+                return
+            try:
+                await self._write(items)
+            except Exception:
+                # Put the batch back unless a newer value arrived meanwhile
+                for key, value in items.items():
+                    self._pending.setdefault(key, value)
+                raise
+    
+    @abstractmethod
+    async def _write(self, items: Dict[Any, Any]):
+        """Persist one batch of coalesced {key: value} items"""
+
+class CardProgressBuffer(WriteBehindBuffer):
+    """Buffers card-position updates so only the latest per (user, subtopic) is written"""
+    
+    def put(self, user_id: str, subtopic_id: str, fields: Dict[str, Any]):
+        self._pending[(user_id, subtopic_id)] = fields
+    
+    def get(self, user_id: str, subtopic_id: str) -> Optional[Dict[str, Any]]:
+        return self._pending.get((user_id, subtopic_id))
+    
+    def discard(self, user_id: str, subtopic_id: str):
+        self._pending.pop((user_id, subtopic_id), None)
+    
+    async def flush_user(self, user_id: str):
+        await self.flush([key for key in list(self._pending) if key[0] == user_id])
+    
+    async def _write(self, items: Dict[Any, Any]):
+        await db.subtopic_progress.bulk_write(
+            [
+                UpdateOne(
+                    {"user_id": user_id, "subtopic_id": subtopic_id},
+                    {"$set": fields},
+                    upsert=True
+                )
+                for (user_id, subtopic_id), fields in items.items()
+            ],
+            ordered=False
+        )
+
+card_progress_buffer = CardProgressBuffer(
+    "Card progress buffer",
+    float(os.environ.get("CARD_PROGRESS_FLUSH_SECONDS", "2"))
+)
+
+# XP needed to reach each level: index i holds the threshold for level i + 1
+LEVEL_THRESHOLDS = [0, 100, 250, 500, 1000, 2000, 3500, 5000, 7500, 10000]
+
+def level_expr(xp_expr: Any) -> Dict[str, Any]:
+    """Aggregation expression computing the level for an XP value"""
+    return {"$add": [1, {"$size": {"$filter": {
+        "input": LEVEL_THRESHOLDS[1:],
+        "cond": {"$gte": [xp_expr, "$$this"]}
+    }}}]}
+
+class XpJournal:
+    """Append-only on-disk log of XP awards that have not reached Mongo yet.
+    
+    Awards go to the active segment file. Flushing rotates it into a closed
+    segment that stays on disk, locked, until its batch is written. Segments
+    left behind by a crash or a failed flush are replayed by whichever worker
+    can lock them first. All methods do blocking file I/O; XpAggregator calls
+    them on its journal thread, never on the event loop.
+    """
+    
+    def __init__(self, directory: Path, fsync: bool):
+        self.directory = directory
+        self.fsync = fsync
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._open_segment()
+    
+    def _open_segment(self):
+        self.segment_id = uuid.uuid4().hex
+        self.path = self.directory / f"xp-{self.segment_id}.jsonl"
+        self._file = open(self.path, "a", encoding="utf-8")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._empty = True
+    
+    def append(self, user_id: str, xp: int, at: datetime):
+        self._file.write(json.dumps({"user_id": user_id, "xp": xp, "at": at.isoformat()}) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._empty = False
+    
+    def rotate(self):
+        """Close the active segment and return (segment_id, path, locked file handle)"""
+        closed = (self.segment_id, self.path, self._file)
+        self._open_segment()
+        return closed
+    
+    def orphaned_segments(self):
+        """Yield (segment_id, path, locked file handle) for segments no live worker holds"""
+        for path in sorted(self.directory.glob("xp-*.jsonl")):
+            if path == self.path:
+                continue
+            handle = open(path, "r", encoding="utf-8")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                continue
+            yield path.stem[len("xp-"):], path, handle
+    
+    @staticmethod
+    def read_segment(handle) -> Dict[str, Dict[str, Any]]:
+        handle.seek(0)
+        awards: Dict[str, Dict[str, Any]] = {}
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A crash can leave a torn last line; that award never acknowledged
+                continue
+            XpAggregator.accumulate(awards, entry["user_id"], entry["xp"], datetime.fromisoformat(entry["at"]))
+        return awards
+    
+    @staticmethod
+    def finish_segment(path: Path, handle, applied: bool):
+        # An unapplied segment stays on disk and is replayed by the next flush
+        if applied:
+            path.unlink(missing_ok=True)
+        handle.close()
+    
+    def close(self):
+        self._file.close()
+        if self._empty:
+            self.path.unlink(missing_ok=True)
+
+class XpAggregator(WriteBehindBuffer):
+    """Accumulates XP awards per user and flushes them as batched pipeline updates.
+    
+    Each flush applies XP, streak and level in one write per user. Awards are
+    journaled to disk before they are acknowledged, and every user update records
+    the segment id it applied, so replaying a segment after a crash never counts
+    an award twice. Once a segment's file is deleted it can no longer be
+    replayed, and its id is pulled from the users again by the next flush.
+    
+    Journal I/O runs on a single dedicated thread, which also owns the pending
+    batch, so an award can never land in a segment other than the batch it is
+    counted in.
+    """
+    
+    def __init__(self, name: str, interval: float, journal_dir: Path, fsync: bool):
+        super().__init__(name, interval)
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self._journal: Optional[XpJournal] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Rotated segments whose batch has not been confirmed written, by segment id
+        self._unapplied: Dict[str, Tuple[Path, Dict[str, Dict[str, Any]]]] = {}
+        # Deleted segments whose ids the users still carry, with the users that carry them
+        self._settled: Dict[str, List[str]] = {}
+    
+    async def _on_journal_thread(self, fn, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="xp-journal")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = XpJournal(self.journal_dir, self.fsync)
+    
+    def start(self):
+        super().start()
+        asyncio.create_task(self._on_journal_thread(self._open_journal))
+    
+    async def stop(self):
+        await super().stop()
+        if self._journal is not None:
+            await self._on_journal_thread(self._journal.close)
+            self._journal = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+    
+    @staticmethod
+    def accumulate(awards: Dict[str, Dict[str, Any]], user_id: str, xp: int, at: datetime):
+        award = awards.setdefault(user_id, {"xp": 0, "activity": {}})
+        award["xp"] += xp
+        # The latest activity per UTC day, so a batch spanning midnight counts both days
+        day = at.date().isoformat()
+        award["activity"][day] = max(award["activity"].get(day, at), at)
+    
+    def _append(self, user_id: str, xp: int, at: datetime):
+        self._open_journal()
+        self._journal.append(user_id, xp, at)
+        self.accumulate(self._pending, user_id, xp, at)
+    
+    async def award(self, user_id: str, xp: int):
+        await self._on_journal_thread(self._append, user_id, xp, datetime.utcnow())
+    
+    def pending_xp(self, user_id: str) -> int:
+        batches = [self._pending] + [awards for _, awards in self._unapplied.values()]
+        return sum(awards[user_id]["xp"] for awards in batches if user_id in awards)
+    
+    def _rotate(self):
+        if not self._pending:
+            return None
+        awards, self._pending = self._pending, {}
+        return (*self._journal.rotate(), awards)
+    
+    def _claim_orphans(self):
+        return [
+            (segment_id, path, handle, XpJournal.read_segment(handle))
+            for segment_id, path, handle in self._journal.orphaned_segments()
+        ]
+    
+    async def flush(self, keys: Optional[List[Any]] = None):
+        async with self._flush_lock:
+            if self._journal is None:
+                return
+            
+            # Segments another worker replayed are no longer ours to report
+            for segment_id, (path, _) in list(self._unapplied.items()):
+                if not path.exists():
+                    del self._unapplied[segment_id]
+            
+            # Replay segments left by crashed workers or earlier failed flushes first
+            for segment_id, path, handle, awards in await self._on_journal_thread(self._claim_orphans):
+                self._unapplied.setdefault(segment_id, (path, awards))
+                await self._write_segment(segment_id, path, handle, awards)
+            
+            rotated = await self._on_journal_thread(self._rotate)
+            if rotated is not None:
+                segment_id, path, handle, awards = rotated
+                self._unapplied[segment_id] = (path, awards)
+                await self._write_segment(segment_id, path, handle, awards)
+            elif self._settled:
+                await self._write({})
+    
+    async def _write_segment(self, segment_id: str, path: Path, handle, awards: Dict[str, Dict[str, Any]]):
+        applied = False
+        try:
+            await self._write({(segment_id, user_id): award for user_id, award in awards.items()})
+            applied = True
+        finally:
+            await self._on_journal_thread(XpJournal.finish_segment, path, handle, applied)
+        del self._unapplied[segment_id]
+        self._settled[segment_id] = list(awards)
+    
+    async def _write(self, items: Dict[Any, Any]):
+        """Apply {(segment_id, user_id): award} items, skipping users that already have their segment.
+        
+        The same bulk write drops the ids of settled segments from the users.
+        """
+        settled = dict(self._settled)
+        settled_ids = list(settled)
+        ops = []
+        for (segment_id, user_id), award in items.items():
+            days = sorted(award["activity"].values())
+            # One streak step per active day, in order; the XP is added with the last one
+            activity = [stage for at in days[:-1] for stage in user_activity_update(0, at)]
+            ops.append(UpdateOne(
+                {"user_id": user_id, "xp_segments": {"$ne": segment_id}},
+                activity + user_activity_update(award["xp"], days[-1]) + [
+                    {"$set": {
+                        "level": level_expr("$xp"),
+                        "xp_segments": {"$concatArrays": [
+                            {"$filter": {
+                                "input": {"$ifNull": ["$xp_segments", []]},
+                                "as": "applied",
+                                "cond": {"$cond": [{"$in": ["$$applied", settled_ids]}, False, True]}
+                            }},
+                            [segment_id]
+                        ]}
+                    }}
+                ]
+            ))
+        batch_users = {user_id for _, user_id in items}
+        other_users = {user_id for users in settled.values() for user_id in users} - batch_users
+        if other_users:
+            ops.append(UpdateMany(
+                {"user_id": {"$in": list(other_users)}},
+                {"$pull": {"xp_segments": {"$in": settled_ids}}}
+            ))
+        if not ops:
+            return
+        await db.users.bulk_write(ops, ordered=False)
+        for segment_id in settled_ids:
+            self._settled.pop(segment_id, None)
+
+xp_aggregator = XpAggregator(
+    "XP aggregator",
+    float(os.environ.get("XP_FLUSH_SECONDS", "1")),
+    Path(os.environ.get("XP_JOURNAL_DIR", str(ROOT_DIR / "xp_journal"))),
+    os.environ.get("XP_JOURNAL_FSYNC", "false").lower() in ("1", "true", "yes")
+)
+
+# ============================================================================
+# LLM CLIENT & USAGE METRICS
+# ============================================================================
+
+# USD per 1K tokens as (prompt, completion); unknown models are counted at 0
+LLM_PRICES_PER_1K_TOKENS = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4o": (0.0025, 0.01),
+}
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Total latency each page may spend; the LLM gets LLM_BUDGET_SHARE of it before
+# the caller gives up and serves its fallback
+ENDPOINT_LATENCY_BUDGET_SECONDS = {
+    "/dashboard/home": 2.0,
+    "/quizzes/{quiz_id}/results": 2.5,
+    "/parent/student/{student_id}/dashboard": 2.5,
+    "/ai/chat": 20.0,
+    "chat_summary": 60.0,  # runs in the background, off the request path
+}
+DEFAULT_LATENCY_BUDGET_SECONDS = float(os.environ.get("DEFAULT_LATENCY_BUDGET_SECONDS", "5"))
+LLM_BUDGET_SHARE = float(os.environ.get("LLM_BUDGET_SHARE", "0.6"))
+# Upstream calls are shared between callers, so they may run up to the longest deadline
+LLM_UPSTREAM_TIMEOUT_SECONDS = float(os.environ.get("LLM_UPSTREAM_TIMEOUT_SECONDS", "15"))
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get("LLM_BREAKER_RESET_SECONDS", "30"))
+
+def llm_deadline(endpoint: str) -> float:
+    return ENDPOINT_LATENCY_BUDGET_SECONDS.get(endpoint, DEFAULT_LATENCY_BUDGET_SECONDS) * LLM_BUDGET_SHARE
+
+class LlmUnavailable(Exception):
+    """Raised instead of calling upstream while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+    
+    Closed: calls flow. After `failure_threshold` failures in a row it opens
+    and rejects calls for `reset_timeout` seconds, then lets a single trial
+    call through (half-open); its success closes the breaker, its failure
+    re-opens it.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+    
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+    
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"{self.name} circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+    
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_running or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f"{self.name} circuit opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+        self._trial_running = False
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+llm_breaker = CircuitBreaker("LLM", LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+
+def llm_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = LLM_PRICES_PER_1K_TOKENS.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+class LlmUsageRollup(WriteBehindBuffer):
+    """Accumulates per (day, endpoint, user, model) usage counters and $inc's them into llm_usage_daily"""
+    
+    def add(self, key: tuple, counts: Dict[str, float]):
+        pending = self._pending.setdefault(key, {})
+        for field, value in counts.items():
+            pending[field] = pending.get(field, 0) + value
+    
+    def pending_tokens(self, day: str, user_id: str) -> int:
+        return sum(
+            counts.get("prompt_tokens", 0) + counts.get("completion_tokens", 0) + counts.get("shared_tokens", 0)
+            for (pending_day, _, pending_user, _), counts in self._pending.items()
+            if pending_day == day and pending_user == user_id
+        )
+    
+    async def flush(self, keys: Optional[List[Any]] = None):
+        async with self._flush_lock:
+            items, self._pending = self._pending, {}
+            if not items:
+                return
+            try:
+                await self._write(items)
+            except Exception:
+                # Counters are additive, so merge the batch back into newer counts
+                for key, counts in items.items():
+                    self.add(key, counts)
+                raise
+    
+    async def _write(self, items: Dict[Any, Any]):
+        await db.llm_usage_daily.bulk_write(
+            [
+                UpdateOne(
+                    {"day": day, "endpoint": endpoint, "user_id": user_id, "model": model},
+                    {"$inc": counts},
+                    upsert=True
+                )
+                for (day, endpoint, user_id, model), counts in items.items()
+            ],
+            ordered=False
+        )
+
+class LlmMetrics:
+    """Process-local LLM call statistics per endpoint, plus the daily rollup"""
+    
+    def __init__(self, rollup: LlmUsageRollup):
+        self.rollup = rollup
+        self.started_at = datetime.utcnow()
+        self.endpoints: Dict[str, Dict[str, Any]] = {}
+    
+    def _endpoint(self, endpoint: str) -> Dict[str, Any]:
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                "latency": Histogram(),
+                "outcomes": {},
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cost_usd": 0.0
+            }
+        return self.endpoints[endpoint]
+    
+    def count(self, endpoint: str, outcome: str):
+        outcomes = self._endpoint(endpoint)["outcomes"]
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        metrics_registry.inc("llm_calls_total", "LLM calls by endpoint and outcome",
+                             {"endpoint": endpoint, "outcome": outcome})
+    
+    def record(self, endpoint: str, user_id: Optional[str], model: str, outcome: str,
+               seconds: float, prompt_tokens: int, completion_tokens: int):
+        stats = self._endpoint(endpoint)
+        cost = llm_cost(model, prompt_tokens, completion_tokens)
+        stats["latency"].observe(seconds)
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        stats["cost_usd"] += cost
+        self.count(endpoint, outcome)
+        metrics_registry.observe("llm_request_duration_seconds", "Upstream LLM call latency",
+                                 {"endpoint": endpoint}, seconds)
+        metrics_registry.inc("llm_tokens_total", "LLM tokens by endpoint and kind",
+                             {"endpoint": endpoint, "kind": "prompt"}, prompt_tokens)
+        metrics_registry.inc("llm_tokens_total", "LLM tokens by endpoint and kind",
+                             {"endpoint": endpoint, "kind": "completion"}, completion_tokens)
+        metrics_registry.inc("llm_cost_usd_total", "Estimated LLM spend", {"endpoint": endpoint}, cost)
+        
+        day = datetime.utcnow().strftime("%Y-%m-%d")
+        self.rollup.add((day, endpoint, user_id, model), {
+            "calls": 1,
+            f"outcomes.{outcome}": 1,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": cost,
+            "latency_seconds": seconds
+        })
+    
+    def charge_shared(self, endpoint: str, user_id: str, model: str, tokens: int):
+        """Count a coalesced caller's answer against its quota without adding to spend"""
+        day = datetime.utcnow().strftime("%Y-%m-%d")
+        self.rollup.add((day, endpoint, user_id, model), {"shared_tokens": tokens})
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            endpoint: {
+                "latency_seconds": stats["latency"].snapshot(),
+                "outcomes": dict(stats["outcomes"]),
+                "prompt_tokens": stats["prompt_tokens"],
+                "completion_tokens": stats["completion_tokens"],
+                "cost_usd": round(stats["cost_usd"], 6)
+            }
+            for endpoint, stats in self.endpoints.items()
+        }
+
+llm_metrics = LlmMetrics(LlmUsageRollup(
+    "LLM usage rollup",
+    float(os.environ.get("LLM_USAGE_FLUSH_SECONDS", "10"))
+))
+
+def llm_outcome(error: Exception) -> str:
+    if isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limited"
+    if isinstance(error, openai.APIStatusError):
+        return f"http_{error.status_code}"
+    return "error"
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers share its result.
+    
+    The shared call runs as its own task that callers await through
+    asyncio.shield, so a caller that goes away (client disconnect) does not
+    cancel it for the others.
+    """
+    
+    def __init__(self):
+        self.inflight: Dict[str, asyncio.Task] = {}
+    
+    def join(self, key: str, factory) -> Tuple[asyncio.Task, bool]:
+        """Return the call running for `key`, starting it if needed, and whether it was already running"""
+        task = self.inflight.get(key)
+        if task is not None:
+            return task, True
+        task = asyncio.create_task(factory())
+        self.inflight[key] = task
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return task, False
+    
+    def _finished(self, key: str, task: asyncio.Task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every caller went away
+
+llm_single_flight = SingleFlight()
+
+def llm_request_key(model: str, messages: List[Dict[str, str]], options: Dict[str, Any]) -> str:
+    """Identity of a completion request, ignoring case and whitespace differences in the prompt"""
+    normalized = [(m["role"], " ".join(m["content"].split()).casefold()) for m in messages]
+    payload = json.dumps([model, normalized, options], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+async def llm_chat(endpoint: str, user_id: Optional[str], messages: List[Dict[str, str]],
+                   model: str = LLM_MODEL, **kwargs) -> str:
+    """Run a chat completion, sharing one upstream call among concurrent identical requests.
+    
+    The caller waits at most the endpoint's LLM deadline. Errors, timeouts and
+    an open circuit breaker (LlmUnavailable, raised without waiting) all
+    propagate so callers serve their own fallbacks.
+    """
+    async def complete():
+        # The breaker sees each upstream call once, however many callers share it
+        if not llm_breaker.allow():
+            llm_metrics.count(endpoint, "short_circuited")
+            raise LlmUnavailable("LLM circuit breaker is open")
+        started = time.monotonic()
+        try:
+            reply = await llm_complete(endpoint, user_id, messages, model, **kwargs)
+        except Exception:
+            llm_breaker.record_failure()
+            raise
+        # A reply that arrives after the deadline served its first caller a fallback
+        if time.monotonic() - started > llm_deadline(endpoint):
+            llm_breaker.record_failure()
+        else:
+            llm_breaker.record_success()
+        return reply
+    
+    key = llm_request_key(model, messages, kwargs)
+    task, coalesced = llm_single_flight.join(key, complete)
+    if coalesced:
+        llm_metrics.count(endpoint, "coalesced")
+    try:
+        text, tokens = await asyncio.wait_for(asyncio.shield(task), timeout=llm_deadline(endpoint))
+    except asyncio.TimeoutError:
+        # The shared upstream call keeps running for callers with longer deadlines
+        llm_metrics.count(endpoint, "deadline_exceeded")
+        raise
+    # The upstream call is billed to the caller that started it; every caller's quota pays for its answer
+    if coalesced and user_id:
+        llm_metrics.charge_shared(endpoint, user_id, model, tokens)
+    return text
+
+async def llm_complete(endpoint: str, user_id: Optional[str], messages: List[Dict[str, str]],
+                       model: str = LLM_MODEL, **kwargs) -> Tuple[str, int]:
+    """Make one upstream completion and record its latency, tokens, cost and outcome.
+    
+    Returns the reply text and the tokens it used.
+    """
+    started = time.perf_counter()
+    outcome, usage, text = "ok", None, ""
+    try:
+        response = await llm_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            timeout=LLM_UPSTREAM_TIMEOUT_SECONDS,
+            **kwargs
+        )
+        usage = response.usage
+        text = response.choices[0].message.content or ""
+    except Exception as e:
+        outcome = llm_outcome(e)
+        raise
+    finally:
+        # Servers that omit usage are counted with the same estimate used for budgets
+        prompt_tokens = usage.prompt_tokens if usage else sum(estimate_tokens(m["content"]) for m in messages)
+        completion_tokens = usage.completion_tokens if usage else estimate_tokens(text)
+        llm_metrics.record(endpoint, user_id, model, outcome, time.perf_counter() - started,
+                           prompt_tokens, completion_tokens)
+    return text, prompt_tokens + completion_tokens
+
+async def require_metrics_token(x_metrics_token: Optional[str] = Header(None)):
+    """Metrics include per-user spend, so they are off unless METRICS_TOKEN is configured"""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    if not hmac.compare_digest(x_metrics_token or "", METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+@api_router.get("/metrics", dependencies=[Depends(require_metrics_token)])
+async def get_prometheus_metrics():
+    """Per-route request and Mongo command metrics in the Prometheus text format"""
+    return Response(content=metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@api_router.get("/metrics/llm", dependencies=[Depends(require_metrics_token)])
+async def get_llm_metrics(days: int = 1, top_users: int = 10):
+    """LLM call statistics since process start, plus persisted per-endpoint and per-user totals"""
+    await llm_metrics.rollup.flush()
+    since = (datetime.utcnow() - timedelta(days=max(days, 1) - 1)).strftime("%Y-%m-%d")
+    totals = {
+        "calls": {"$sum": "$calls"},
+        "prompt_tokens": {"$sum": "$prompt_tokens"},
+        "completion_tokens": {"$sum": "$completion_tokens"},
+        "cost_usd": {"$sum": "$cost_usd"}
+    }
+    
+    by_endpoint, by_user = await asyncio.gather(
+        db.llm_usage_daily.aggregate([
+            {"$match": {"day": {"$gte": since}}},
+            {"$group": {"_id": "$endpoint", **totals}},
+            {"$sort": {"cost_usd": -1}}
+        ]).to_list(None),
+        db.llm_usage_daily.aggregate([
+            {"$match": {"day": {"$gte": since}, "user_id": {"$ne": None}}},
+            {"$group": {"_id": "$user_id", **totals}},
+            {"$sort": {"cost_usd": -1}},
+            {"$limit": max(1, min(top_users, 100))}
+        ]).to_list(None)
+    )
+    
+    return {
+        "process": {
+            "since": llm_metrics.started_at,
+            "inflight_requests": len(llm_single_flight.inflight),
+            "circuit_breaker": llm_breaker.snapshot(),
+            "endpoints": llm_metrics.snapshot()
+        },
+        "since_day": since,
+        "by_endpoint": [{"endpoint": row.pop("_id"), **row} for row in by_endpoint],
+        "top_users": [{"user_id": row.pop("_id"), **row} for row in by_user]
+    }
+
+# ============================================================================
+# RATE LIMITING & QUOTAS
+# ============================================================================
+
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")  # "memory" or "mongo" (shared across workers)
+AI_USER_RATE_PER_MINUTE = float(os.environ.get("AI_USER_RATE_PER_MINUTE", "6"))
+AI_USER_BURST = float(os.environ.get("AI_USER_BURST", "10"))
+# Off by default: a school network or the ingress puts many students behind one address
+AI_IP_RATE_PER_MINUTE = float(os.environ.get("AI_IP_RATE_PER_MINUTE", "0"))  # 0 disables
+AI_IP_BURST = float(os.environ.get("AI_IP_BURST", "300"))
+LLM_DAILY_TOKEN_QUOTA = int(os.environ.get("LLM_DAILY_TOKEN_QUOTA", "50000"))  # per user, 0 disables
+TRUST_FORWARDED_FOR = os.environ.get("TRUST_FORWARDED_FOR", "false").lower() in ("1", "true", "yes")
+
+class MemoryTokenBuckets:
+    """Token buckets held in this process: `burst` capacity refilled at `rate` tokens per second"""
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[str, tuple] = {}
+    
+    async def take(self, key: str, cost: float = 1.0) -> float:
+        """Consume `cost` tokens; returns 0 if allowed, else seconds until it would be"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= cost:
+            self._buckets[key] = (tokens - cost, now)
+            self._evict_full(now)
+            return 0.0
+        self._buckets[key] = (tokens, now)
+        return (cost - tokens) / self.rate
+    
+    def _evict_full(self, now: float):
+        # Buckets that have had time to refill completely carry no state worth keeping
+        if len(self._buckets) > 10000:
+            refill = self.burst / self.rate
+            self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < refill}
+
+class MongoTokenBuckets:
+    """Token buckets in the rate_limits collection, shared by every API worker.
+    
+    Refill and consume happen in a single pipeline update, so concurrent
+    requests on different workers cannot overspend a bucket.
+    """
+    
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+    
+    async def take(self, key: str, cost: float = 1.0) -> float:
+        now = datetime.utcnow()
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        refilled = {"$min": [self.burst, {"$add": [{"$ifNull": ["$tokens", self.burst]}, {"$multiply": [elapsed, self.rate]}]}]}
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": f"{self.name}:{key}"},
+            [
+                {"$set": {"tokens": refilled, "updated_at": now}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", cost]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", cost]}, {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                    "expires_at": now + timedelta(seconds=self.burst / self.rate)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return 0.0 if bucket["allowed"] else (cost - bucket["tokens"]) / self.rate
+
+def token_buckets(name: str, per_minute: float, burst: float):
+    if RATE_LIMIT_BACKEND == "mongo":
+        return MongoTokenBuckets(name, per_minute / 60, burst)
+    return MemoryTokenBuckets(per_minute / 60, burst)
+
+ai_user_buckets = token_buckets("ai_user", AI_USER_RATE_PER_MINUTE, AI_USER_BURST)
+ai_ip_buckets = token_buckets("ai_ip", AI_IP_RATE_PER_MINUTE, AI_IP_BURST) if AI_IP_RATE_PER_MINUTE > 0 else None
+
+def client_ip(request: Request) -> str:
+    if TRUST_FORWARDED_FOR and request.headers.get("x-forwarded-for"):
+        return request.headers["x-forwarded-for"].split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+def seconds_until_utc_midnight() -> float:
+    now = datetime.utcnow()
+    return (datetime(now.year, now.month, now.day) + timedelta(days=1) - now).total_seconds()
+
+async def llm_tokens_used_today(user_id: str) -> int:
+    """Prompt + completion tokens counted for a user today, including unflushed usage"""
+    day = datetime.utcnow().strftime("%Y-%m-%d")
+    rows = await db.llm_usage_daily.aggregate([
+        {"$match": {"user_id": user_id, "day": day}},
+        # Rows of coalesced callers only carry shared_tokens
+        {"$group": {"_id": None, "tokens": {"$sum": {"$add": [
+            {"$ifNull": [f"${field}", 0]} for field in ("prompt_tokens", "completion_tokens", "shared_tokens")
+        ]}}}}
+    ]).to_list(1)
+    return (rows[0]["tokens"] if rows else 0) + llm_metrics.rollup.pending_tokens(day, user_id)
+
+async def llm_quota_exceeded(user_id: str) -> bool:
+    return LLM_DAILY_TOKEN_QUOTA > 0 and await llm_tokens_used_today(user_id) >= LLM_DAILY_TOKEN_QUOTA
+
+async def enforce_ai_limits(request: Request, current_user = Depends(get_current_user)):
+    """Dependency for AI endpoints: per-IP (when enabled) and per-user token buckets, then the daily token quota"""
+    if ai_ip_buckets is not None:
+        retry_after = await ai_ip_buckets.take(client_ip(request))
+        if retry_after:
+            raise too_many_requests("Too many AI requests from this network, please slow down", retry_after)
+    retry_after = await ai_user_buckets.take(current_user["user_id"])
+    if retry_after:
+        raise too_many_requests("You're sending messages too quickly, please wait a moment", retry_after)
+    if await llm_quota_exceeded(current_user["user_id"]):
+        raise too_many_requests("Daily AI usage limit reached, try again tomorrow", seconds_until_utc_midnight())
+    return current_user
+
 # ============================================================================
 # AUTHENTICATION ENDPOINTS
 # ============================================================================
@@ -270,6 +1507,7 @@ async def login(credentials: UserLogin):
     
     user.pop("password")
     user.pop("_id")
+    user.pop("xp_segments", None)
     
     return {
         "access_token": access_token,
@@ -301,6 +1539,8 @@ async def verify_otp(user_id: str, otp: str, current_user = Depends(get_current_
 async def get_me(current_user = Depends(get_current_user)):
     current_user.pop("_id", None)
     current_user.pop("password", None)
+    current_user.pop("xp_segments", None)
+    current_user["xp"] = current_user.get("xp", 0) + xp_aggregator.pending_xp(current_user["user_id"])
     return current_user
 
 # ============================================================================
@@ -312,13 +1552,17 @@ async def submit_onboarding_quiz(responses: List[OnboardingQuizResponse], curren
     user_id = current_user["user_id"]
     
     # Store responses
-    for response in responses:
-        await db.onboarding_responses.insert_one({
-            "user_id": user_id,
-            "question_id": response.question_id,
-            "answer": response.answer,
-            "created_at": datetime.utcnow()
-        })
+    now = datetime.utcnow()
+    if responses:
+        await db.onboarding_responses.insert_many([
+            {
+                "user_id": user_id,
+                "question_id": response.question_id,
+                "answer": response.answer,
+                "created_at": now
+            }
+            for response in responses
+        ])
     
     return {"message": "Quiz responses saved"}
 
@@ -347,7 +1591,7 @@ async def get_home_dashboard(current_user = Depends(get_current_user)):
     
     # Get user progress
     chapters = await db.user_progress.find({"user_id": user_id}).to_list(100)
-    total_chapters = await db.chapters.count_documents({})
+    total_chapters = await content.chapters.count_documents({})
     completed_chapters = sum(1 for ch in chapters if ch.get("completed", False))
     
     # Get recent activity
@@ -369,12 +1613,12 @@ async def get_home_dashboard(current_user = Depends(get_current_user)):
         "streak": streak
     }
     
-    recommendations = await get_ai_recommendations(user_id, performance_data)
+    recommendations = await get_ai_recommendations(user_id, performance_data, "/dashboard/home")
     
     return {
         "user": {
             "full_name": current_user["full_name"],
-            "xp": current_user.get("xp", 0),
+            "xp": current_user.get("xp", 0) + xp_aggregator.pending_xp(user_id),
             "level": current_user.get("level", 1),
             "streak": streak,
         },
@@ -399,7 +1643,7 @@ async def get_home_dashboard(current_user = Depends(get_current_user)):
 async def get_chapters(current_user = Depends(get_current_user)):
     user_id = current_user["user_id"]
     
-    chapters = await db.chapters.find().sort("order", ASCENDING).to_list(100)
+    chapters = await content.chapters.find().sort("order", ASCENDING).to_list(100)
     user_progress = await db.user_progress.find({"user_id": user_id}).to_list(100)
     
     progress_map = {p["chapter_id"]: p for p in user_progress}
@@ -426,7 +1670,7 @@ async def get_chapters(current_user = Depends(get_current_user)):
 async def get_chapter_topics(chapter_id: str, current_user = Depends(get_current_user)):
     user_id = current_user["user_id"]
     
-    topics = await db.topics.find({"chapter_id": chapter_id}).sort("order", ASCENDING).to_list(100)
+    topics = await content.topics.find({"chapter_id": chapter_id}).sort("order", ASCENDING).to_list(100)
     topic_progress = await db.topic_progress.find({
         "user_id": user_id,
         "chapter_id": chapter_id
@@ -456,52 +1700,42 @@ async def get_chapter_topics(chapter_id: str, current_user = Depends(get_current
 async def update_topic_progress(topic_id: str, progress: float, position: int, current_user = Depends(get_current_user)):
     user_id = current_user["user_id"]
     
-    topic = await db.topics.find_one({"topic_id": topic_id})
+    topic = await content.topics.find_one({"topic_id": topic_id})
     if not topic:
         raise HTTPException(status_code=404, detail="Topic not found")
     
-    await db.topic_progress.update_one(
-        {"user_id": user_id, "topic_id": topic_id},
-        {"$set": {
-            "chapter_id": topic["chapter_id"],
-            "progress": progress,
-            "last_position": position,
-            "completed": progress >= 90,
-            "updated_at": datetime.utcnow()
-        }},
-        upsert=True
-    )
-    
-    # Update chapter progress
-    topics = await db.topics.find({"chapter_id": topic["chapter_id"]}).to_list(100)
-    topic_progress = await db.topic_progress.find({
-        "user_id": user_id,
-        "chapter_id": topic["chapter_id"]
-    }).to_list(100)
-    
-    total_topics = len(topics)
-    completed_topics = sum(1 for p in topic_progress if p.get("completed", False))
-    chapter_progress = (completed_topics / total_topics * 100) if total_topics > 0 else 0
+    # Reading the lesson to the end completes the topic through the same rollup as its subtopics
+    topic_delta = await update_topic_rollup(user_id, topic_id, topic["chapter_id"], 0, {
+        "progress": progress,
+        "last_position": position,
+        "lesson_completed": progress >= 90
+    })
     
-    await db.user_progress.update_one(
-        {"user_id": user_id, "chapter_id": topic["chapter_id"]},
-        {"$set": {
-            "progress": chapter_progress,
-            "completed": chapter_progress >= 100,
-            "updated_at": datetime.utcnow()
-        }},
-        upsert=True
-    )
+    # Update chapter progress only when the topic's completed state flips
+    await rollup_topic_completion(user_id, topic_id, topic_delta)
     
     # Award XP
     if progress >= 90:
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$inc": {"xp": 10}}
-        )
+        await record_user_activity(user_id, 10)
     
     return {"message": "Progress updated"}
 
+@api_router.get("/search")
+async def search_content(q: str, limit: int = 20, types: Optional[str] = None, current_user = Depends(get_current_user)):
+    """Ranked full-text search over topics, subtopics, microcontent and questions"""
+    limit = max(1, min(limit, 50))
+    kinds = set(types.split(",")) if types else None
+    
+    await content_search.ensure_current()
+    started = time.perf_counter()
+    results = content_search.index.search(q[:200], limit=limit, kinds=kinds)
+    
+    return {
+        "query": q,
+        "results": results,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
 # ============================================================================
 # PRACTICE/QUIZ ENDPOINTS
 # ============================================================================
@@ -509,7 +1743,7 @@ async def update_topic_progress(topic_id: str, progress: float, position: int, c
 @api_router.get("/quizzes/daily-challenge")
 async def get_daily_challenge(current_user = Depends(get_current_user)):
     # Get 5 random questions from user's weak topics
-    questions = await db.quiz_questions.aggregate([
+    questions = await content.quiz_questions.aggregate([
         {"$sample": {"size": 5}}
     ]).to_list(5)
     
@@ -532,10 +1766,10 @@ async def get_daily_challenge(current_user = Depends(get_current_user)):
 
 @api_router.get("/quizzes/chapter/{chapter_id}")
 async def get_chapter_quiz(chapter_id: str, current_user = Depends(get_current_user)):
-    topics = await db.topics.find({"chapter_id": chapter_id}).to_list(100)
+    topics = await content.topics.find({"chapter_id": chapter_id}).to_list(100)
     topic_ids = [t["topic_id"] for t in topics]
     
-    questions = await db.quiz_questions.find({
+    questions = await content.quiz_questions.find({
         "topic_id": {"$in": topic_ids}
     }).to_list(100)
     
@@ -564,48 +1798,144 @@ async def submit_quiz_answer(submission: QuizSubmission, current_user = Depends(
     user_id = current_user["user_id"]
     
     # Get question
-    question = await db.quiz_questions.find_one({"question_id": submission.question_id})
+    question = await content.quiz_questions.find_one({"question_id": submission.question_id})
     if not question:
         raise HTTPException(status_code=404, detail="Question not found")
     
-    is_correct = submission.user_answer == question["correct_answer"]
+    response = grade_quiz_answer(user_id, submission.quiz_id, submission, question, datetime.utcnow())
     
-    # Store response
-    await db.quiz_responses.insert_one({
-        "user_id": user_id,
-        "quiz_id": submission.quiz_id,
-        "question_id": submission.question_id,
-        "user_answer": submission.user_answer,
-        "correct_answer": question["correct_answer"],
-        "is_correct": is_correct,
-        "time_taken": submission.time_taken,
-        "created_at": datetime.utcnow()
-    })
-    
-    # Award XP for correct answer
-    if is_correct:
-        xp_gained = 5
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$inc": {"xp": xp_gained}}
-        )
+    # Award XP only the first time this question is answered correctly
+    xp_gained = sum((await store_quiz_responses(user_id, [response])).values())
+    if xp_gained:
+        await record_user_activity(user_id, xp_gained)
     
     return {
-        "is_correct": is_correct,
+        "is_correct": response["is_correct"],
         "correct_answer": question["correct_answer"],
         "explanation": question.get("explanation", ""),
-        "xp_gained": 5 if is_correct else 0
+        "xp_gained": xp_gained
+    }
+
+def grade_quiz_answer(user_id: str, quiz_id: str, answer: Any, question: Dict, now: datetime) -> Dict[str, Any]:
+    """Build the quiz_responses document for one answer"""
+    return {
+        "user_id": user_id,
+        "quiz_id": quiz_id,
+        "question_id": answer.question_id,
+        "user_answer": answer.user_answer,
+        "correct_answer": question["correct_answer"],
+        "is_correct": answer.user_answer == question["correct_answer"],
+        "time_taken": answer.time_taken,
+        "created_at": now
     }
 
+async def store_quiz_responses(user_id: str, responses: List[Dict[str, Any]]) -> Dict[tuple, int]:
+    """Store the latest answer per (quiz, question) and award XP for first-correct answers.
+    
+    Each question keeps one response document. XP is claimed with a conditional
+    update on its xp_awarded flag, so resubmitting a correct answer, in the same
+    batch or later, never earns it twice. Returns {(quiz_id, question_id): xp}
+    for the answers that earned XP; the caller awards the total.
+    """
+    latest = {(r["quiz_id"], r["question_id"]): r for r in responses}
+    if not latest:
+        return {}
+    
+    def response_key(quiz_id: str, question_id: str) -> Dict[str, Any]:
+        return {"user_id": user_id, "quiz_id": quiz_id, "question_id": question_id}
+    
+    await db.quiz_responses.bulk_write(
+        [UpdateOne(response_key(*key), {"$set": r}, upsert=True) for key, r in latest.items()],
+        ordered=False
+    )
+    
+    correct = [key for key, r in latest.items() if r["is_correct"]]
+    if not correct:
+        return {}
+
+    # Tag each claim with this call's id: a concurrent submission may claim some of
+    # the same questions first, and only the documents carrying our id are ours
+    claim_id = str(uuid.uuid4())
+    result = await db.quiz_responses.bulk_write(
+        [
+            UpdateOne(
+                {**response_key(*key), "is_correct": True, "xp_awarded": {"$ne": True}},
+                {"$set": {"xp_awarded": True, "xp_claim_id": claim_id}}
+            )
+            for key in correct
+        ],
+        ordered=False
+    )
+    if not result.modified_count:
+        return {}
+    claimed = db.quiz_responses.find(
+        {"user_id": user_id, "xp_claim_id": claim_id}, {"_id": 0, "quiz_id": 1, "question_id": 1}
+    )
+    return {(doc["quiz_id"], doc["question_id"]): 5 async for doc in claimed}
+
+async def load_quiz_responses(user_id: str, quiz_id: str) -> List[Dict[str, Any]]:
+    """Stored responses for a quiz, one per question (the latest answer)"""
+    responses = await db.quiz_responses.find(
+        {"user_id": user_id, "quiz_id": quiz_id}
+    ).sort("created_at", ASCENDING).to_list(None)
+    # Responses stored before answers were kept per question may repeat a question
+    return list({r["question_id"]: r for r in responses}.values())
+
+@api_router.post("/quizzes/submit-batch")
+async def submit_quiz_batch(submission: QuizBatchSubmission, current_user = Depends(get_current_user)):
+    """Grade every answer of a quiz at once and return the results for the whole quiz.
+    
+    A quiz may be submitted in several parts; results cover every stored answer.
+    """
+    user_id = current_user["user_id"]
+    
+    # Fetch all referenced questions in one query
+    question_ids = list({a.question_id for a in submission.answers})
+    questions = await content.quiz_questions.find({"question_id": {"$in": question_ids}}).to_list(len(question_ids))
+    questions_map = {q["question_id"]: q for q in questions}
+    
+    missing = [qid for qid in question_ids if qid not in questions_map]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Question not found: {missing[0]}")
+    
+    now = datetime.utcnow()
+    responses = [
+        grade_quiz_answer(user_id, submission.quiz_id, answer, questions_map[answer.question_id], now)
+        for answer in submission.answers
+    ]
+    
+    # Award XP for all first-correct answers with a single update
+    xp_gained = sum((await store_quiz_responses(user_id, responses)).values())
+    if xp_gained:
+        await record_user_activity(user_id, xp_gained)
+    
+    # Earlier parts of the quiz may have answered questions this batch did not include
+    stored = await load_quiz_responses(user_id, submission.quiz_id)
+    other_wrong_ids = [r["question_id"] for r in stored if not r["is_correct"] and r["question_id"] not in questions_map]
+    if other_wrong_ids:
+        questions = await content.quiz_questions.find({"question_id": {"$in": other_wrong_ids}}).to_list(len(other_wrong_ids))
+        questions_map.update({q["question_id"]: q for q in questions})
+    
+    results = await build_quiz_results(current_user, submission.quiz_id, stored, questions_map)
+    results["xp_earned"] = xp_gained
+    return results
+
 @api_router.get("/quizzes/{quiz_id}/results")
+@query_budget(4)
 async def get_quiz_results(quiz_id: str, current_user = Depends(get_current_user)):
     user_id = current_user["user_id"]
     
-    responses = await db.quiz_responses.find({
-        "user_id": user_id,
-        "quiz_id": quiz_id
-    }).to_list(100)
+    responses = await load_quiz_responses(user_id, quiz_id)
     
+    # Look up all incorrectly answered questions in one query
+    wrong_ids = list({r["question_id"] for r in responses if not r["is_correct"]})
+    questions = await content.quiz_questions.find({"question_id": {"$in": wrong_ids}}).to_list(len(wrong_ids)) if wrong_ids else []
+    questions_map = {q["question_id"]: q for q in questions}
+    
+    return await build_quiz_results(current_user, quiz_id, responses, questions_map)
+
+async def build_quiz_results(current_user: Dict, quiz_id: str, responses: List[Dict], questions_map: Dict[str, Dict]):
+    """Build the quiz results payload from stored responses and their questions"""
     total_questions = len(responses)
     correct_answers = sum(1 for r in responses if r["is_correct"])
     score = (correct_answers / total_questions * 100) if total_questions > 0 else 0
@@ -615,7 +1945,7 @@ async def get_quiz_results(quiz_id: str, current_user = Depends(get_current_user
     incorrect_topics = []
     for r in responses:
         if not r["is_correct"]:
-            question = await db.quiz_questions.find_one({"question_id": r["question_id"]})
+            question = questions_map.get(r["question_id"])
             if question:
                 incorrect_topics.append(question.get("topic", ""))
     
@@ -626,7 +1956,10 @@ async def get_quiz_results(quiz_id: str, current_user = Depends(get_current_user
         "streak": current_user.get("streak", 0)
     }
     
-    recommendations = await get_ai_recommendations(user_id, performance_data)
+    recommendations = await get_ai_recommendations(current_user["user_id"], performance_data, "/quizzes/{quiz_id}/results")
+    
+    for r in responses:
+        r.pop("_id", None)
     
     return {
         "quiz_id": quiz_id,
@@ -663,11 +1996,8 @@ async def flag_question(flag: FlagQuestion, current_user = Depends(get_current_u
     
     return {"message": "Question flagged successfully"}
 
-@api_router.post("/feedback/general")
-async def submit_feedback(feedback: Feedback, current_user = Depends(get_current_user)):
-    user_id = current_user["user_id"]
-    
-    await db.feedback.insert_one({
+def feedback_document(user_id: str, feedback: Feedback) -> Dict[str, Any]:
+    return {
         "user_id": user_id,
         "category": feedback.category,
         "message": feedback.message,
@@ -675,7 +2005,13 @@ async def submit_feedback(feedback: Feedback, current_user = Depends(get_current
         "screenshot": feedback.screenshot,
         "created_at": datetime.utcnow(),
         "status": "pending"
-    })
+    }
+
+@api_router.post("/feedback/general")
+async def submit_feedback(feedback: Feedback, current_user = Depends(get_current_user)):
+    user_id = current_user["user_id"]
+    
+    await db.feedback.insert_one(feedback_document(user_id, feedback))
     
     return {"message": "Feedback submitted successfully"}
 
@@ -739,24 +2075,33 @@ async def create_study_group(group: StudyGroup, current_user = Depends(get_curre
     return {"group_id": group_id, "message": "Group created successfully"}
 
 @api_router.get("/community/groups")
+@query_budget(3)
 async def get_study_groups(current_user = Depends(get_current_user)):
     groups = await db.study_groups.find().to_list(100)
     
+    # Member counts and the user's own memberships for every group in one aggregation
+    membership = {
+        doc["_id"]: doc
+        async for doc in db.group_members.aggregate([
+            {"$match": {"group_id": {"$in": [group["group_id"] for group in groups]}}},
+            {"$group": {
+                "_id": "$group_id",
+                "member_count": {"$sum": 1},
+                "is_member": {"$max": {"$eq": ["$user_id", current_user["user_id"]]}}
+            }}
+        ])
+    }
+    
     result = []
     for group in groups:
-        member_count = await db.group_members.count_documents({"group_id": group["group_id"]})
-        is_member = await db.group_members.find_one({
-            "group_id": group["group_id"],
-            "user_id": current_user["user_id"]
-        })
-        
+        members = membership.get(group["group_id"], {})
         result.append({
             "group_id": group["group_id"],
             "name": group["name"],
             "description": group.get("description", ""),
-            "member_count": member_count,
+            "member_count": members.get("member_count", 0),
             "max_members": group["max_members"],
-            "is_member": is_member is not None
+            "is_member": members.get("is_member", False)
         })
     
     return result
@@ -789,6 +2134,7 @@ async def join_study_group(group_id: str, current_user = Depends(get_current_use
     return {"message": "Joined group successfully"}
 
 @api_router.get("/community/groups/{group_id}/messages")
+@query_budget(4)
 async def get_group_messages(group_id: str, current_user = Depends(get_current_user)):
     # Check if member
     is_member = await db.group_members.find_one({
@@ -802,13 +2148,17 @@ async def get_group_messages(group_id: str, current_user = Depends(get_current_u
         {"group_id": group_id}
     ).sort("created_at", ASCENDING).limit(100).to_list(100)
     
+    # Sender names for every message in one query
+    sender_ids = list({msg["user_id"] for msg in messages})
+    senders = await db.users.find({"user_id": {"$in": sender_ids}}, {"user_id": 1, "full_name": 1}).to_list(len(sender_ids))
+    names = {sender["user_id"]: sender.get("full_name") for sender in senders}
+    
     result = []
     for msg in messages:
-        user = await db.users.find_one({"user_id": msg["user_id"]})
         result.append({
             "message_id": str(msg["_id"]),
             "user_id": msg["user_id"],
-            "user_name": user["full_name"] if user else "Unknown",
+            "user_name": names.get(msg["user_id"]) or "Unknown",
             "message": msg["message"],
             "created_at": msg["created_at"].isoformat()
         })
@@ -837,17 +2187,62 @@ async def send_group_message(group_id: str, message: GroupMessage, current_user
 # AI CHATBOT ENDPOINTS
 # ============================================================================
 
-@api_router.post("/ai/chat")
-async def chat_with_ai(chat: ChatMessage, current_user = Depends(get_current_user)):
-    try:
-        if not openai.api_key:
-            return {
-                "response": "I'm Nova, your learning assistant! I'm here to help you understand topics better. How can I assist you today?",
-                "success": False,
-                "error": "AI service not configured"
-            }
-        
-        system_prompt = """You are Nova, a friendly and encouraging educational assistant for students. 
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", "600"))
+CHAT_CONTEXT_TOP_K = int(os.environ.get("CHAT_CONTEXT_TOP_K", "4"))
+
+async def retrieve_chat_context(message: str, microcontent_id: Optional[str], subtopic_id: Optional[str],
+                                top_k: int = CHAT_CONTEXT_TOP_K, budget: int = CHAT_CONTEXT_TOKEN_BUDGET):
+    """Pick the card texts most relevant to a chat message, within a token budget.
+    
+    The card the student is on comes first; the rest are ranked by the search
+    index, favouring cards of the same subtopic and chapter. Returns
+    (snippets, microcontent_ids).
+    """
+    await content_search.ensure_current()
+    await catalog.ensure_loaded()
+    index = content_search.index
+    
+    anchor = index.payloads.get(f"microcontent:{microcontent_id}") if microcontent_id else None
+    subtopic_id = subtopic_id or (anchor and anchor["subtopic_id"])
+    chapter_id = anchor["chapter_id"] if anchor else catalog.subtopics.get(subtopic_id, {}).get("chapter_id")
+    
+    ranked = []
+    for hit in index.search(message, limit=top_k * 5, kinds={"microcontent"}):
+        weight = 1.5 if subtopic_id and hit["subtopic_id"] == subtopic_id else 1.2 if chapter_id and hit["chapter_id"] == chapter_id else 1.0
+        ranked.append((hit["score"] * weight, hit["id"]))
+    ranked.sort(reverse=True)
+    
+    card_ids = [anchor["id"]] if anchor else []
+    card_ids += [card_id for _, card_id in ranked if card_id not in card_ids]
+    if len(card_ids) < top_k and subtopic_id:
+        # Vague questions ("explain this") match nothing; use the subtopic's own cards
+        card_ids += [
+            c["microcontent_id"] async for c in content.microcontent.find({"subtopic_id": subtopic_id}, {"microcontent_id": 1}).sort("order", ASCENDING)
+            if c["microcontent_id"] not in card_ids
+        ]
+    card_ids = card_ids[:top_k]
+    if not card_ids:
+        return [], []
+    
+    cards = {
+        c["microcontent_id"]: c.get("core_text") or c.get("microcontent_text") or ""
+        async for c in content.microcontent.find({"microcontent_id": {"$in": card_ids}}, {"microcontent_id": 1, "core_text": 1, "microcontent_text": 1})
+    }
+    
+    snippets, used_ids, remaining = [], [], budget
+    for card_id in card_ids:
+        text = cards.get(card_id)
+        if not text:
+            continue
+        if estimate_tokens(text) > remaining and remaining < 30:
+            break  # a few words cut from a card add noise, not context
+        text = truncate_to_tokens(text, remaining)
+        snippets.append(text)
+        used_ids.append(card_id)
+        remaining -= estimate_tokens(text)
+    return snippets, used_ids
+
+NOVA_SYSTEM_PROMPT = """You are Nova, a friendly and encouraging educational assistant for students. 
         Your role is to:
         1. Explain concepts step-by-step in simple terms
         2. Break down complex problems into manageable steps
@@ -856,37 +2251,174 @@ async def chat_with_ai(chat: ChatMessage, current_user = Depends(get_current_use
         5. Ask guiding questions to help students think critically
         
         Keep responses concise (2-3 paragraphs max) and age-appropriate."""
+
+# Recent turns are replayed verbatim; older ones live on only in the thread summary
+CHAT_VERBATIM_TURNS = int(os.environ.get("CHAT_VERBATIM_TURNS", "6"))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", "800"))
+CHAT_SUMMARY_MAX_TOKENS = int(os.environ.get("CHAT_SUMMARY_MAX_TOKENS", "250"))
+# Summarize once this many turns have fallen out of the verbatim window
+CHAT_SUMMARY_BATCH = int(os.environ.get("CHAT_SUMMARY_BATCH", "4"))
+
+summary_tasks: set = set()
+
+async def load_recent_turns(thread: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Unsummarized turns, oldest first, trimmed to the verbatim window and token budget"""
+    recent = await db.chat_history.find(
+        {"thread_id": thread["thread_id"], "seq": {"$gt": thread.get("summarized_until", 0)}},
+        {"_id": 0, "message": 1, "response": 1, "seq": 1}
+    ).sort("seq", DESCENDING).limit(CHAT_VERBATIM_TURNS).to_list(CHAT_VERBATIM_TURNS)
+    
+    turns, remaining = [], CHAT_HISTORY_TOKEN_BUDGET
+    for turn in recent:
+        cost = estimate_tokens(turn["message"]) + estimate_tokens(turn["response"])
+        if cost > remaining:
+            break
+        turns.append(turn)
+        remaining -= cost
+    return list(reversed(turns))
+
+def build_chat_messages(message: str, snippets: List[str], thread: Dict[str, Any], turns: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    messages = [{"role": "system", "content": NOVA_SYSTEM_PROMPT}]
+    if snippets:
+        context_text = "\n".join(f"- {snippet}" for snippet in snippets)
+        messages.append({"role": "system", "content": f"Lesson material the student is studying:\n{context_text}"})
+    if thread.get("summary"):
+        summary = truncate_to_tokens(thread["summary"], CHAT_SUMMARY_MAX_TOKENS)
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    for turn in turns:
+        messages.append({"role": "user", "content": turn["message"]})
+        messages.append({"role": "assistant", "content": turn["response"]})
+    messages.append({"role": "user", "content": message})
+    return messages
+
+async def summarize_thread(thread_id: str):
+    """Fold turns that left the verbatim window into the thread's running summary"""
+    thread = await db.chat_threads.find_one({"thread_id": thread_id})
+    if not thread:
+        return
+    summarized_until = thread.get("summarized_until", 0)
+    upto = thread.get("turn_count", 0) - CHAT_VERBATIM_TURNS
+    if upto - summarized_until < CHAT_SUMMARY_BATCH:
+        return
+    
+    turns = await db.chat_history.find(
+        {"thread_id": thread_id, "seq": {"$gt": summarized_until, "$lte": upto}},
+        {"_id": 0, "message": 1, "response": 1}
+    ).sort("seq", ASCENDING).to_list(None)
+    transcript = "\n".join(f"Student: {t['message']}\nNova: {t['response']}" for t in turns)
+    
+    summary = await llm_chat(
+        "chat_summary",
+        thread["user_id"],
+        [
+            {"role": "system", "content": (
+                "Maintain a running summary of a tutoring conversation. Keep the topics covered, "
+                "what the student understood or struggled with, and open questions. "
+                f"Stay under {CHAT_SUMMARY_MAX_TOKENS * 3 // 4} words."
+            )},
+            {"role": "user", "content": f"Current summary:\n{thread.get('summary') or '(none)'}\n\nNew turns:\n{transcript}"}
+        ],
+        max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+        temperature=0.2
+    )
+    
+    # Conditional on summarized_until so concurrent summarizers cannot overwrite each other
+    await db.chat_threads.update_one(
+        {"thread_id": thread_id, "summarized_until": summarized_until},
+        {"$set": {
+            "summary": truncate_to_tokens(summary, CHAT_SUMMARY_MAX_TOKENS),
+            "summarized_until": upto,
+            "summarized_at": datetime.utcnow()
+        }}
+    )
+
+def schedule_thread_summary(thread_id: str):
+    async def run():
+        try:
+            await summarize_thread(thread_id)
+        except Exception as e:
+            logger.error(f"Chat summary error for thread {thread_id}: {e}")
+    
+    task = asyncio.create_task(run())
+    summary_tasks.add(task)
+    task.add_done_callback(summary_tasks.discard)
+
+@api_router.post("/ai/chat")
+async def chat_with_ai(chat: ChatMessage, current_user = Depends(enforce_ai_limits)):
+    user_id = current_user["user_id"]
+    try:
+        if not LLM_ENABLED:
+            llm_metrics.count("/ai/chat", "disabled")
+            return {
+                "response": "I'm Nova, your learning assistant! I'm here to help you understand topics better. How can I assist you today?",
+                "success": False,
+                "error": "AI service not configured"
+            }
         
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": chat.message}
-        ]
+        if chat.thread_id:
+            thread = await db.chat_threads.find_one({"thread_id": chat.thread_id, "user_id": user_id})
+            if not thread:
+                raise HTTPException(status_code=404, detail="Chat thread not found")
+            turns = await load_recent_turns(thread)
+        else:
+            thread = {"thread_id": str(uuid.uuid4()), "summary": None, "summarized_until": 0}
+            turns = []
         
-        if chat.context:
-            messages.insert(1, {"role": "system", "content": f"Context: {chat.context}"})
+        snippets, context_ids = [], []
+        if chat.microcontent_id or chat.subtopic_id:
+            snippets, context_ids = await retrieve_chat_context(chat.message, chat.microcontent_id, chat.subtopic_id)
+        elif chat.context:
+            # Client-supplied context is still honoured, but held to the same budget
+            snippets = [truncate_to_tokens(chat.context, CHAT_CONTEXT_TOKEN_BUDGET)]
         
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
+        ai_response = await llm_chat(
+            "/ai/chat",
+            user_id,
+            build_chat_messages(chat.message, snippets, thread, turns),
             max_tokens=300,
             temperature=0.7
         )
         
-        ai_response = response.choices[0].message.content
+        now = datetime.utcnow()
+        thread = await db.chat_threads.find_one_and_update(
+            {"thread_id": thread["thread_id"], "user_id": user_id},
+            {
+                "$inc": {"turn_count": 1},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"title": chat.message[:60], "summary": None, "summarized_until": 0, "created_at": now}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
         
         # Store conversation
         await db.chat_history.insert_one({
-            "user_id": current_user["user_id"],
+            "user_id": user_id,
+            "thread_id": thread["thread_id"],
+            "seq": thread["turn_count"],
             "message": chat.message,
             "response": ai_response,
             "context": chat.context,
-            "created_at": datetime.utcnow()
+            "context_ids": context_ids,
+            "created_at": now
         })
         
+        if thread["turn_count"] - CHAT_VERBATIM_TURNS - thread.get("summarized_until", 0) >= CHAT_SUMMARY_BATCH:
+            schedule_thread_summary(thread["thread_id"])
+        
         return {
             "response": ai_response,
+            "thread_id": thread["thread_id"],
             "success": True
         }
+    except HTTPException:
+        raise
+    except (LlmUnavailable, asyncio.TimeoutError):
+        return {
+            "response": "I'm having trouble connecting right now. Please try again in a moment!",
+            "success": False,
+            "error": "AI service temporarily unavailable"
+        }
     except Exception as e:
         logger.error(f"AI chat error: {e}")
         return {
@@ -895,6 +2427,49 @@ async def chat_with_ai(chat: ChatMessage, current_user = Depends(get_current_use
             "error": str(e)
         }
 
+@api_router.get("/ai/chat/threads")
+async def list_chat_threads(before: Optional[datetime] = None, limit: int = 20, current_user = Depends(get_current_user)):
+    """Most recently active threads first; pass the last thread's updated_at as `before` for the next page"""
+    limit = max(1, min(limit, 50))
+    query: Dict[str, Any] = {"user_id": current_user["user_id"]}
+    if before:
+        query["updated_at"] = {"$lt": before}
+    
+    threads = await db.chat_threads.find(
+        query,
+        {"_id": 0, "thread_id": 1, "title": 1, "turn_count": 1, "created_at": 1, "updated_at": 1}
+    ).sort("updated_at", DESCENDING).limit(limit).to_list(limit)
+    
+    return {
+        "threads": threads,
+        "next_before": threads[-1]["updated_at"] if len(threads) == limit else None
+    }
+
+@api_router.get("/ai/chat/threads/{thread_id}/messages")
+async def get_chat_thread_messages(thread_id: str, before: Optional[int] = None, limit: int = 20, current_user = Depends(get_current_user)):
+    """Turns of a thread, newest first; pass `next_before` back as `before` to page further"""
+    limit = max(1, min(limit, 100))
+    thread = await db.chat_threads.find_one(
+        {"thread_id": thread_id, "user_id": current_user["user_id"]},
+        {"_id": 0, "thread_id": 1, "title": 1, "turn_count": 1}
+    )
+    if not thread:
+        raise HTTPException(status_code=404, detail="Chat thread not found")
+    
+    query: Dict[str, Any] = {"thread_id": thread_id}
+    if before is not None:
+        query["seq"] = {"$lt": before}
+    messages = await db.chat_history.find(
+        query,
+        {"_id": 0, "seq": 1, "message": 1, "response": 1, "context_ids": 1, "created_at": 1}
+    ).sort("seq", DESCENDING).limit(limit).to_list(limit)
+    
+    return {
+        **thread,
+        "messages": messages,
+        "next_before": messages[-1]["seq"] if messages and messages[-1]["seq"] > 1 else None
+    }
+
 # ============================================================================
 # PARENT DASHBOARD ENDPOINTS
 # ============================================================================
@@ -917,15 +2492,20 @@ async def link_parent_to_student(request: ParentLinkRequest):
     return {"message": "Parent linked successfully"}
 
 @api_router.get("/parent/children")
+@query_budget(3)
 async def get_linked_children(current_user = Depends(get_current_user)):
     if current_user["role"] != "parent":
         raise HTTPException(status_code=403, detail="Only parents can access this")
     
     links = await db.parent_links.find({"parent_id": current_user["user_id"]}).to_list(10)
     
+    student_ids = [link["student_id"] for link in links]
+    students = await db.users.find({"user_id": {"$in": student_ids}}).to_list(len(student_ids))
+    students_by_id = {student["user_id"]: student for student in students}
+    
     children = []
-    for link in links:
-        student = await db.users.find_one({"user_id": link["student_id"]})
+    for student_id in student_ids:
+        student = students_by_id.get(student_id)
         if student:
             children.append({
                 "student_id": student["user_id"],
@@ -979,7 +2559,7 @@ async def get_student_dashboard_for_parent(student_id: str, current_user = Depen
         "strong_topics": [],
         "streak": student.get("streak", 0)
     }
-    insights = await get_ai_recommendations(student_id, performance_data)
+    insights = await get_ai_recommendations(student_id, performance_data, "/parent/student/{student_id}/dashboard")
     
     return {
         "student": {
@@ -1048,20 +2628,292 @@ async def request_account_deletion(current_user = Depends(get_current_user)):
         "deletion_date": (datetime.utcnow() + timedelta(days=30)).isoformat()
     }
 
+# Every collection holding a user's data, with the field that references the user.
+# New collections are appended at the end of the list.
+USER_DATA_COLLECTIONS = [
+    ("user_progress", "user_id"),
+    ("topic_progress", "user_id"),
+    ("subtopic_progress", "user_id"),
+    ("quiz_responses", "user_id"),
+    ("quiz_results", "user_id"),
+    ("quiz_attempts", "user_id"),
+    ("daily_challenges", "user_id"),
+    ("onboarding_responses", "user_id"),
+    ("user_activity", "user_id"),
+    ("feedback", "user_id"),
+    ("flagged_questions", "user_id"),
+    ("chat_history", "user_id"),
+    ("group_members", "user_id"),
+    ("group_messages", "user_id"),
+    ("study_groups", "created_by"),
+    ("parent_links", "parent_id"),
+    ("parent_links", "student_id"),
+    ("privacy_settings", "user_id"),
+    ("otps", "user_id"),
+    ("sync_events", "user_id"),
+    ("llm_usage_daily", "user_id"),
+    ("chat_threads", "user_id"),
+]
+
+EXPORT_DIR = Path(os.environ.get("EXPORT_DIR", str(ROOT_DIR / "exports")))
+EXPORT_CONCURRENCY = int(os.environ.get("EXPORT_CONCURRENCY", "2"))
+EXPORT_BATCH_SIZE = 500
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+export_semaphore = asyncio.Semaphore(EXPORT_CONCURRENCY)
+export_tasks = set()
+
+def export_path(job_id: str) -> Path:
+    return EXPORT_DIR / f"{job_id}.ndjson.gz"
+
+async def run_export_job(job_id: str, user_id: str):
+    """Stream every collection for a user into a gzipped NDJSON file on disk"""
+    async with export_semaphore:
+        await db.export_jobs.update_one(
+            {"job_id": job_id},
+            {"$set": {"status": "running", "started_at": datetime.utcnow()}}
+        )
+        EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = export_path(job_id).with_suffix(".tmp")
+        records = 0
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as out:
+                sources = [("users", "user_id", {"password": 0, "xp_segments": 0})]
+                sources += [(name, field, None) for name, field in USER_DATA_COLLECTIONS]
+                for collection, field, projection in sources:
+                    cursor = db[collection].find({field: user_id}, projection, batch_size=EXPORT_BATCH_SIZE)
+                    lines = []
+                    async for doc in cursor:
+                        lines.append(json.dumps({"collection": collection, "document": doc}, default=str))
+                        if len(lines) >= EXPORT_BATCH_SIZE:
+                            await asyncio.to_thread(out.write, "\n".join(lines) + "\n")
+                            records += len(lines)
+                            lines = []
+                    if lines:
+                        await asyncio.to_thread(out.write, "\n".join(lines) + "\n")
+                        records += len(lines)
+            tmp_path.rename(export_path(job_id))
+            
+            await db.export_jobs.update_one(
+                {"job_id": job_id},
+                {"$set": {
+                    "status": "ready",
+                    "records": records,
+                    "size": export_path(job_id).stat().st_size,
+                    "finished_at": datetime.utcnow()
+                }}
+            )
+        except Exception as e:
+            logger.error(f"Data export {job_id} failed: {e}")
+            tmp_path.unlink(missing_ok=True)
+            await db.export_jobs.update_one(
+                {"job_id": job_id},
+                {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.utcnow()}}
+            )
+
+def export_job_response(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "records": job.get("records"),
+        "size": job.get("size"),
+        "created_at": job["created_at"].isoformat(),
+        "download_url": f"/api/privacy/export-data/{job['job_id']}/download" if job["status"] == "ready" else None
+    }
+
 @api_router.get("/privacy/export-data")
 async def export_user_data(current_user = Depends(get_current_user)):
+    """Start a background export of all the user's data and return its job id"""
     user_id = current_user["user_id"]
     
-    # Collect all user data
-    user_data = {
-        "user_info": current_user,
-        "progress": await db.user_progress.find({"user_id": user_id}).to_list(1000),
-        "quiz_responses": await db.quiz_responses.find({"user_id": user_id}).to_list(1000),
-        "feedback": await db.feedback.find({"user_id": user_id}).to_list(1000),
-        "chat_history": await db.chat_history.find({"user_id": user_id}).to_list(1000)
+    # Reuse an export that is still being produced (unless its worker died long ago)
+    active = await db.export_jobs.find_one({
+        "user_id": user_id,
+        "status": {"$in": ["queued", "running"]},
+        "created_at": {"$gte": datetime.utcnow() - timedelta(hours=1)}
+    })
+    if active:
+        return export_job_response(active)
+    
+    # Only the latest export is kept on disk
+    previous = await db.export_jobs.find({"user_id": user_id}, {"job_id": 1}).to_list(100)
+    for job in previous:
+        export_path(job["job_id"]).unlink(missing_ok=True)
+    await db.export_jobs.delete_many({"user_id": user_id})
+    
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "status": "queued",
+        "created_at": datetime.utcnow()
+    }
+    await db.export_jobs.insert_one(job)
+    
+    task = asyncio.create_task(run_export_job(job["job_id"], user_id))
+    export_tasks.add(task)
+    task.add_done_callback(export_tasks.discard)
+    
+    return export_job_response(job)
+
+@api_router.get("/privacy/export-data/{job_id}")
+async def get_export_status(job_id: str, current_user = Depends(get_current_user)):
+    job = await db.export_jobs.find_one({"job_id": job_id, "user_id": current_user["user_id"]})
+    if not job:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return export_job_response(job)
+
+def parse_byte_range(range_header: str, size: int):
+    """Parse a single-range `bytes=` header into inclusive (start, end), or None if unsatisfiable"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+def iter_file_range(path: Path, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+@api_router.get("/privacy/export-data/{job_id}/download")
+async def download_export(job_id: str, range: Optional[str] = Header(None), current_user = Depends(get_current_user)):
+    """Serve a finished export, honouring HTTP Range requests for resumable downloads"""
+    job = await db.export_jobs.find_one({"job_id": job_id, "user_id": current_user["user_id"]})
+    if not job:
+        raise HTTPException(status_code=404, detail="Export not found")
+    path = export_path(job_id)
+    if job["status"] != "ready" or not path.exists():
+        raise HTTPException(status_code=409, detail="Export is not ready")
+    
+    size = path.stat().st_size
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="ailo-export-{job_id}.ndjson.gz"'
     }
     
-    return user_data
+    if range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(iter_file_range(path, 0, size - 1), media_type="application/gzip", headers=headers)
+    
+    byte_range = parse_byte_range(range, size)
+    if byte_range is None:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file_range(path, start, end),
+        status_code=206,
+        media_type="application/gzip",
+        headers=headers
+    )
+
+# ============================================================================
+# ACCOUNT PURGE
+# ============================================================================
+
+ACCOUNT_DELETION_GRACE = timedelta(days=30)
+PURGE_ENABLED = os.environ.get("PURGE_ENABLED", "true").lower() in ("1", "true", "yes")
+PURGE_HOUR_UTC = int(os.environ.get("PURGE_HOUR_UTC", "2"))
+PURGE_BATCH_SIZE = int(os.environ.get("PURGE_BATCH_SIZE", "500"))
+PURGE_MAX_DOCS_PER_SECOND = float(os.environ.get("PURGE_MAX_DOCS_PER_SECOND", "2000"))
+
+# Groups outlive their creator; only the reference to the deleted user is removed
+PURGE_DETACH_COLLECTIONS = {"study_groups"}
+
+async def purge_user_collection(user_id: str, collection: str, field: str) -> int:
+    """Delete one user's documents from a collection in bounded, rate-limited batches"""
+    if collection in PURGE_DETACH_COLLECTIONS:
+        result = await db[collection].update_many({field: user_id}, {"$set": {field: None}})
+        return result.modified_count
+    
+    deleted = 0
+    while True:
+        started = asyncio.get_running_loop().time()
+        batch = await db[collection].find({field: user_id}, {"_id": 1}).limit(PURGE_BATCH_SIZE).to_list(PURGE_BATCH_SIZE)
+        if not batch:
+            return deleted
+        result = await db[collection].delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        deleted += result.deleted_count
+        
+        # Keep the delete rate under the configured budget
+        elapsed = asyncio.get_running_loop().time() - started
+        await asyncio.sleep(max(0.0, len(batch) / PURGE_MAX_DOCS_PER_SECOND - elapsed))
+
+async def purge_user(user_id: str) -> int:
+    """Hard-delete all of a user's data, skipping collections a previous run finished"""
+    checkpoint = await db.purge_checkpoints.find_one_and_update(
+        {"_id": user_id},
+        {"$setOnInsert": {"done": [], "deleted": 0, "started_at": datetime.utcnow()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    deleted = checkpoint["deleted"]
+    # Finished collections are recorded by name, so the list can change between runs.
+    # Older checkpoints only stored a position and start over; deletes are idempotent.
+    done = set(checkpoint.get("done", []))
+    
+    # Exports live on disk as well as in export_jobs
+    for job in await db.export_jobs.find({"user_id": user_id}, {"job_id": 1}).to_list(100):
+        export_path(job["job_id"]).unlink(missing_ok=True)
+    await db.export_jobs.delete_many({"user_id": user_id})
+    
+    for collection, field in USER_DATA_COLLECTIONS:
+        step = f"{collection}.{field}"
+        if step in done:
+            continue
+        deleted += await purge_user_collection(user_id, collection, field)
+        await db.purge_checkpoints.update_one(
+            {"_id": user_id},
+            {"$addToSet": {"done": step}, "$set": {"deleted": deleted, "updated_at": datetime.utcnow()}}
+        )
+    
+    # The account itself goes last so an interrupted purge is found again next run
+    await db.users.delete_one({"user_id": user_id, "status": "pending_deletion"})
+    await db.purge_checkpoints.delete_one({"_id": user_id})
+    return deleted
+
+async def purge_deleted_accounts() -> Dict[str, int]:
+    """Purge every account whose deletion grace period has ended"""
+    cutoff = datetime.utcnow() - ACCOUNT_DELETION_GRACE
+    purged = set()
+    accounts = documents = 0
+
+    # Purges are slow, so no cursor is held across them: fetch a batch of ids, purge
+    # it, then query again. Purged accounts are gone, so each query finds the next batch.
+    while True:
+        batch = await db.users.find(
+            {"status": "pending_deletion", "deleted_at": {"$lt": cutoff}},
+            {"_id": 0, "user_id": 1}
+        ).hint("pending_deletion").sort("deleted_at", ASCENDING).limit(PURGE_BATCH_SIZE).to_list(PURGE_BATCH_SIZE)
+        user_ids = [user["user_id"] for user in batch if user["user_id"] not in purged]
+        if not user_ids:
+            break
+        for user_id in user_ids:
+            documents += await purge_user(user_id)
+            purged.add(user_id)
+            accounts += 1
+            logger.info(f"Purged account {user_id}")
+    return {"accounts": accounts, "documents": documents}
 
 # ============================================================================
 # SEED DATA ENDPOINT (Development Only)
@@ -1069,12 +2921,11 @@ async def export_user_data(current_user = Depends(get_current_user)):
 
 @api_router.post("/seed/data")
 async def seed_database():
-    """Seed database with sample chapters, topics, and quiz questions"""
+    """Seed database with sample chapters, topics, and quiz questions.
     
-    # Clear existing data
-    await db.chapters.delete_many({})
-    await db.topics.delete_many({})
-    await db.quiz_questions.delete_many({})
+    The seed is published as a new content version cloned from the live one, so
+    existing content is kept and readers see the samples only once it is switched over.
+    """
     
     # Seed Chapters
     chapters = [
@@ -1104,8 +2955,6 @@ async def seed_database():
         }
     ]
     
-    await db.chapters.insert_many(chapters)
-    
     # Seed Topics
     topics = [
         {
@@ -1142,8 +2991,6 @@ async def seed_database():
         }
     ]
     
-    await db.topics.insert_many(topics)
-    
     # Seed Quiz Questions
     questions = [
         {
@@ -1202,10 +3049,24 @@ async def seed_database():
         }
     ]
     
-    await db.quiz_questions.insert_many(questions)
+    async def build(draft):
+        # The draft is a copy of the live content; the samples are added to it by id
+        for collection, id_field, docs in [
+            ("chapters", "chapter_id", chapters),
+            ("topics", "topic_id", topics),
+            ("quiz_questions", "question_id", questions),
+        ]:
+            await draft[collection].bulk_write(
+                [UpdateOne({id_field: doc[id_field]}, {"$set": doc}, upsert=True) for doc in docs],
+                ordered=False
+            )
+    
+    version = await publish(db, build, note="seed data")
+    await refresh_content_version()
     
     return {
         "message": "Database seeded successfully",
+        "content_version": version,
         "chapters": len(chapters),
         "topics": len(topics),
         "questions": len(questions)
@@ -1221,12 +3082,12 @@ async def get_topic_subtopics(topic_id: str, current_user = Depends(get_current_
     user_id = current_user["user_id"]
     
     # Get topic info
-    topic = await db.topics.find_one({"topic_id": topic_id})
+    topic = await content.topics.find_one({"topic_id": topic_id})
     if not topic:
         raise HTTPException(status_code=404, detail="Topic not found")
     
     # Get all subtopics for this topic
-    subtopics = await db.subtopics.find({"topic_id": topic_id}).sort("order", ASCENDING).to_list(100)
+    subtopics = await content.subtopics.find({"topic_id": topic_id}).sort("order", ASCENDING).to_list(100)
     
     # Get user progress for subtopics
     subtopic_ids = [s["subtopic_id"] for s in subtopics]
@@ -1241,6 +3102,9 @@ async def get_topic_subtopics(topic_id: str, current_user = Depends(get_current_
     for subtopic in subtopics:
         subtopic_id = subtopic["subtopic_id"]
         progress = progress_map.get(subtopic_id, {})
+        pending = card_progress_buffer.get(user_id, subtopic_id)
+        if pending:
+            progress = {**progress, **pending}
         
         result.append({
             "subtopic_id": subtopic_id,
@@ -1269,15 +3133,15 @@ async def get_subtopic_microcontent(subtopic_id: str, current_user = Depends(get
     user_id = current_user["user_id"]
     
     # Get subtopic info
-    subtopic = await db.subtopics.find_one({"subtopic_id": subtopic_id})
+    subtopic = await content.subtopics.find_one({"subtopic_id": subtopic_id})
     if not subtopic:
         raise HTTPException(status_code=404, detail="Subtopic not found")
     
     # Get all microcontent for this subtopic
-    microcontent_list = await db.microcontent.find({"subtopic_id": subtopic_id}).sort("order", ASCENDING).to_list(100)
+    microcontent_list = await content.microcontent.find({"subtopic_id": subtopic_id}).sort("order", ASCENDING).to_list(100)
     
-    # Get user progress
-    progress = await db.subtopic_progress.find_one({
+    # Get user progress, preferring a position that has not been flushed yet
+    progress = card_progress_buffer.get(user_id, subtopic_id) or await db.subtopic_progress.find_one({
         "user_id": user_id,
         "subtopic_id": subtopic_id
     })
@@ -1318,76 +3182,70 @@ async def update_subtopic_progress(
     current_user = Depends(get_current_user)
 ):
     """Update user progress for a subtopic"""
-    user_id = current_user["user_id"]
-    
-    subtopic = await db.subtopics.find_one({"subtopic_id": subtopic_id})
+    subtopic = await get_subtopic_info(subtopic_id)
     if not subtopic:
         raise HTTPException(status_code=404, detail="Subtopic not found")
     
+    return await apply_subtopic_progress(current_user["user_id"], subtopic_id, subtopic, progress_data)
+
+
+async def apply_subtopic_progress(user_id: str, subtopic_id: str, subtopic: Dict[str, Any], progress_data: SubtopicProgressUpdate) -> Dict[str, Any]:
+    """Record a card position or a subtopic completion and apply its side effects"""
     total_cards = subtopic.get("microcontent_count", 0)
     progress_pct = (progress_data.current_card / total_cards * 100) if total_cards > 0 else 0
     
+    # Card swipes only move the position: buffer them and let the flusher coalesce
+    if not progress_data.completed:
+        card_progress_buffer.put(user_id, subtopic_id, {
+            "topic_id": subtopic["topic_id"],
+            "chapter_id": subtopic["chapter_id"],
+            "current_card": progress_data.current_card,
+            "progress": progress_pct,
+            "updated_at": datetime.utcnow()
+        })
+        return {
+            "message": "Progress updated",
+            "xp_earned": 0,
+            "topic_completed": False
+        }
+    
+    # A completion supersedes the buffered position for this subtopic
+    card_progress_buffer.discard(user_id, subtopic_id)
+    
     # Save subtopic progress
-    await db.subtopic_progress.update_one(
+    now = datetime.utcnow()
+    before = await db.subtopic_progress.find_one_and_update(
         {"user_id": user_id, "subtopic_id": subtopic_id},
         {"$set": {
             "topic_id": subtopic["topic_id"],
             "chapter_id": subtopic["chapter_id"],
             "current_card": progress_data.current_card,
             "progress": progress_pct,
-            "completed": progress_data.completed,
-            "completed_at": datetime.utcnow() if progress_data.completed else None,
-            "updated_at": datetime.utcnow()
+            "completed": True,
+            "completed_at": now,
+            "updated_at": now
         }},
-        upsert=True
+        projection={"completed": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
     )
     
-    xp_earned = 0
-    topic_completed = False
+    # Roll the completion up to the topic only when its state flips
+    was_completed = bool(before and before.get("completed", False))
+    topic_delta = await rollup_subtopic_completion(
+        user_id, subtopic_id, 1 - int(was_completed), rollup_chapter=False
+    )
+    topic_completed = topic_delta > 0
     
-    # Award XP if completed
-    if progress_data.completed:
-        xp_earned = 20
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$inc": {"xp": xp_earned}}
-        )
-        
-        # Check if all subtopics in this topic are completed
-        topic_id = subtopic["topic_id"]
-        all_subtopics = await db.subtopics.find({"topic_id": topic_id}).to_list(100)
-        all_subtopic_ids = [s["subtopic_id"] for s in all_subtopics]
-        
-        completed_subtopics = await db.subtopic_progress.count_documents({
-            "user_id": user_id,
-            "subtopic_id": {"$in": all_subtopic_ids},
-            "completed": True
-        })
-        
-        # If all subtopics completed, mark topic as complete and award bonus XP
-        if completed_subtopics == len(all_subtopics):
-            topic_completed = True
-            bonus_xp = 40
-            xp_earned += bonus_xp
-            
-            await db.topic_progress.update_one(
-                {"user_id": user_id, "topic_id": topic_id},
-                {"$set": {
-                    "chapter_id": subtopic["chapter_id"],
-                    "completed": True,
-                    "completed_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow()
-                }},
-                upsert=True
-            )
-            
-            await db.users.update_one(
-                {"user_id": user_id},
-                {"$inc": {"xp": bonus_xp}}
-            )
-        
-        # Update streak
-        await update_user_streak(user_id)
+    # Award XP, plus a bonus when this completion finished the whole topic
+    xp_earned = 20 + (40 if topic_completed else 0)
+    
+    # The remaining side effects are independent of each other
+    await asyncio.gather(
+        record_user_activity(user_id, xp_earned),
+        rollup_topic_completion(user_id, subtopic["topic_id"], topic_delta),
+        card_progress_buffer.flush_user(user_id)
+    )
     
     return {
         "message": "Progress updated", 
@@ -1396,53 +3254,38 @@ async def update_subtopic_progress(
     }
 
 
-async def update_user_streak(user_id: str):
-    """Update user's learning streak"""
-    user = await db.users.find_one({"user_id": user_id})
-    if not user:
-        return
+def user_activity_update(xp: int = 0, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Pipeline update that awards XP and advances the learning streak in one write.
     
-    today = datetime.utcnow().date()
-    last_activity = user.get("last_activity_date")
+    The streak is computed server-side from last_activity_date: unchanged if the
+    user was already active today, +1 if last active yesterday, otherwise reset to 1.
+    """
+    now = now or datetime.utcnow()
+    today = datetime(now.year, now.month, now.day)
+    yesterday = today - timedelta(days=1)
+    active_today = {"$gte": ["$last_activity_date", today]}
     
-    if last_activity:
-        last_activity_date = last_activity.date() if isinstance(last_activity, datetime) else last_activity
-        days_diff = (today - last_activity_date).days
-        
-        if days_diff == 0:
-            # Same day, no change
-            return
-        elif days_diff == 1:
-            # Consecutive day, increment streak
-            await db.users.update_one(
-                {"user_id": user_id},
-                {
-                    "$inc": {"streak": 1},
-                    "$set": {"last_activity_date": datetime.utcnow()}
-                }
-            )
-        else:
-            # Streak broken, reset to 1
-            await db.users.update_one(
-                {"user_id": user_id},
-                {
-                    "$set": {
-                        "streak": 1,
-                        "last_activity_date": datetime.utcnow()
-                    }
-                }
-            )
-    else:
-        # First activity
-        await db.users.update_one(
-            {"user_id": user_id},
-            {
-                "$set": {
-                    "streak": 1,
-                    "last_activity_date": datetime.utcnow()
-                }
-            }
-        )
+    return [
+        {"$set": {
+            "streak": {"$switch": {
+                "branches": [
+                    {"case": active_today, "then": {"$ifNull": ["$streak", 1]}},
+                    {"case": {"$gte": ["$last_activity_date", yesterday]}, "then": {"$add": [{"$ifNull": ["$streak", 0]}, 1]}}
+                ],
+                "default": 1
+            }},
+            "last_activity_date": {"$cond": [active_today, "$last_activity_date", now]},
+            "xp": {"$add": [{"$ifNull": ["$xp", 0]}, xp]}
+        }}
+    ]
+
+async def record_user_activity(user_id: str, xp: int = 0):
+    """Award XP and update the user's learning streak.
+    
+    The award is journaled and handed to the XP aggregator, which applies XP,
+    streak and level for the user in one batched write.
+    """
+    await xp_aggregator.award(user_id, xp)
 
 
 @api_router.get("/subtopics/{subtopic_id}/quiz")
@@ -1450,7 +3293,7 @@ async def get_subtopic_quiz(subtopic_id: str, current_user = Depends(get_current
     """Get quiz questions for a completed subtopic"""
     
     # Get quiz questions for this subtopic
-    questions = await db.quiz_questions.find({"subtopic_id": subtopic_id}).to_list(100)
+    questions = await content.quiz_questions.find({"subtopic_id": subtopic_id}).to_list(100)
     
     # Select up to 5 questions
     selected_questions = random.sample(questions, min(5, len(questions))) if questions else []
@@ -1490,18 +3333,15 @@ async def submit_quiz(
     total_questions = len(submission.answers)
     
     for answer in submission.answers:
-        question = await db.quiz_questions.find_one({"question_id": answer["question_id"]})
+        question = await content.quiz_questions.find_one({"question_id": answer["question_id"]})
         if question and question["correct_answer"] == answer["user_answer"]:
             correct_count += 1
     
     score = (correct_count / total_questions * 100) if total_questions > 0 else 0
     xp_earned = correct_count * 5  # 5 XP per correct answer
     
-    # Update user XP
-    await db.users.update_one(
-        {"user_id": user_id},
-        {"$inc": {"xp": xp_earned}}
-    )
+    # Update user XP and streak
+    await record_user_activity(user_id, xp_earned)
     
     # Store quiz result
     await db.quiz_results.insert_one({
@@ -1529,15 +3369,16 @@ async def submit_quiz(
 # ============================================================================
 
 @api_router.get("/practice/dashboard")
+@query_budget(5)
 async def get_practice_dashboard(current_user = Depends(get_current_user)):
     """Get practice dashboard with stats and available quizzes"""
     user_id = current_user["user_id"]
     
-    # Get user stats
-    user = await db.users.find_one({"user_id": user_id})
+    # User stats come from the account get_current_user just loaded
+    user = current_user
     
     # Get quiz history
-    quiz_history = await db.quiz_attempts.find({"user_id": user_id}).sort("completed_at", DESCENDING).limit(10).to_list(10)
+    quiz_history = await db.quiz_attempts.find({"user_id": user_id}, {"_id": 0}).sort("completed_at", DESCENDING).limit(10).to_list(10)
     
     # Calculate stats
     total_quizzes = len(quiz_history)
@@ -1546,20 +3387,29 @@ async def get_practice_dashboard(current_user = Depends(get_current_user)):
     else:
         avg_score = 0
     
-    # Get chapter quizzes with user progress
-    chapter_quizzes = await db.chapter_quizzes.find({}).sort("chapter_number", ASCENDING).to_list(10)
+    # Get chapter quizzes with user progress; every chapter is listed
+    chapter_quizzes = await db.chapter_quizzes.find({}, {"_id": 0}).sort("chapter_number", ASCENDING).to_list(None)
+    
+    # Best attempt and attempt count of every quiz in one aggregation
+    attempts_by_quiz = {
+        doc["_id"]: doc
+        async for doc in db.quiz_attempts.aggregate([
+            {"$match": {"user_id": user_id}},
+            {"$sort": {"score": DESCENDING}},
+            {"$group": {
+                "_id": "$quiz_id",
+                "best_score": {"$first": "$score"},
+                "last_attempted": {"$first": "$completed_at"},
+                "attempts": {"$sum": 1}
+            }}
+        ])
+    }
     
     for quiz in chapter_quizzes:
-        # Get best attempt for this quiz
-        best_attempt = await db.quiz_attempts.find_one(
-            {"user_id": user_id, "quiz_id": quiz["quiz_id"]},
-            sort=[("score", DESCENDING)]
-        )
-        quiz["best_score"] = best_attempt.get("score", 0) if best_attempt else None
-        quiz["attempts"] = await db.quiz_attempts.count_documents(
-            {"user_id": user_id, "quiz_id": quiz["quiz_id"]}
-        )
-        quiz["last_attempted"] = best_attempt.get("completed_at") if best_attempt else None
+        attempts = attempts_by_quiz.get(quiz["quiz_id"])
+        quiz["best_score"] = attempts.get("best_score", 0) if attempts else None
+        quiz["attempts"] = attempts["attempts"] if attempts else 0
+        quiz["last_attempted"] = attempts.get("last_attempted") if attempts else None
         quiz["completed"] = quiz["best_score"] is not None and quiz["best_score"] >= 70
     
     # Get daily challenge status
@@ -1671,15 +3521,6 @@ async def submit_practice_quiz(submission: QuizSubmission, current_user = Depend
     score = (correct_count / total_questions * 100) if total_questions > 0 else 0
     xp_earned = int(correct_count * 10)
     
-    # Award XP
-    await db.users.update_one(
-        {"user_id": user_id},
-        {"$inc": {"xp": xp_earned}}
-    )
-    
-    # Update streak
-    await update_user_streak(user_id)
-    
     # Save quiz attempt
     attempt = {
         "attempt_id": str(uuid.uuid4()),
@@ -1693,7 +3534,12 @@ async def submit_practice_quiz(submission: QuizSubmission, current_user = Depend
         "time_taken": submission.time_taken,
         "completed_at": datetime.utcnow()
     }
+    
+    # The award is journaled before the attempt is written, so a crash in between can
+    # leave XP without its attempt but never an attempt whose XP was lost
+    await record_user_activity(user_id, xp_earned)
     await db.quiz_attempts.insert_one(attempt)
+    attempt.pop("_id", None)
     
     return {
         "score": round(score, 1),
@@ -1854,6 +3700,314 @@ async def get_daily_challenge(current_user = Depends(get_current_user)):
     }
 
 
+# ============================================================================
+# OFFLINE SYNC ENDPOINTS
+# ============================================================================
+
+class SyncCardProgress(SubtopicProgressUpdate):
+    subtopic_id: str
+
+class SyncQuizAnswer(QuizBatchAnswer):
+    quiz_id: str
+
+SYNC_EVENT_MODELS = {
+    "onboarding_answer": OnboardingQuizResponse,
+    "card_progress": SyncCardProgress,
+    "quiz_answer": SyncQuizAnswer,
+    "feedback": Feedback,
+}
+
+SYNC_CLAIM_LEASE_SECONDS = int(os.environ.get("SYNC_CLAIM_LEASE_SECONDS", "120"))
+
+async def claim_sync_events(user_id: str, events: List[SyncEvent]) -> Dict[str, Dict[str, Any]]:
+    """Record idempotency keys, as pending claims with a lease, before applying events.
+    
+    Returns the stored documents of keys that were already claimed by an earlier sync.
+    A pending claim whose lease ran out belonged to a sync that died before finishing;
+    it is taken over here and the event is applied again.
+    """
+    now = datetime.utcnow()
+    lease_until = now + timedelta(seconds=SYNC_CLAIM_LEASE_SECONDS)
+    try:
+        await db.sync_events.insert_many(
+            [
+                {
+                    "_id": f"{user_id}:{event.idempotency_key}",
+                    "user_id": user_id,
+                    "type": event.type,
+                    "status": "pending",
+                    "lease_until": lease_until,
+                    "created_at": now
+                }
+                for event in events
+            ],
+            ordered=False
+        )
+        return {}
+    except BulkWriteError as e:
+        duplicate_ids = [
+            f"{user_id}:{events[err['index']].idempotency_key}"
+            for err in e.details.get("writeErrors", [])
+            if err.get("code") == 11000
+        ]
+        if len(duplicate_ids) != len(e.details.get("writeErrors", [])):
+            raise
+        claimed = await db.sync_events.find({"_id": {"$in": duplicate_ids}}).to_list(len(duplicate_ids))
+    
+    existing = {}
+    for doc in claimed:
+        if doc["status"] == "pending" and (doc.get("lease_until") or now) <= now:
+            taken = await db.sync_events.update_one(
+                {"_id": doc["_id"], "status": "pending", "lease_until": doc.get("lease_until")},
+                {"$set": {"lease_until": lease_until}}
+            )
+            if taken.modified_count:
+                continue
+            doc = await db.sync_events.find_one({"_id": doc["_id"]}) or doc
+        existing[doc["_id"].split(":", 1)[1]] = doc
+    return existing
+
+async def release_sync_claims(user_id: str, keys: List[str]):
+    """Drop pending claims so a retried upload applies those events"""
+    await db.sync_events.delete_many({
+        "_id": {"$in": [f"{user_id}:{key}" for key in keys]},
+        "status": "pending"
+    })
+
+async def apply_sync_events(user_id: str, event_type: str, events: List[Tuple[SyncEvent, Any]]) -> List[Dict[str, Any]]:
+    """Apply a run of consecutive events of one type and return their results in order"""
+    now = datetime.utcnow()
+    
+    # Onboarding answers and feedback: one insert_many each
+    if event_type == "onboarding_answer":
+        await db.onboarding_responses.insert_many([
+            {
+                "user_id": user_id,
+                "question_id": answer.question_id,
+                "answer": answer.answer,
+                "created_at": event.client_ts or now
+            }
+            for event, answer in events
+        ])
+        return [{"status": "applied"} for _ in events]
+    
+    if event_type == "feedback":
+        await db.feedback.insert_many([feedback_document(user_id, feedback) for _, feedback in events])
+        return [{"status": "applied"} for _ in events]
+    
+    # Quiz answers: one question lookup, one insert_many and one XP award
+    if event_type == "quiz_answer":
+        question_ids = list({answer.question_id for _, answer in events})
+        questions = await content.quiz_questions.find({"question_id": {"$in": question_ids}}).to_list(len(question_ids))
+        questions_map = {q["question_id"]: q for q in questions}
+        
+        results: List[Dict[str, Any]] = []
+        responses = []
+        for event, answer in events:
+            question = questions_map.get(answer.question_id)
+            if question is None:
+                results.append({"status": "invalid", "error": "Question not found"})
+                continue
+            response = grade_quiz_answer(user_id, answer.quiz_id, answer, question, event.client_ts or now)
+            responses.append((len(results), response))
+            results.append(None)
+        
+        awarded = await store_quiz_responses(user_id, [response for _, response in responses])
+        xp_gained = sum(awarded.values())
+        for position, response in responses:
+            results[position] = {"status": "applied", "result": {
+                "is_correct": response["is_correct"],
+                "correct_answer": response["correct_answer"],
+                # Credit the award to one event when a batch repeats a question
+                "xp_gained": awarded.pop((response["quiz_id"], response["question_id"]), 0)
+            }}
+        if xp_gained:
+            await record_user_activity(user_id, xp_gained)
+        return results
+    
+    # Card progress: positions coalesce in the write-behind buffer, completions apply in order
+    results = []
+    for _, progress in events:
+        subtopic = await get_subtopic_info(progress.subtopic_id)
+        if not subtopic:
+            results.append({"status": "invalid", "error": "Subtopic not found"})
+            continue
+        outcome = await apply_subtopic_progress(user_id, progress.subtopic_id, subtopic, progress)
+        results.append({"status": "applied", "result": outcome})
+    return results
+
+@api_router.post("/sync")
+async def sync_offline_events(batch: SyncBatch, current_user = Depends(get_current_user)):
+    """Apply an ordered batch of queued client events, at most once per idempotency key"""
+    user_id = current_user["user_id"]
+    results: Dict[int, Dict[str, Any]] = {}
+    
+    # Validate payloads and drop keys repeated within the batch
+    parsed: Dict[int, Any] = {}
+    seen_keys = set()
+    for idx, event in enumerate(batch.events):
+        if event.idempotency_key in seen_keys:
+            results[idx] = {"status": "duplicate"}
+            continue
+        seen_keys.add(event.idempotency_key)
+        
+        model = SYNC_EVENT_MODELS.get(event.type)
+        if model is None:
+            results[idx] = {"status": "invalid", "error": f"Unknown event type: {event.type}"}
+            continue
+        try:
+            parsed[idx] = model(**event.payload)
+        except ValueError as e:
+            results[idx] = {"status": "invalid", "error": str(e)}
+    
+    # Claim the keys; events applied by an earlier upload are skipped, and events
+    # another upload is still applying are reported so the client retries them later
+    if parsed:
+        already_claimed = await claim_sync_events(user_id, [batch.events[idx] for idx in parsed])
+        for idx in list(parsed):
+            claimed = already_claimed.get(batch.events[idx].idempotency_key)
+            if claimed is None:
+                continue
+            if claimed["status"] == "pending":
+                results[idx] = {"status": "in_progress"}
+            else:
+                results[idx] = {"status": "duplicate", "result": claimed.get("result")}
+            del parsed[idx]
+    
+    # Apply in submitted order, batching runs of consecutive events of one type
+    runs: List[List[int]] = []
+    for idx in parsed:
+        if runs and batch.events[runs[-1][-1]].type == batch.events[idx].type:
+            runs[-1].append(idx)
+        else:
+            runs.append([idx])
+    
+    for position, run in enumerate(runs):
+        try:
+            outcomes = await apply_sync_events(
+                user_id, batch.events[run[0]].type, [(batch.events[idx], parsed[idx]) for idx in run]
+            )
+        except Exception:
+            # Later events may depend on this run, so none of them count as applied
+            await release_sync_claims(user_id, [
+                batch.events[idx].idempotency_key for unapplied in runs[position:] for idx in unapplied
+            ])
+            raise
+        results.update(zip(run, outcomes))
+        
+        # Store outcomes so retried uploads get the same answer
+        await db.sync_events.bulk_write([
+            UpdateOne(
+                {"_id": f"{user_id}:{batch.events[idx].idempotency_key}"},
+                {
+                    "$set": {"status": results[idx]["status"], "result": results[idx].get("result")},
+                    "$unset": {"lease_until": ""}
+                }
+            )
+            for idx in run
+        ], ordered=False)
+    
+    return {
+        "results": [
+            {"idempotency_key": event.idempotency_key, **results[idx]}
+            for idx, event in enumerate(batch.events)
+        ]
+    }
+
+# ============================================================================
+# SCHEDULED JOBS
+# ============================================================================
+
+STREAK_DECAY_ENABLED = os.environ.get("STREAK_DECAY_ENABLED", "true").lower() in ("1", "true", "yes")
+STREAK_DECAY_HOUR_UTC = int(os.environ.get("STREAK_DECAY_HOUR_UTC", "0"))
+STREAK_DECAY_BATCH_SIZE = int(os.environ.get("STREAK_DECAY_BATCH_SIZE", "1000"))
+STREAK_DECAY_PAUSE_SECONDS = float(os.environ.get("STREAK_DECAY_PAUSE_SECONDS", "0.2"))
+
+background_tasks: List[asyncio.Task] = []
+
+async def ensure_indexes():
+    """Create the indexes the API and background jobs rely on"""
+    # Idempotency keys only need to outlive a device's offline window
+    await db.sync_events.create_index("created_at", expireAfterSeconds=30 * 24 * 3600)
+    # Per-user lookups, exports and purges filter every user-data collection by user
+    for collection, field in USER_DATA_COLLECTIONS:
+        await db[collection].create_index(field)
+    await db.users.create_index(
+        [("deleted_at", ASCENDING)],
+        name="pending_deletion",
+        partialFilterExpression={"status": "pending_deletion"}
+    )
+    # Only users with a live streak are indexed, so the decay scan never touches inactive users
+    await db.users.create_index(
+        [("last_activity_date", ASCENDING)],
+        name="streak_decay",
+        partialFilterExpression={"streak": {"$gt": 0}}
+    )
+    await db.chat_history.create_index([("thread_id", ASCENDING), ("seq", DESCENDING)])
+    await db.chat_threads.create_index([("user_id", ASCENDING), ("updated_at", DESCENDING)])
+    await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+    await db.llm_usage_daily.create_index([("day", ASCENDING), ("endpoint", ASCENDING), ("user_id", ASCENDING), ("model", ASCENDING)])
+    await db.quiz_responses.create_index([("user_id", ASCENDING), ("quiz_id", ASCENDING), ("question_id", ASCENDING)])
+
+async def acquire_job_lease(job_name: str, ttl: timedelta) -> bool:
+    """Take a time-bounded lease so only one worker runs a scheduled job"""
+    now = datetime.utcnow()
+    try:
+        await db.job_leases.update_one(
+            {"_id": job_name, "expires_at": {"$lt": now}},
+            {"$set": {"expires_at": now + ttl, "acquired_at": now}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease
+        return False
+
+async def run_nightly(job_name: str, hour_utc: int, job):
+    """Run `job` once a day at hour_utc on whichever worker gets the lease"""
+    while True:
+        now = datetime.utcnow()
+        next_run = now.replace(hour=hour_utc, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        
+        if not await acquire_job_lease(job_name, timedelta(hours=23)):
+            continue
+        try:
+            started = datetime.utcnow()
+            result = await job()
+            logger.info(f"{job_name} finished in {(datetime.utcnow() - started).total_seconds():.1f}s: {result}")
+        except Exception as e:
+            logger.error(f"{job_name} failed: {e}")
+
+async def decay_lapsed_streaks(batch_size: int = STREAK_DECAY_BATCH_SIZE, pause: float = STREAK_DECAY_PAUSE_SECONDS) -> int:
+    """Reset the streak of every user whose last activity was before yesterday.
+    
+    Users are fetched through the partial streak_decay index in chunks and reset
+    with unordered bulk writes, sleeping `pause` seconds between chunks. Reset
+    users drop out of the index, so each chunk just takes the next batch.
+    """
+    now = datetime.utcnow()
+    cutoff = datetime(now.year, now.month, now.day) - timedelta(days=1)
+    query = {"streak": {"$gt": 0}, "last_activity_date": {"$lt": cutoff}}
+    
+    total_reset = 0
+    while True:
+        lapsed = await db.users.find(query, {"_id": 1}).hint("streak_decay").limit(batch_size).to_list(batch_size)
+        if not lapsed:
+            break
+        
+        # Re-check the condition per user so activity since the scan is never clobbered
+        result = await db.users.bulk_write(
+            [UpdateOne({"_id": u["_id"], **query}, {"$set": {"streak": 0}}) for u in lapsed],
+            ordered=False
+        )
+        total_reset += result.modified_count
+        await asyncio.sleep(pause)
+    
+    return total_reset
+
 # Include router
 app.include_router(api_router)
 
@@ -1865,6 +4019,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so the recorded latency covers CORS and every other middleware
+app.add_middleware(
+    RequestMetricsMiddleware,
+    registry=metrics_registry,
+    budget_mode=QUERY_BUDGET_MODE,
+    repeat_threshold=QUERY_REPEAT_THRESHOLD,
+)
+
+@app.on_event("startup")
+async def start_background_workers():
+    await ensure_indexes()
+    await refresh_content_version()
+    await content_search.ensure_current()
+    background_tasks.append(asyncio.create_task(watch_content_version()))
+    card_progress_buffer.start()
+    xp_aggregator.start()
+    llm_metrics.rollup.start()
+    if STREAK_DECAY_ENABLED:
+        background_tasks.append(asyncio.create_task(
+            run_nightly("streak_decay", STREAK_DECAY_HOUR_UTC, decay_lapsed_streaks)
+        ))
+    if PURGE_ENABLED:
+        background_tasks.append(asyncio.create_task(
+            run_nightly("account_purge", PURGE_HOUR_UTC, purge_deleted_accounts)
+        ))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks + list(summary_tasks):
+        task.cancel()
+    await card_progress_buffer.stop()
+    await xp_aggregator.stop()
+    await llm_metrics.rollup.stop()
     client.close()
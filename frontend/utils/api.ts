@@ -51,12 +51,16 @@ export const learningAPI = {
     api.post('/quiz/submit', { quiz_id: quizId, subtopic_id: subtopicId, answers }),
   updateProgress: (topicId: string, progress: number, position: number) =>
     api.post(`/topics/${topicId}/progress`, { progress, position }),
+  search: (q: string, types?: string[], limit: number = 20) =>
+    api.get('/search', { params: { q, limit, types: types?.join(',') } }),
 };
 
 export const quizAPI = {
   getDailyChallenge: () => api.get('/quizzes/daily-challenge'),
   getChapterQuiz: (chapterId: string) => api.get(`/quizzes/chapter/${chapterId}`),
   submitAnswer: (data: any) => api.post('/quizzes/submit', data),
+  submitBatch: (quizId: string, answers: any[]) =>
+    api.post('/quizzes/submit-batch', { quiz_id: quizId, answers }),
   getResults: (quizId: string) => api.get(`/quizzes/${quizId}/results`),
 };
 
@@ -77,6 +81,11 @@ export const feedbackAPI = {
 
 export const aiAPI = {
   chat: (message: string, context?: string) => api.post('/ai/chat', { message, context }),
+  chatAboutContent: (message: string, ids: { microcontent_id?: string; subtopic_id?: string; thread_id?: string }) =>
+    api.post('/ai/chat', { message, ...ids }),
+  getThreads: (before?: string) => api.get('/ai/chat/threads', { params: { before } }),
+  getThreadMessages: (threadId: string, before?: number) =>
+    api.get(`/ai/chat/threads/${threadId}/messages`, { params: { before } }),
 };
 
 export const parentAPI = {
@@ -90,6 +99,11 @@ export const privacyAPI = {
   updateSettings: (settings: any) => api.post('/privacy/settings', settings),
   deleteAccount: () => api.post('/privacy/delete-account'),
   exportData: () => api.get('/privacy/export-data'),
+  getExportStatus: (jobId: string) => api.get(`/privacy/export-data/${jobId}`),
+};
+
+export const syncAPI = {
+  uploadEvents: (events: any[]) => api.post('/sync', { events }),
 };
 
 export const seedAPI = {
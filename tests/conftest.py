@@ -0,0 +1,36 @@
+"""Shared fixtures: the backend module runs against an in-memory Mongo (mongomock)"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def database():
+    from mongomock_motor import AsyncMongoMockClient
+
+    return AsyncMongoMockClient()["ailo_test"]
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path, database):
+    """The server module with its database, content view and in-process state replaced"""
+    import server as module
+    from content_versions import ContentNamespace
+
+    monkeypatch.setattr(module, "db", database)
+    monkeypatch.setattr(module, "content", ContentNamespace(database))
+    monkeypatch.setattr(module, "catalog", module.ContentCatalog())
+    monkeypatch.setattr(module, "LLM_ENABLED", False)
+    monkeypatch.setattr(module, "xp_aggregator", module.XpAggregator("XP aggregator", 60, tmp_path / "xp_journal", False))
+    return module
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+MESSAGES = [{"role": "user", "content": "Explain fractions"}]
+
+
+@pytest.fixture
+def llm(server, monkeypatch):
+    monkeypatch.setattr(server, "llm_metrics", server.LlmMetrics(server.LlmUsageRollup("LLM usage rollup", 60)))
+    monkeypatch.setattr(server, "llm_single_flight", server.SingleFlight())
+
+    async def upstream(endpoint, user_id, messages, model, **kwargs):
+        await asyncio.sleep(0.02)
+        server.llm_metrics.record(endpoint, user_id, model, "ok", 0.02, 60, 40)
+        return "answer", 100
+
+    monkeypatch.setattr(server, "llm_complete", upstream)
+    return server
+
+
+async def test_coalesced_callers_are_each_charged_against_their_quota(llm):
+    server = llm
+    replies = await asyncio.gather(*(server.llm_chat("/ai/chat", f"u{n}", MESSAGES) for n in range(3)))
+    assert replies == ["answer"] * 3
+
+    await server.llm_metrics.rollup.flush()
+    assert [await server.llm_tokens_used_today(f"u{n}") for n in range(3)] == [100, 100, 100]
+
+    # Spend is only recorded once, for the caller that made the upstream call
+    usage = await server.db.llm_usage_daily.find({}).to_list(None)
+    assert sum(row.get("cost_usd", 0) > 0 for row in usage) == 1
+    assert sum(row.get("calls", 0) for row in usage) == 1
+
+
+async def test_per_ip_limit_is_off_by_default(server):
+    assert server.AI_IP_RATE_PER_MINUTE == 0
+    assert server.ai_ip_buckets is None
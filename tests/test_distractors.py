@@ -0,0 +1,51 @@
+import random
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def distractors():
+    import distractors as module
+    return module
+
+
+def dense(entries, count, width):
+    rows, terms, weights = entries
+    matrix = np.zeros((count, width))
+    matrix[rows, terms] = weights
+    return matrix
+
+
+def test_cosine_blocks_match_the_dense_product(distractors):
+    rng = random.Random(7)
+    words = [f"w{n}" for n in range(40)]
+    documents = [rng.choices(words, k=rng.randint(0, 8)) for _ in range(60)]
+    rows, terms, weights = distractors.tfidf_vectors(documents)
+    width = terms.max() + 1
+
+    queries = (rows[rows < 45], terms[rows < 45], weights[rows < 45])
+    candidates = (rows[rows >= 45] - 45, terms[rows >= 45], weights[rows >= 45])
+    expected = dense(queries, 45, width) @ dense(candidates, 15, width).T
+
+    # Tiny limits force many blocks, including single rows over the pair limit
+    blocks = list(distractors.cosine_blocks(queries, candidates, 45, 15, max_rows=4, max_pairs=10))
+    assert len(blocks) > 10
+    actual = np.vstack([block for _, block in blocks])
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_distractors_prefer_other_subtopics_and_never_repeat_the_answer(distractors):
+    questions = [
+        {"question_text": "What does a Python list store?", "correct_answer": "An ordered collection",
+         "chapter_id": "c1", "subtopic_id": "s1"},
+        {"question_text": "What does a Python set store?", "correct_answer": "An unordered collection",
+         "chapter_id": "c1", "subtopic_id": "s1"},
+        {"question_text": "What does a Python dict store?", "correct_answer": "Key value pairs",
+         "chapter_id": "c1", "subtopic_id": "s2"},
+    ]
+
+    mined = distractors.mine_distractors(questions, k=2, fallback=["None of these"])
+
+    assert mined[0] == ["Key value pairs", "An unordered collection"]
+    assert all(q["correct_answer"] not in picks for q, picks in zip(questions, mined))
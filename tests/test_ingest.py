@@ -0,0 +1,85 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def ingest_content():
+    import ingest_content as module
+    return module
+
+
+def row(ingest_content, **cells):
+    values = dict.fromkeys(ingest_content.COLUMNS)
+    values.update({
+        "Chapter_Name": "Unit 1: Python",
+        "Topic_Number": "1.1",
+        "Topic_Title": "Libraries",
+        "Subtopic_Title": "Definition of Libraries",
+        "Microcontent_ID": "1.1_MC1",
+        "Microcontent_Text": "A library is reusable code.",
+        "QA_Pair": "Q: What is a library? A: Reusable code",
+    })
+    values.update(cells)
+    return values
+
+
+async def test_reworded_titles_keep_their_ids(database, ingest_content):
+    await ingest_content.ingest_rows(database, [row(ingest_content, Subtopic_ID="libraries-definition")])
+    before = await database.subtopics.find_one({})
+
+    reworded = row(ingest_content, Topic_Title="Python Libraries", Subtopic_Title="What Libraries Are",
+                   Subtopic_ID="libraries-definition")
+    await ingest_content.ingest_rows(database, [reworded], prune=True)
+
+    after = await database.subtopics.find({}).to_list(None)
+    assert [doc["subtopic_id"] for doc in after] == [before["subtopic_id"]]
+    assert after[0]["title"] == "What Libraries Are"
+    assert after[0]["topic_id"] == before["topic_id"]
+
+
+async def test_inserted_and_reordered_rows_keep_subtopic_ids(ingest_content):
+    def subtopic_ids(titles):
+        builder = ingest_content.ContentBuilder()
+        for n, title in enumerate(titles, 1):
+            builder.add_row(row(ingest_content, Subtopic_Title=title, Microcontent_ID=f"1.1_MC{n}"))
+        return {doc["title"]: doc["subtopic_id"] for doc in builder.subtopics.values()}
+
+    before = subtopic_ids(["Definition of Libraries", "Role of NumPy"])
+    after = subtopic_ids(["Installing Libraries", "Role of NumPy", "Definition of Libraries"])
+    assert {title: after[title] for title in before} == before
+
+
+async def test_microcontent_without_numeric_suffix_keeps_row_order(ingest_content):
+    builder = ingest_content.ContentBuilder()
+    first, _ = builder.add_row(row(ingest_content, Microcontent_ID="1.1_intro"))
+    second, _ = builder.add_row(row(ingest_content, Microcontent_ID="1.1_MCa"))
+    assert (first["order"], second["order"]) == (1, 2)
+
+
+async def test_reingest_keeps_generated_questions(database, ingest_content):
+    await ingest_content.ingest_rows(database, [row(ingest_content)])
+    stored = await database.quiz_questions.find_one({})
+    await database.quiz_questions.update_one(
+        {"question_id": stored["question_id"]},
+        {"$set": {"question_text": "Generated?", "options": ["x", "y"], "generated_by": "v1"}}
+    )
+
+    stats = await ingest_content.ingest_rows(database, [row(ingest_content, QA_Pair="Q: Changed? A: Yes")], prune=True)
+
+    question = await database.quiz_questions.find_one({"question_id": stored["question_id"]})
+    assert question["question_text"] == "Generated?"
+    assert question["options"] == ["x", "y"]
+    assert stats["collections"]["quiz_questions"]["generated"] == 1
+
+
+async def test_xlsx_rows_are_read(tmp_path, ingest_content):
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    workbook.active.append(ingest_content.COLUMNS)
+    workbook.active.append([row(ingest_content, Topic_Number=1.1)[column] for column in ingest_content.COLUMNS])
+    workbook.save(tmp_path / "syllabus.xlsx")
+
+    rows = list(ingest_content.iter_rows(tmp_path / "syllabus.xlsx"))
+    assert rows == [row(ingest_content, Topic_Number="1.1")]
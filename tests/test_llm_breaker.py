@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+MESSAGES = [{"role": "user", "content": "Explain fractions"}]
+
+
+@pytest.fixture
+def llm(server, monkeypatch):
+    monkeypatch.setattr(server, "llm_breaker", server.CircuitBreaker("LLM", 2, 30))
+    monkeypatch.setattr(server, "llm_single_flight", server.SingleFlight())
+    monkeypatch.setattr(server, "llm_deadline", lambda endpoint: 0.05)
+    return server
+
+
+async def call_concurrently(server, callers):
+    return await asyncio.gather(
+        *(server.llm_chat("/ai/chat", f"u{n}", MESSAGES) for n in range(callers)),
+        return_exceptions=True
+    )
+
+
+async def test_slow_coalesced_call_counts_one_breaker_failure(llm, monkeypatch):
+    server = llm
+
+    async def slow(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        return "late", 0
+
+    monkeypatch.setattr(server, "llm_complete", slow)
+    results = await call_concurrently(server, 5)
+    assert all(isinstance(result, asyncio.TimeoutError) for result in results)
+
+    await asyncio.sleep(0.1)
+    assert server.llm_breaker.failures == 1
+    assert server.llm_breaker.state == "closed"
+
+
+async def test_failed_coalesced_call_counts_one_breaker_failure(llm, monkeypatch):
+    server = llm
+
+    async def failing(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream error")
+
+    monkeypatch.setattr(server, "llm_complete", failing)
+    results = await call_concurrently(server, 5)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert server.llm_breaker.failures == 1
+
+    # A second upstream failure reaches the threshold and opens the breaker
+    await call_concurrently(server, 1)
+    assert server.llm_breaker.state == "open"
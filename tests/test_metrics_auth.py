@@ -0,0 +1,39 @@
+import pytest
+from fastapi import HTTPException
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_metrics_are_disabled_without_a_configured_token(server, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_TOKEN", None)
+    with pytest.raises(HTTPException) as error:
+        await server.require_metrics_token(x_metrics_token=None)
+    assert error.value.status_code == 404
+
+
+async def test_metrics_require_the_configured_token(server, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_TOKEN", "secret")
+    for token in (None, "", "wrong"):
+        with pytest.raises(HTTPException) as error:
+            await server.require_metrics_token(x_metrics_token=token)
+        assert error.value.status_code == 401
+    await server.require_metrics_token(x_metrics_token="secret")
+
+
+@pytest.mark.parametrize("path", ["/api/metrics", "/api/metrics/llm"])
+@pytest.mark.parametrize("configured, token, expected", [(None, None, 404), ("secret", None, 401), ("secret", "wrong", 401)])
+def test_metrics_routes_are_protected(server, monkeypatch, path, configured, token, expected):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, "METRICS_TOKEN", configured)
+    headers = {"X-Metrics-Token": token} if token else {}
+    assert TestClient(server.app).get(path, headers=headers).status_code == expected
+
+
+def test_prometheus_metrics_are_served_with_the_token(server, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, "METRICS_TOKEN", "secret")
+    response = TestClient(server.app).get("/api/metrics", headers={"X-Metrics-Token": "secret"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
@@ -0,0 +1,56 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def bank(chapters):
+    return [
+        {
+            "chapter": f"Chapter {number}",
+            "chapter_number": number,
+            "questions": [{
+                "question_text": f"Question of chapter {number}?",
+                "options": ["a", "b"],
+                "correct_answer": "a",
+                "explanation": "",
+                "difficulty": "easy",
+                "topic": "t",
+            }],
+        }
+        for number in range(1, chapters + 1)
+    ]
+
+
+@pytest.fixture
+def generate_quiz_data():
+    import generate_quiz_data as module
+    return module
+
+
+async def test_reload_moves_attempts_to_the_new_quiz_ids(server, generate_quiz_data):
+    await server.db.chapter_quizzes.insert_one({"quiz_id": "random-uuid", "chapter_number": 1, "chapter_name": "Chapter 1"})
+    await server.db.quiz_attempts.insert_one({"user_id": "u1", "quiz_id": "random-uuid", "score": 90})
+
+    quizzes, questions = generate_quiz_data.build_bank(bank(1))
+    stats = await generate_quiz_data.write_bank(server.db, quizzes, questions)
+
+    assert stats["quiz_attempts"] == {"migrated": 1}
+    assert stats["chapter_quizzes"]["removed"] == 1
+    assert await server.db.quiz_attempts.find_one({"quiz_id": quizzes[0]["quiz_id"]}) is not None
+
+
+async def test_dashboard_lists_every_chapter_with_best_scores(server, generate_quiz_data):
+    await server.db.users.insert_one({"user_id": "u1", "xp": 0, "streak": 0})
+    quizzes, questions = generate_quiz_data.build_bank(bank(12))
+    await generate_quiz_data.write_bank(server.db, quizzes, questions)
+    await server.db.quiz_attempts.insert_many([
+        {"user_id": "u1", "quiz_id": quizzes[11]["quiz_id"], "score": 60},
+        {"user_id": "u1", "quiz_id": quizzes[11]["quiz_id"], "score": 80},
+    ])
+
+    dashboard = await server.get_practice_dashboard(current_user={"user_id": "u1"})
+
+    assert len(dashboard["chapter_quizzes"]) == 12
+    last = dashboard["chapter_quizzes"][11]
+    assert (last["best_score"], last["attempts"], last["completed"]) == (80, 2, True)
+    assert dashboard["chapter_quizzes"][0]["attempts"] == 0
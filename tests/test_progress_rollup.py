@@ -0,0 +1,101 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+USER = {"user_id": "u1"}
+
+
+@pytest.fixture
+async def syllabus(server):
+    # c1 has t1 (three subtopics) and t2 (one subtopic)
+    await server.content.topics.insert_many([
+        {"topic_id": "t1", "chapter_id": "c1", "title": "Fractions", "order": 1},
+        {"topic_id": "t2", "chapter_id": "c1", "title": "Decimals", "order": 2},
+    ])
+    await server.content.subtopics.insert_many([
+        {"subtopic_id": f"s{n}", "topic_id": "t1", "chapter_id": "c1", "microcontent_count": 3} for n in (1, 2, 3)
+    ] + [{"subtopic_id": "s4", "topic_id": "t2", "chapter_id": "c1", "microcontent_count": 3}])
+    return server
+
+
+async def complete(server, subtopic_id):
+    info = await server.get_subtopic_info(subtopic_id)
+    update = server.SubtopicProgressUpdate(current_card=3, completed=True)
+    return await server.apply_subtopic_progress("u1", subtopic_id, info, update)
+
+
+async def legacy_completed_subtopics(server, *subtopic_ids):
+    await server.db.subtopic_progress.insert_many([
+        {"user_id": "u1", "subtopic_id": s, "topic_id": "t1", "chapter_id": "c1", "completed": True} for s in subtopic_ids
+    ])
+
+
+async def test_counters_track_subtopic_and_topic_completion(syllabus):
+    server = syllabus
+    assert (await complete(server, "s1"))["topic_completed"] is False
+    assert (await complete(server, "s2"))["topic_completed"] is False
+    result = await complete(server, "s3")
+    assert result == {"message": "Progress updated", "xp_earned": 60, "topic_completed": True}
+
+    topic = await server.db.topic_progress.find_one({"user_id": "u1", "topic_id": "t1"})
+    assert topic["completed_subtopics"] == 3 and topic["completed"] is True
+    chapter = await server.db.user_progress.find_one({"user_id": "u1", "chapter_id": "c1"})
+    assert chapter["completed_topics"] == 1 and chapter["completed"] is False
+
+
+async def test_legacy_rows_are_seeded_on_first_use(syllabus):
+    server = syllabus
+    await legacy_completed_subtopics(server, "s1", "s2")
+    await server.db.topic_progress.insert_one({"user_id": "u1", "topic_id": "t1", "chapter_id": "c1", "progress": 66})
+
+    result = await complete(server, "s3")
+
+    assert result["topic_completed"] is True
+    topic = await server.db.topic_progress.find_one({"user_id": "u1", "topic_id": "t1"})
+    assert topic["completed_subtopics"] == 3
+    chapter = await server.db.user_progress.find_one({"user_id": "u1", "chapter_id": "c1"})
+    assert chapter["completed_topics"] == 1
+
+
+async def test_recompleting_a_subtopic_finishes_a_topic_completed_before_counters(syllabus):
+    server = syllabus
+    await legacy_completed_subtopics(server, "s1", "s2", "s3")
+
+    result = await complete(server, "s3")
+
+    assert result["topic_completed"] is True
+    assert result["xp_earned"] == 60
+    chapter = await server.db.user_progress.find_one({"user_id": "u1", "chapter_id": "c1"})
+    assert chapter["completed_topics"] == 1
+
+
+async def test_lesson_completion_and_subtopic_rollup_agree(syllabus):
+    server = syllabus
+    await server.update_topic_progress("t1", progress=95, position=10, current_user=USER)
+    chapter = await server.db.user_progress.find_one({"user_id": "u1", "chapter_id": "c1"})
+    assert chapter["completed_topics"] == 1
+
+    # A subtopic completion must not undo the lesson completion or emit a -1 for the chapter
+    result = await complete(server, "s1")
+    assert result["topic_completed"] is False
+    topic = await server.db.topic_progress.find_one({"user_id": "u1", "topic_id": "t1"})
+    assert topic["completed"] is True and topic["completed_subtopics"] == 1
+    chapter = await server.db.user_progress.find_one({"user_id": "u1", "chapter_id": "c1"})
+    assert chapter["completed_topics"] == 1
+
+    await complete(server, "s4")
+    chapter = await server.db.user_progress.find_one({"user_id": "u1", "chapter_id": "c1"})
+    assert chapter["completed_topics"] == 2 and chapter["completed"] is True
+
+
+async def test_legacy_lesson_completion_is_kept(syllabus):
+    server = syllabus
+    await server.db.topic_progress.insert_one(
+        {"user_id": "u1", "topic_id": "t1", "chapter_id": "c1", "progress": 95, "completed": True}
+    )
+
+    result = await complete(server, "s1")
+
+    assert result["topic_completed"] is False
+    topic = await server.db.topic_progress.find_one({"user_id": "u1", "topic_id": "t1"})
+    assert topic["completed"] is True and topic["lesson_completed"] is True
@@ -0,0 +1,86 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def deleted_user(server):
+    await server.db.users.insert_one({"user_id": "u1", "status": "pending_deletion"})
+    await server.db.quiz_responses.insert_many([{"user_id": "u1"}, {"user_id": "u1"}])
+    await server.db.feedback.insert_one({"user_id": "u1"})
+    await server.db.sync_events.insert_one({"_id": "u1:k", "user_id": "u1"})
+    return server
+
+
+async def test_interrupted_purge_resumes_without_repeating_finished_collections(deleted_user, monkeypatch):
+    server = deleted_user
+    purge_collection = server.purge_user_collection
+    calls = []
+
+    async def failing_on_feedback(user_id, collection, field):
+        calls.append(collection)
+        if collection == "feedback":
+            raise RuntimeError("interrupted")
+        return await purge_collection(user_id, collection, field)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(server, "purge_user_collection", failing_on_feedback)
+        with pytest.raises(RuntimeError):
+            await server.purge_user("u1")
+    assert await server.db.quiz_responses.count_documents({}) == 0
+    assert await server.db.users.count_documents({}) == 1
+
+    calls.clear()
+    monkeypatch.setattr(server, "purge_user_collection", lambda *args: calls.append(args[1]) or purge_collection(*args))
+    assert await server.purge_user("u1") == 4
+
+    assert calls[0] == "feedback"
+    assert "quiz_responses" not in calls
+    assert await server.db.feedback.count_documents({}) == 0
+    assert await server.db.sync_events.count_documents({}) == 0
+    assert await server.db.users.count_documents({}) == 0
+    assert await server.db.purge_checkpoints.count_documents({}) == 0
+
+
+async def test_resumed_purge_covers_collections_added_since_the_checkpoint(deleted_user, monkeypatch):
+    server = deleted_user
+    await server.db.purge_checkpoints.insert_one({
+        "_id": "u1",
+        "done": [f"{collection}.{field}" for collection, field in server.USER_DATA_COLLECTIONS[:5]],
+        "deleted": 0,
+    })
+    await server.db.new_notes.insert_one({"user_id": "u1"})
+    monkeypatch.setattr(server, "USER_DATA_COLLECTIONS", [("new_notes", "user_id")] + server.USER_DATA_COLLECTIONS)
+
+    await server.purge_user("u1")
+
+    assert await server.db.new_notes.count_documents({}) == 0
+    assert await server.db.feedback.count_documents({}) == 0
+    # quiz_responses was recorded as finished, so the resumed run leaves it alone
+    assert await server.db.quiz_responses.count_documents({}) == 2
+
+
+async def test_backlog_is_purged_in_batches_without_holding_a_cursor(server, monkeypatch):
+    deleted_at = server.datetime.utcnow() - server.ACCOUNT_DELETION_GRACE - server.timedelta(days=1)
+    await server.db.users.insert_many([
+        {"user_id": f"u{n}", "status": "pending_deletion", "deleted_at": deleted_at} for n in range(5)
+    ] + [{"user_id": "active", "status": "active"}])
+    await server.db.feedback.insert_many([{"user_id": f"u{n}"} for n in range(5)])
+    monkeypatch.setattr(server, "PURGE_BATCH_SIZE", 2)
+
+    collection = type(server.db.users)
+    find = collection.find
+    batches = []
+
+    def recording_find(self, *args, **kwargs):
+        cursor = find(self, *args, **kwargs)
+        if args and args[0].get("status") == "pending_deletion":
+            batches.append(cursor)
+        return cursor
+
+    monkeypatch.setattr(collection, "find", recording_find)
+    assert await server.purge_deleted_accounts() == {"accounts": 5, "documents": 5}
+
+    # Three batches of at most two ids, then an empty query ends the run
+    assert len(batches) == 4
+    assert await server.db.users.distinct("user_id") == ["active"]
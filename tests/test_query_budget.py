@@ -0,0 +1,186 @@
+"""Route query counts, measured through the Mongo command listener and the metrics middleware.
+
+mongomock does not emit driver command events, so the database is wrapped to
+report one command per collection call, the way the driver does for every
+round trip that fits in a single batch.
+"""
+import itertools
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from fastapi import APIRouter, Depends, FastAPI
+from fastapi.testclient import TestClient
+
+COMMANDS = {
+    "find": ("find", "filter"),
+    "find_one": ("find", "filter"),
+    "count_documents": ("aggregate", "pipeline"),
+    "aggregate": ("aggregate", "pipeline"),
+    "distinct": ("distinct", "query"),
+    "insert_one": ("insert", "documents"),
+    "insert_many": ("insert", "documents"),
+    "update_one": ("update", "updates"),
+    "update_many": ("update", "updates"),
+    "delete_many": ("delete", "deletes"),
+    "find_one_and_update": ("findAndModify", "query"),
+    "bulk_write": ("update", "updates"),
+}
+
+request_ids = itertools.count()
+
+
+class CountingCollection:
+    def __init__(self, collection, listener):
+        self._collection = collection
+        self._listener = listener
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+        if name not in COMMANDS:
+            return method
+
+        def call(*args, **kwargs):
+            command_name, field = COMMANDS[name]
+            request_id = next(request_ids)
+            self._listener.started(SimpleNamespace(
+                command_name=command_name,
+                command={command_name: self._collection.name, field: args[0] if args else {}},
+                connection_id=1,
+                request_id=request_id,
+            ))
+            self._listener.succeeded(SimpleNamespace(
+                command_name=command_name, connection_id=1, request_id=request_id, duration_micros=100
+            ))
+            return method(*args, **kwargs)
+        return call
+
+
+class CountingDatabase:
+    def __init__(self, database, listener):
+        self._database = database
+        self._listener = listener
+
+    def __getitem__(self, name):
+        return CountingCollection(self._database[name], self._listener)
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+@pytest.fixture
+def measured(server, database, monkeypatch):
+    """A client for the API routes with query budgets enforced; records each route's command count"""
+    from content_versions import ContentNamespace
+    from metrics import MetricsRegistry, RequestMetricsMiddleware
+
+    counting = CountingDatabase(database, server.mongo_command_listener)
+    monkeypatch.setattr(server, "db", counting)
+    monkeypatch.setattr(server, "content", ContentNamespace(counting))
+
+    counts = {}
+
+    class RecordingMiddleware(RequestMetricsMiddleware):
+        def check_budget(self, labels, endpoint, stats):
+            counts[labels["route"]] = stats.mongo_commands
+            super().check_budget(labels, endpoint, stats)
+
+    app = FastAPI()
+    app.include_router(server.api_router)
+    app.add_middleware(RecordingMiddleware, registry=MetricsRegistry(), budget_mode="raise")
+
+    def get(path, user_id="u1", **kwargs):
+        token = server.create_access_token({"sub": user_id})
+        return TestClient(app).get(path, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+
+    return SimpleNamespace(get=get, counts=counts, app=app, server=server)
+
+
+@pytest.fixture
+async def community(database):
+    now = datetime.utcnow()
+    await database.users.insert_many([
+        {"user_id": "u1", "full_name": "Asha", "role": "student", "xp": 0, "streak": 0},
+        {"user_id": "u2", "full_name": "Ravi", "role": "student", "xp": 0, "streak": 0},
+        {"user_id": "p1", "full_name": "Parent", "role": "parent", "xp": 0, "streak": 0},
+    ])
+    await database.study_groups.insert_many([
+        {"group_id": f"g{n}", "name": f"Group {n}", "max_members": 10} for n in range(5)
+    ])
+    await database.group_members.insert_many(
+        [{"group_id": f"g{n}", "user_id": "u2"} for n in range(5)] + [{"group_id": "g0", "user_id": "u1"}]
+    )
+    await database.group_messages.insert_many([
+        {"group_id": "g0", "user_id": user_id, "message": "hi", "created_at": now} for user_id in ["u1", "u2"] * 3
+    ])
+    await database.parent_links.insert_many([
+        {"parent_id": "p1", "student_id": student_id} for student_id in ("u1", "u2")
+    ])
+
+
+@pytest.mark.anyio
+async def test_budgeted_routes_issue_exactly_their_budget(measured, community, database, monkeypatch):
+    server = measured.server
+    await database.chapter_quizzes.insert_many([
+        {"quiz_id": f"cq{n}", "chapter_number": n, "chapter_name": f"Chapter {n}"} for n in range(12)
+    ])
+    await database.quiz_attempts.insert_many([
+        {"user_id": "u1", "quiz_id": f"cq{n}", "score": 80, "completed_at": datetime.utcnow()} for n in range(12)
+    ])
+    await database.quiz_questions.insert_many([
+        {"question_id": f"q{n}", "question_text": "?", "correct_answer": "a", "options": ["a", "b"], "topic": "t"}
+        for n in range(3)
+    ])
+    await database.quiz_responses.insert_many([
+        {"user_id": "u1", "quiz_id": "quiz", "question_id": f"q{n}", "is_correct": n == 0, "created_at": datetime.utcnow()}
+        for n in range(3)
+    ])
+
+    # Recommendations check the LLM quota before calling the model
+    async def recommend(*args, **kwargs):
+        return '["Review fractions"]'
+
+    monkeypatch.setattr(server, "LLM_ENABLED", True)
+    monkeypatch.setattr(server, "llm_chat", recommend)
+
+    for path, user_id in [
+        ("/api/quizzes/quiz/results", "u1"),
+        ("/api/community/groups", "u1"),
+        ("/api/community/groups/g0/messages", "u1"),
+        ("/api/parent/children", "p1"),
+        ("/api/practice/dashboard", "u1"),
+    ]:
+        assert measured.get(path, user_id).status_code == 200, path
+
+    budgets = {
+        route.path: route.endpoint.query_budget
+        for route in measured.app.routes
+        if hasattr(getattr(route, "endpoint", None), "query_budget")
+    }
+    assert measured.counts == budgets
+
+
+@pytest.mark.anyio
+async def test_route_over_budget_is_reported(measured, community, monkeypatch):
+    from metrics import QueryBudgetExceeded
+
+    monkeypatch.setattr(measured.server.get_study_groups, "query_budget", 2)
+    with pytest.raises(QueryBudgetExceeded, match=r"GET /api/community/groups: 3 Mongo commands \(budget 2\)"):
+        measured.get("/api/community/groups")
+
+
+@pytest.mark.anyio
+async def test_repeated_query_shape_is_reported(measured, community):
+    from metrics import QueryBudgetExceeded
+
+    server = measured.server
+    router = APIRouter()
+
+    @router.get("/n-plus-one")
+    async def n_plus_one(current_user=Depends(server.get_current_user)):
+        groups = await server.db.study_groups.find().to_list(None)
+        return [await server.db.group_members.count_documents({"group_id": group["group_id"]}) for group in groups]
+
+    measured.app.include_router(router)
+    with pytest.raises(QueryBudgetExceeded, match=r"5x group_members\.aggregate"):
+        measured.get("/n-plus-one")
@@ -0,0 +1,73 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+USER = {"user_id": "u1", "streak": 0}
+
+
+async def seed_questions(server):
+    await server.content.quiz_questions.insert_many([
+        {"question_id": "q1", "question_text": "2 + 2?", "correct_answer": "4", "topic": "Addition"},
+        {"question_id": "q2", "question_text": "3 * 3?", "correct_answer": "9", "topic": "Multiplication"},
+    ])
+
+
+def batch(server, *answers):
+    return server.QuizBatchSubmission(quiz_id="quiz1", answers=[
+        server.QuizBatchAnswer(question_id=question_id, user_answer=answer) for question_id, answer in answers
+    ])
+
+
+async def test_repeated_correct_answer_earns_xp_once(server):
+    await seed_questions(server)
+
+    results = await server.submit_quiz_batch(batch(server, ("q1", "4"), ("q1", "4"), ("q1", "4")), current_user=USER)
+    assert results["xp_earned"] == 5
+    assert results["total_questions"] == 1
+
+    results = await server.submit_quiz_batch(batch(server, ("q1", "4")), current_user=USER)
+    assert results["xp_earned"] == 0
+    assert server.xp_aggregator.pending_xp("u1") == 5
+
+
+async def test_results_cover_answers_from_earlier_parts(server):
+    await seed_questions(server)
+
+    await server.submit_quiz_batch(batch(server, ("q1", "4")), current_user=USER)
+    results = await server.submit_quiz_batch(batch(server, ("q2", "8")), current_user=USER)
+
+    assert results["total_questions"] == 2
+    assert results["correct_answers"] == 1
+    assert results["score"] == 50
+    assert await server.db.quiz_responses.count_documents({"user_id": "u1"}) == 2
+
+
+async def test_answer_corrected_later_still_earns_xp_once(server):
+    await seed_questions(server)
+
+    first = await server.submit_quiz_batch(batch(server, ("q2", "8")), current_user=USER)
+    second = await server.submit_quiz_batch(batch(server, ("q2", "9")), current_user=USER)
+    third = await server.submit_quiz_batch(batch(server, ("q2", "8"), ("q2", "9")), current_user=USER)
+
+    assert [first["xp_earned"], second["xp_earned"], third["xp_earned"]] == [0, 5, 0]
+    assert third["correct_answers"] == 1
+
+
+async def test_concurrent_claim_credits_only_the_questions_this_call_claimed(server, monkeypatch):
+    await seed_questions(server)
+    responses = [
+        server.grade_quiz_answer("u1", "quiz1", server.QuizBatchAnswer(question_id=question_id, user_answer=answer),
+                                 {"question_id": question_id, "correct_answer": answer}, server.datetime.utcnow())
+        for question_id, answer in (("q1", "4"), ("q2", "9"))
+    ]
+    collection = type(server.db.quiz_responses)
+    bulk_write = collection.bulk_write
+
+    async def racing_bulk_write(self, requests, **kwargs):
+        # Another submission claims q1 between storing the answers and claiming the XP
+        if any("xp_awarded" in request._doc.get("$set", {}) for request in requests):
+            await self.update_one({"user_id": "u1", "question_id": "q1"}, {"$set": {"xp_awarded": True}})
+        return await bulk_write(self, requests, **kwargs)
+
+    monkeypatch.setattr(collection, "bulk_write", racing_bulk_write)
+    assert await server.store_quiz_responses("u1", responses) == {("quiz1", "q2"): 5}
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+USER = {"user_id": "u1"}
+
+
+def event(key, event_type, **payload):
+    return {"idempotency_key": key, "type": event_type, "payload": payload}
+
+
+def onboarding(key, answer="a"):
+    return event(key, "onboarding_answer", question_id="q1", answer=answer)
+
+
+def feedback(key):
+    return event(key, "feedback", category="other", message="hi")
+
+
+async def sync(server, *events):
+    response = await server.sync_offline_events(server.SyncBatch(events=list(events)), current_user=USER)
+    return [result["status"] for result in response["results"]]
+
+
+async def test_events_apply_in_submitted_order(server, monkeypatch):
+    runs = []
+    apply = server.apply_sync_events
+
+    async def recording(user_id, event_type, events):
+        runs.append((event_type, [e.idempotency_key for e, _ in events]))
+        return await apply(user_id, event_type, events)
+
+    monkeypatch.setattr(server, "apply_sync_events", recording)
+    statuses = await sync(server, onboarding("k1"), onboarding("k2"), feedback("k3"), onboarding("k4"))
+
+    assert statuses == ["applied"] * 4
+    assert runs == [
+        ("onboarding_answer", ["k1", "k2"]),
+        ("feedback", ["k3"]),
+        ("onboarding_answer", ["k4"]),
+    ]
+
+
+async def test_failed_apply_releases_claims_for_retry(server, monkeypatch):
+    apply = server.apply_sync_events
+
+    async def failing_feedback(user_id, event_type, events):
+        if event_type == "feedback":
+            raise RuntimeError("write failed")
+        return await apply(user_id, event_type, events)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(server, "apply_sync_events", failing_feedback)
+        with pytest.raises(RuntimeError):
+            await sync(server, onboarding("k1"), feedback("k2"), onboarding("k3"))
+
+    assert await sync(server, onboarding("k1"), feedback("k2"), onboarding("k3")) == ["duplicate", "applied", "applied"]
+    assert await server.db.onboarding_responses.count_documents({"user_id": "u1"}) == 2
+    assert await server.db.feedback.count_documents({}) == 1
+
+
+async def test_stale_pending_claim_is_taken_over(server):
+    now = datetime.utcnow()
+    await server.db.sync_events.insert_many([
+        {"_id": "u1:stale", "user_id": "u1", "type": "feedback", "status": "pending",
+         "lease_until": now - timedelta(seconds=1), "created_at": now},
+        {"_id": "u1:live", "user_id": "u1", "type": "feedback", "status": "pending",
+         "lease_until": now + timedelta(minutes=5), "created_at": now},
+    ])
+
+    assert await sync(server, feedback("stale"), feedback("live")) == ["applied", "in_progress"]
+    stored = await server.db.sync_events.find_one({"_id": "u1:stale"})
+    assert stored["status"] == "applied"
+    assert "lease_until" not in stored
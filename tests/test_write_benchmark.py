@@ -0,0 +1,27 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def benchmark(server):
+    import benchmark_write_pipeline as module
+    return module
+
+
+async def progress_state(database, user_id):
+    user = await database.users.find_one({"user_id": user_id})
+    subtopics = await database.subtopic_progress.find(
+        {"user_id": user_id}, {"_id": 0, "subtopic_id": 1, "current_card": 1, "completed": 1}
+    ).sort("subtopic_id").to_list(None)
+    topics = await database.topic_progress.find({"user_id": user_id, "completed": True}).distinct("topic_id")
+    return user["xp"], subtopics, sorted(topics)
+
+
+async def test_both_paths_leave_the_same_progress(database, benchmark):
+    results, users = await benchmark.run_benchmark(database, 4)
+
+    assert set(results) == {"sequential", "pipelined"}
+    sequential = await progress_state(database, users["sequential"])
+    assert sequential[0] == 4 * 20 + 2 * 40
+    assert await progress_state(database, users["pipelined"]) == sequential
@@ -0,0 +1,113 @@
+import threading
+from datetime import datetime
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def user(server):
+    await server.db.users.insert_one({"user_id": "u1", "xp": 0, "streak": 0})
+    return server
+
+
+async def stored_user(server):
+    return await server.db.users.find_one({"user_id": "u1"})
+
+
+async def test_journal_append_runs_off_the_event_loop(user, monkeypatch):
+    server = user
+    threads = []
+    append = server.XpJournal.append
+    monkeypatch.setattr(server.XpJournal, "append", lambda self, *args: threads.append(threading.current_thread().name) or append(self, *args))
+
+    await server.xp_aggregator.award("u1", 10)
+
+    assert threads and threads[0].startswith("xp-journal")
+    assert threads[0] != threading.current_thread().name
+    await server.xp_aggregator.stop()
+
+
+async def test_pending_xp_includes_a_batch_whose_flush_failed(user, monkeypatch):
+    server = user
+    aggregator = server.xp_aggregator
+    await aggregator.award("u1", 10)
+
+    async def unavailable(*args, **kwargs):
+        raise RuntimeError("mongo unavailable")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(type(server.db.users), "bulk_write", unavailable)
+        with pytest.raises(RuntimeError):
+            await aggregator.flush()
+    await aggregator.award("u1", 5)
+    assert aggregator.pending_xp("u1") == 15
+
+    await aggregator.flush()
+    assert (await stored_user(server))["xp"] == 15
+    assert aggregator.pending_xp("u1") == 0
+    await aggregator.stop()
+
+
+async def test_replaying_an_old_segment_does_not_count_it_twice(user, monkeypatch, tmp_path):
+    server = user
+    crashed = server.xp_aggregator
+    await crashed.award("u1", 100)
+
+    def crash_before_unlink(path, handle, applied):
+        handle.close()
+        raise RuntimeError("worker died")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(server.XpJournal, "finish_segment", staticmethod(crash_before_unlink))
+        with pytest.raises(RuntimeError):
+            await crashed.flush()
+    assert (await stored_user(server))["xp"] == 100
+
+    # Many more segments are applied to the user before the orphan is replayed
+    other = server.XpAggregator("other", 60, tmp_path / "other_journal", False)
+    for _ in range(60):
+        await other.award("u1", 1)
+        await other.flush()
+    await other.stop()
+
+    survivor = server.XpAggregator("survivor", 60, crashed.journal_dir, False)
+    await survivor.award("u1", 1)
+    await survivor.flush()
+    await survivor.stop()
+
+    assert (await stored_user(server))["xp"] == 161
+    # Only the crashed worker's active segment is left in its journal
+    assert list(crashed.journal_dir.glob("xp-*.jsonl")) == [crashed._journal.path]
+
+
+async def test_settled_segment_ids_are_dropped_from_users(user):
+    server = user
+    aggregator = server.xp_aggregator
+    for _ in range(3):
+        await aggregator.award("u1", 1)
+        await aggregator.flush()
+    await aggregator.flush()
+
+    stored = await stored_user(server)
+    assert stored["xp"] == 3
+    assert stored["xp_segments"] == []
+    await aggregator.stop()
+
+
+async def test_batch_spanning_midnight_advances_the_streak_for_each_day(user):
+    server = user
+    await server.db.users.update_one(
+        {"user_id": "u1"}, {"$set": {"streak": 3, "last_activity_date": datetime(2026, 3, 1, 20, 0)}}
+    )
+    awards = {}
+    server.XpAggregator.accumulate(awards, "u1", 10, datetime(2026, 3, 2, 23, 59))
+    server.XpAggregator.accumulate(awards, "u1", 10, datetime(2026, 3, 3, 0, 1))
+
+    await server.xp_aggregator._write({("segment", "u1"): awards["u1"]})
+
+    stored = await stored_user(server)
+    assert stored["xp"] == 20
+    assert stored["streak"] == 5
+    assert stored["last_activity_date"] == datetime(2026, 3, 3, 0, 1)